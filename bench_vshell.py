@@ -0,0 +1,577 @@
+"""Бенчмарки производительности VShell.
+
+Запуск: python bench_vshell.py journal
+        python bench_vshell.py codec --workers 1 2 4 8 16
+        python bench_vshell.py startup --commands 100000
+        python bench_vshell.py snapshot --files 20000
+        python bench_vshell.py server --clients 1 10 100
+        python bench_vshell.py index --entries 10000 100000
+        python bench_vshell.py transfer --files 100000
+        python bench_vshell.py completion --entries 1000000
+        python bench_vshell.py suite --entries 1000 10000 --output baseline.json
+        python bench_vshell.py compare baseline.json results.json --threshold 0.2
+"""
+import argparse
+import asyncio
+import copy
+import gc
+import io
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+
+from vshell import VShell, CommandDispatcher, Profiler, run_batch, ShellServer, END_OF_REPLY
+
+# Версия формата JSON с результатами набора бенчмарков
+SUITE_FORMAT = 1
+
+
+def make_archive(path, files=100):
+    """Создает архив с files небольшими файлами"""
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for i in range(files):
+            zf.writestr(f"dir{i % 10}/file{i}.txt", f"content {i}\n")
+
+
+def bench_journal_commit(commands, group_commits):
+    """Измеряет стоимость одной команды nano без журнала и с журналом при разных group_commit"""
+    results = []
+    for group_commit in [None] + list(group_commits):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            zip_path = os.path.join(temp_dir, "bench.zip")
+            make_archive(zip_path)
+            shell = VShell(zip_path, journal=group_commit is not None,
+                           group_commit=group_commit or 1, checkpoint_size=float('inf'))
+            start = time.perf_counter()
+            for i in range(commands):
+                shell.nano(f"/dir0/bench{i}.txt", "x" * 64)
+            elapsed = time.perf_counter() - start
+            shell.close()
+        label = "без журнала" if group_commit is None else f"group_commit={group_commit}"
+        results.append((label, elapsed / commands * 1e6))
+    return results
+
+
+def bench_journal_recovery(record_counts):
+    """Измеряет время запуска с воспроизведением журнала из records записей"""
+    results = []
+    for records in record_counts:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            zip_path = os.path.join(temp_dir, "bench.zip")
+            make_archive(zip_path)
+            shell = VShell(zip_path, journal=True, group_commit=records, checkpoint_size=float('inf'))
+            for i in range(records):
+                shell.nano(f"/dir0/bench{i}.txt", "x" * 64)
+            shell.journal.close()
+            start = time.perf_counter()
+            VShell(zip_path, journal=True).close()
+            elapsed = time.perf_counter() - start
+        results.append((records, elapsed * 1000))
+    return results
+
+
+def bench_codec(files, file_size, workers_counts):
+    """Измеряет время загрузки с распаковкой всех файлов и сохранения со сжатием всех файлов"""
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        zip_path = os.path.join(temp_dir, "bench.zip")
+        line = b"".join(b"%08x " % i for i in range(1024))
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for i in range(files):
+                zf.writestr(f"dir{i % 16}/file{i}.txt", (line * (file_size // len(line) + 1))[:file_size])
+        for workers in workers_counts:
+            start = time.perf_counter()
+            shell = VShell(zip_path, lazy=False, workers=workers)
+            load = time.perf_counter() - start
+            # Все файлы помечаются измененными, чтобы сохранение сжимало каждый из них
+            for path, node in list(shell._walk(shell.root)):
+                if not node.is_dir:
+                    shell.nano(path, shell._read(node))
+            start = time.perf_counter()
+            shell._write_to_zip()
+            save = time.perf_counter() - start
+            shell.close()
+            results.append((workers, load * 1000, save * 1000))
+    return results
+
+
+def bench_import(runs):
+    """Измеряет время запуска интерпретатора с импортом модулей (медиана по runs запускам)"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    for label, code in (("python", "pass"), ("import vshell", "import vshell"),
+                        ("import vshell, tkinter", "import vshell, tkinter")):
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], cwd=here, check=True)
+            timings.append(time.perf_counter() - start)
+        results.append((label, statistics.median(timings) * 1000))
+    return results
+
+
+def bench_batch(commands):
+    """Измеряет время пакетного выполнения commands команд через CommandDispatcher"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        zip_path = os.path.join(temp_dir, "bench.zip")
+        make_archive(zip_path)
+        start = time.perf_counter()
+        shell = VShell(zip_path)
+        startup = time.perf_counter() - start
+        cycle = ["cd dir1", "ls", "pwd", "cat file1.txt", "cd ..", "ls", "tree -L 1", "wc dir2/file2.txt"]
+        script = [cycle[i % len(cycle)] for i in range(commands)]
+        start = time.perf_counter()
+        run_batch(CommandDispatcher(shell), script, io.StringIO())
+        elapsed = time.perf_counter() - start
+        shell.close()
+    return startup, elapsed
+
+
+def bench_snapshot(files, snapshots, changes):
+    """Сравнивает снимки VShell с полной копией дерева через copy.deepcopy.
+
+    Снимки чередуются с changes изменениями; для обоих способов замеряются время одного
+    снимка и объем памяти, выделенной под все снимки."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        zip_path = os.path.join(temp_dir, "bench.zip")
+        make_archive(zip_path, files)
+        shell = VShell(zip_path)
+        results = []
+        for label, take in (("snapshot", lambda: shell.snapshot()),
+                            ("deepcopy", lambda: copy.deepcopy(shell.filesystem))):
+            kept = []
+            timings = []
+            tracemalloc.start()
+            for i in range(snapshots):
+                start = time.perf_counter()
+                kept.append(take())
+                timings.append(time.perf_counter() - start)
+                for j in range(changes):
+                    shell.nano(f"/dir{j % 10}/file{j}.txt", f"{label} {i} {j}\n")
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            results.append((label, statistics.median(timings) * 1e6, memory))
+            del kept
+        shell.close()
+    return results
+
+
+def bench_server(client_counts, commands, write_ratio):
+    """Нагружает сервер clients одновременными клиентами; каждый выполняет commands команд.
+
+    Доля write_ratio команд - nano, остальные - чтения (ls, cat, tree, pwd). Возвращает
+    (клиентов, команд/с, p50 и p99 задержки в мс)."""
+    reads = ["ls", "cat /dir1/file1.txt", "tree -L 1", "pwd", "cd /dir2", "cd /"]
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        zip_path = os.path.join(temp_dir, "bench.zip")
+        socket_path = os.path.join(temp_dir, "bench.sock")
+        make_archive(zip_path, 1000)
+        shell = VShell(zip_path)
+        # Сервер работает в своем потоке со своим циклом событий, клиенты - в основном
+        loop = asyncio.new_event_loop()
+        server = loop.run_until_complete(ShellServer(shell).start(socket_path))
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+
+        async def client(index, latencies):
+            reader, writer = await asyncio.open_unix_connection(socket_path)
+            for i in range(commands):
+                if (i * 7919 + index) % 1000 < write_ratio * 1000:
+                    command = f"nano /dir{index % 10}/client{index}.txt {i}"
+                else:
+                    command = reads[(i + index) % len(reads)]
+                start = time.perf_counter()
+                writer.write(command.encode('utf-8') + b"\n")
+                await writer.drain()
+                await reader.readuntil(END_OF_REPLY)
+                latencies.append(time.perf_counter() - start)
+            writer.close()
+            await writer.wait_closed()
+
+        async def run(clients):
+            latencies = []
+            start = time.perf_counter()
+            await asyncio.gather(*(client(index, latencies) for index in range(clients)))
+            return time.perf_counter() - start, latencies
+
+        for clients in client_counts:
+            elapsed, latencies = asyncio.run(run(clients))
+            latencies.sort()
+            p50 = latencies[len(latencies) // 2] * 1000
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+            results.append((clients, len(latencies) / elapsed, p50, p99))
+
+        async def shutdown():
+            server.close()
+            await server.wait_closed()
+            # Клиенты уже отключились, поэтому обработчики подключений дочитывают конец потока
+            # и завершаются сами; зависшие отменяются, чтобы цикл не остановился с живыми задачами
+            handlers = asyncio.all_tasks() - {asyncio.current_task()}
+            if handlers:
+                _, pending = await asyncio.wait(handlers, timeout=5)
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(shutdown(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+        shell.close()
+    return results
+
+
+def generate_archive(path, entries, fanout=10, depth=3, size_dist="lognormal", mean_size=1024,
+                     binary_ratio=0.1, seed=0):
+    """Создает синтетический архив из entries файлов.
+
+    Директории образуют дерево с ветвлением fanout и глубиной depth, файлы раскладываются
+    по директориям нижнего уровня по кругу. Размеры файлов распределены по size_dist
+    (fixed, uniform или lognormal) со средним mean_size; доля binary_ratio файлов - случайные
+    байты без сжатия, остальные - текст со сжатием. Содержимое детерминировано seed.
+    Возвращает пути всех файлов."""
+    rng = random.Random(seed)
+    leaves = [""]
+    for _ in range(depth):
+        leaves = [f"{parent}d{i}/" for parent in leaves for i in range(fanout)]
+    words = " ".join(f"w{rng.randrange(10000)}" for _ in range(16384)).encode()
+    sigma = 1.0
+    mu = math.log(max(mean_size, 1)) - sigma * sigma / 2
+
+    def size():
+        if size_dist == "fixed":
+            return mean_size
+        if size_dist == "uniform":
+            return rng.randint(0, 2 * mean_size)
+        return min(int(rng.lognormvariate(mu, sigma)), 64 * mean_size)
+
+    names = []
+    with zipfile.ZipFile(path, 'w') as zf:
+        for i in range(entries):
+            binary = rng.random() < binary_ratio
+            name = f"{leaves[i % len(leaves)]}f{i}.{'bin' if binary else 'txt'}"
+            length = size()
+            if binary:
+                zf.writestr(name, rng.randbytes(length), zipfile.ZIP_STORED)
+            else:
+                start = rng.randrange(len(words))
+                data = (words[start:] + words) * (length // len(words) + 1)
+                zf.writestr(name, data[:length], zipfile.ZIP_DEFLATED)
+            names.append('/' + name)
+    return names
+
+
+def measure(operation, repeats):
+    """Замеряет операцию: медиана и минимум времени по repeats запускам, затем отдельный запуск
+    под tracemalloc - пик выделенной памяти и прирост числа выделенных блоков"""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        operation()
+        timings.append(time.perf_counter() - start)
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    operation()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": statistics.median(timings), "min_seconds": min(timings),
+            "alloc_peak": peak, "alloc_blocks": sys.getallocatedblocks() - blocks,
+            "peak_rss": Profiler.peak_memory()}
+
+
+def bench_suite(entries_counts, fanout, depth, size_dist, mean_size, binary_ratio, repeats, seed=0):
+    """Прогоняет операции VShell на синтетических архивах каждого размера из entries_counts"""
+    results = {}
+    for entries in entries_counts:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            zip_path = os.path.join(temp_dir, "suite.zip")
+            files = generate_archive(zip_path, entries, fanout, depth, size_dist, mean_size, binary_ratio, seed)
+            sample = random.Random(seed).sample(files, min(100, len(files)))
+            shell = VShell(zip_path)
+            top = sorted(shell.ls())[0]
+            deep = sample[0].rsplit('/', 1)[0] or '/'
+            counter = iter(range(10 ** 9))
+
+            def ls_deep():
+                shell.cd(deep)
+                shell.ls()
+                shell.cd('/')
+
+            def mv():
+                shell.mv(f"/{top}", "/moved")
+                shell.mv("/moved", f"/{top}")
+
+            def nano():
+                for path in sample:
+                    shell.nano(path, f"changed {next(counter)}\n")
+
+            def save():
+                shell.nano(sample[0], f"saved {next(counter)}\n")
+                shell._write_to_zip()
+
+            operations = [
+                ("load", lambda: VShell(zip_path).close()),
+                ("ls", shell.ls),
+                ("ls_deep", ls_deep),
+                ("tree", lambda: shell.tree_helper('/')),
+                ("cat_100", lambda: [shell.cat(path) for path in sample]),
+                ("find_prefix", lambda: list(shell.find('/', name="f1*"))),
+                ("find_glob", lambda: list(shell.find('/', name="*7.bin"))),
+                ("du_summary", lambda: list(shell.du('/', summarize=True))),
+                ("mv_dir", mv),
+                ("nano_100", nano),
+                ("write_to_zip", save),
+            ]
+            shape = f"{entries}"
+            results[shape] = {name: measure(operation, repeats) for name, operation in operations}
+            shell.close()
+    return {"format": SUITE_FORMAT, "python": platform.python_version(), "platform": platform.platform(),
+            "shape": {"fanout": fanout, "depth": depth, "size_dist": size_dist, "mean_size": mean_size,
+                      "binary_ratio": binary_ratio, "seed": seed},
+            "results": results}
+
+
+def bench_index(entries_counts, runs):
+    """Сравнивает загрузку архива без индекса-спутника, с его построением и по готовому индексу"""
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for entries in entries_counts:
+            zip_path = os.path.join(temp_dir, f"index{entries}.zip")
+            generate_archive(zip_path, entries, mean_size=64)
+            timings = {"без индекса": [], "построение": [], "по индексу": []}
+            for _ in range(runs):
+                for label, index_cache in (("без индекса", False), ("построение", True), ("по индексу", True)):
+                    if label == "построение" and os.path.exists(zip_path + ".index"):
+                        os.remove(zip_path + ".index")
+                    # Дерево предыдущего запуска не должно собираться во время замера
+                    gc.collect()
+                    start = time.perf_counter()
+                    VShell(zip_path, index_cache=index_cache).close()
+                    timings[label].append(time.perf_counter() - start)
+            results.append((entries, os.path.getsize(zip_path + ".index"),
+                            {label: statistics.median(values) * 1000 for label, values in timings.items()}))
+    return results
+
+
+def bench_transfer(files, file_size, fanout):
+    """Измеряет пропускную способность import и export на дереве хоста из files файлов"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        host_dir = os.path.join(temp_dir, "host")
+        line = b"0123456789abcdef" * 4 + b"\n"
+        data = (line * (file_size // len(line) + 1))[:file_size]
+        for i in range(files):
+            directory = os.path.join(host_dir, f"d{i % fanout}", f"d{i // fanout % fanout}")
+            if i < fanout * fanout:
+                os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, f"f{i}.txt"), 'wb') as f:
+                f.write(data)
+        zip_path = os.path.join(temp_dir, "bench.zip")
+        make_archive(zip_path, files=1)
+        shell = VShell(zip_path)
+        results = []
+        start = time.perf_counter()
+        shell.import_tree(host_dir, "/imported")
+        results.append(("import", time.perf_counter() - start))
+        start = time.perf_counter()
+        shell.export_tree("/imported", os.path.join(temp_dir, "export"))
+        results.append(("export из памяти", time.perf_counter() - start))
+        shell._write_to_zip()
+        start = time.perf_counter()
+        shell.export_tree("/imported", os.path.join(temp_dir, "export_zip"))
+        results.append(("export из архива", time.perf_counter() - start))
+        shell.close()
+    megabytes = files * file_size / (1024 * 1024)
+    return [(label, files / seconds, megabytes / seconds) for label, seconds in results]
+
+
+def bench_completion(entries, queries):
+    """Измеряет задержку дополнения путей в директории с entries файлами: первое обращение
+    (построение списка имен) и последующие (p50/p99 по queries запросам)"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        zip_path = os.path.join(temp_dir, "completion.zip")
+        # Все файлы в одной директории - худший случай для дополнения
+        files = generate_archive(zip_path, entries, fanout=1, depth=1, size_dist="fixed", mean_size=0)
+        shell = VShell(zip_path)
+        dispatcher = CommandDispatcher(shell)
+        start = time.perf_counter()
+        dispatcher.complete("cat /d0/f1")
+        first = time.perf_counter() - start
+        rng = random.Random(0)
+        timings = []
+        for _ in range(queries):
+            name = rng.choice(files).rsplit('/', 1)[1]
+            line = f"cat /d0/{name[:rng.randint(1, len(name))]}"
+            start = time.perf_counter()
+            dispatcher.complete(line)
+            timings.append(time.perf_counter() - start)
+        shell.mkdir("/d0/new_dir")
+        start = time.perf_counter()
+        dispatcher.complete("cat /d0/new")
+        after_change = time.perf_counter() - start
+        shell.close()
+    timings.sort()
+    return first, timings[len(timings) // 2], timings[int(len(timings) * 0.99)], after_change
+
+
+def compare_results(baseline, current, threshold, metrics=("seconds", "alloc_peak")):
+    """Сравнивает результаты с базовыми; возвращает строки таблицы и список регрессий.
+
+    Регрессия - метрика, выросшая больше чем в 1 + threshold раз."""
+    lines = []
+    regressions = []
+    for shape, operations in current["results"].items():
+        base_operations = baseline["results"].get(shape, {})
+        for name, values in operations.items():
+            base = base_operations.get(name)
+            if base is None:
+                continue
+            for metric in metrics:
+                if not base.get(metric):
+                    continue
+                ratio = values[metric] / base[metric]
+                regressed = ratio > 1 + threshold
+                lines.append(f"{shape:>8} {name:<14} {metric:<11} {base[metric]:>14.6g} {values[metric]:>14.6g} "
+                             f"{ratio:7.2f}{'  РЕГРЕССИЯ' if regressed else ''}")
+                if regressed:
+                    regressions.append((shape, name, metric, ratio))
+    return lines, regressions
+
+
+def print_comparison(baseline, current, threshold):
+    lines, regressions = compare_results(baseline, current, threshold)
+    print(f"{'записей':>8} {'операция':<14} {'метрика':<11} {'база':>14} {'сейчас':>14} {'отн.':>7}")
+    print("\n".join(lines))
+    print(f"Регрессий больше {threshold:.0%}: {len(regressions)}")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки VShell")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    journal = subparsers.add_parser("journal", help="стоимость записи в журнал и восстановления")
+    journal.add_argument("--commands", type=int, default=2000)
+    journal.add_argument("--group-commit", type=int, nargs="+", default=[1, 8, 64])
+    journal.add_argument("--records", type=int, nargs="+", default=[1000, 10000, 100000])
+    codec = subparsers.add_parser("codec", help="параллельная распаковка при загрузке и сжатие при сохранении")
+    codec.add_argument("--files", type=int, default=256)
+    codec.add_argument("--file-size", type=int, default=256 * 1024)
+    codec.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    startup = subparsers.add_parser("startup", help="время импорта, запуска и пакетного выполнения команд")
+    startup.add_argument("--commands", type=int, default=100000)
+    startup.add_argument("--runs", type=int, default=5)
+    snapshot = subparsers.add_parser("snapshot", help="стоимость снимков по сравнению с copy.deepcopy")
+    snapshot.add_argument("--files", type=int, default=20000)
+    snapshot.add_argument("--snapshots", type=int, default=5)
+    snapshot.add_argument("--changes", type=int, default=10)
+    server = subparsers.add_parser("server", help="пропускная способность и задержки сервера сеансов")
+    server.add_argument("--clients", type=int, nargs="+", default=[1, 10, 100])
+    server.add_argument("--commands", type=int, default=200, help="команд на одного клиента")
+    server.add_argument("--write-ratio", type=float, default=0.1)
+    index = subparsers.add_parser("index", help="загрузка по индексу-спутнику по сравнению с центральным каталогом")
+    index.add_argument("--entries", type=int, nargs="+", default=[10000, 100000])
+    index.add_argument("--runs", type=int, default=3)
+    transfer = subparsers.add_parser("transfer", help="пропускная способность import и export")
+    transfer.add_argument("--files", type=int, default=100000)
+    transfer.add_argument("--file-size", type=int, default=4096)
+    transfer.add_argument("--fanout", type=int, default=32)
+    completion = subparsers.add_parser("completion", help="задержка дополнения путей по Tab")
+    completion.add_argument("--entries", type=int, default=100000)
+    completion.add_argument("--queries", type=int, default=1000)
+    suite = subparsers.add_parser("suite", help="все операции на синтетических архивах с результатами в JSON")
+    suite.add_argument("--entries", type=int, nargs="+", default=[1000, 10000])
+    suite.add_argument("--fanout", type=int, default=10)
+    suite.add_argument("--depth", type=int, default=3)
+    suite.add_argument("--size-dist", choices=["fixed", "uniform", "lognormal"], default="lognormal")
+    suite.add_argument("--mean-size", type=int, default=1024)
+    suite.add_argument("--binary-ratio", type=float, default=0.1)
+    suite.add_argument("--repeats", type=int, default=5)
+    suite.add_argument("--seed", type=int, default=0)
+    suite.add_argument("--output", help="файл для результатов в JSON")
+    suite.add_argument("--baseline", help="сравнить с результатами из этого JSON-файла")
+    suite.add_argument("--threshold", type=float, default=0.2, help="допустимый рост метрики (0.2 = 20%%)")
+    compare = subparsers.add_parser("compare", help="сравнить два JSON-файла с результатами набора")
+    compare.add_argument("baseline")
+    compare.add_argument("current")
+    compare.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.benchmark == "journal":
+        print("Стоимость команды nano:")
+        for label, micros in bench_journal_commit(args.commands, args.group_commit):
+            print(f"  {label:<20} {micros:10.1f} мкс/команда")
+        print("Восстановление из журнала:")
+        for records, millis in bench_journal_recovery(args.records):
+            print(f"  {records:>8} записей {millis:10.1f} мс")
+    elif args.benchmark == "codec":
+        print(f"{'потоков':>8} {'загрузка, мс':>14} {'сохранение, мс':>16}")
+        for workers, load, save in bench_codec(args.files, args.file_size, args.workers):
+            print(f"{workers:>8} {load:14.1f} {save:16.1f}")
+    elif args.benchmark == "startup":
+        print("Время запуска интерпретатора:")
+        for label, millis in bench_import(args.runs):
+            print(f"  {label:<24} {millis:8.1f} мс")
+        startup_time, elapsed = bench_batch(args.commands)
+        print(f"Загрузка архива: {startup_time * 1000:.1f} мс")
+        print(f"Пакетное выполнение: {args.commands} команд за {elapsed:.2f} с "
+              f"({args.commands / elapsed:.0f} команд/с, {elapsed / args.commands * 1e6:.1f} мкс/команда)")
+    elif args.benchmark == "snapshot":
+        print(f"{args.files} файлов, {args.snapshots} снимков по {args.changes} изменений между ними")
+        print(f"{'способ':>10} {'снимок, мкс':>14} {'память, МБ':>12}")
+        for label, micros, memory in bench_snapshot(args.files, args.snapshots, args.changes):
+            print(f"{label:>10} {micros:14.1f} {memory / (1024 * 1024):12.2f}")
+    elif args.benchmark == "server":
+        print(f"{'клиентов':>9} {'команд/с':>10} {'p50, мс':>9} {'p99, мс':>9}")
+        for clients, throughput, p50, p99 in bench_server(args.clients, args.commands, args.write_ratio):
+            print(f"{clients:>9} {throughput:10.0f} {p50:9.2f} {p99:9.2f}")
+    elif args.benchmark == "index":
+        print(f"{'записей':>8} {'индекс, КБ':>11} {'без индекса, мс':>16} {'построение, мс':>15} {'по индексу, мс':>15}")
+        for entries, size, timings in bench_index(args.entries, args.runs):
+            print(f"{entries:>8} {size / 1024:11.0f} {timings['без индекса']:16.1f} "
+                  f"{timings['построение']:15.1f} {timings['по индексу']:15.1f}")
+    elif args.benchmark == "transfer":
+        print(f"{args.files} файлов по {args.file_size} байт")
+        print(f"{'операция':<18} {'файлов/с':>10} {'МБ/с':>8}")
+        for label, files_per_second, megabytes_per_second in bench_transfer(args.files, args.file_size, args.fanout):
+            print(f"{label:<18} {files_per_second:10.0f} {megabytes_per_second:8.1f}")
+    elif args.benchmark == "completion":
+        first, p50, p99, after_change = bench_completion(args.entries, args.queries)
+        print(f"{args.entries} файлов в одной директории")
+        print(f"  первое дополнение (сортировка имен): {first * 1000:10.2f} мс")
+        print(f"  p50:                                 {p50 * 1000:10.3f} мс")
+        print(f"  p99:                                 {p99 * 1000:10.3f} мс")
+        print(f"  после mkdir в той же директории:     {after_change * 1000:10.3f} мс")
+    elif args.benchmark == "suite":
+        current = bench_suite(args.entries, args.fanout, args.depth, args.size_dist, args.mean_size,
+                              args.binary_ratio, args.repeats, args.seed)
+        for shape, operations in current["results"].items():
+            print(f"{shape} записей:")
+            for name, values in operations.items():
+                print(f"  {name:<14} {values['seconds'] * 1000:10.3f} мс  "
+                      f"пик выделений {values['alloc_peak'] / 1024:10.1f} КБ  блоков {values['alloc_blocks']:+8d}")
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(current, f, indent=2, ensure_ascii=False)
+        if args.baseline:
+            with open(args.baseline, encoding='utf-8') as f:
+                sys.exit(print_comparison(json.load(f), current, args.threshold))
+    elif args.benchmark == "compare":
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        with open(args.current, encoding='utf-8') as f:
+            current = json.load(f)
+        sys.exit(print_comparison(baseline, current, args.threshold))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,14 @@ import unittest
 import tempfile
 import zipfile
 import os
-from vshell import VShell
+import io
+import socket
+import subprocess
+import sys
+import threading
+from unittest import mock
+import vshell
+from vshell import VShell, CommandDispatcher, run_batch, Session, ShellServer, END_OF_REPLY
 
 class TestVShell(unittest.TestCase):
     def setUp(self):
@@ -55,6 +62,7 @@ class TestVShell(unittest.TestCase):
         self.assertEqual(shell._abs_path("../file.txt"), "/file.txt")
         self.assertEqual(shell._abs_path("/file.txt"), "/file.txt")
     def tearDown(self):
+        self.shell.close()
         os.remove(self.zip_path)
         os.rmdir(self.temp_dir)
 
@@ -130,5 +138,1141 @@ class TestVShell(unittest.TestCase):
         self.assertIn("dir1/file2.txt", tree_output)
         self.assertIn("dir1/subdir/file3.txt", tree_output)
 
+    def test_tree_depth_and_dirs_only(self):
+        self.assertEqual(self.shell.tree(max_depth=1), "/\n├── dir1\n└── file1.txt\n")
+        self.assertEqual(self.shell.tree(dirs_only=True), "/\n└── dir1\n    └── subdir\n")
+
+    def test_tree_limit_and_streaming(self):
+        lines = self.shell.iter_tree(limit=2)
+        self.assertEqual(next(lines), "/")
+        self.assertEqual(list(lines), ["├── dir1", "│   ├── file2.txt", "... (вывод ограничен 2 записями)"])
+
+    def test_tree_deep_hierarchy(self):
+        path = ""
+        for i in range(2000):
+            path += f"/d{i}"
+            self.shell.mkdir(path)
+        self.assertEqual(len(self.shell.tree().splitlines()), 2000 + 6)
+
+    # дерево узлов
+    def test_implicit_parent_directories(self):
+        self.shell.cd("dir1/subdir")
+        self.assertEqual(self.shell.ls(), ['file3.txt'])
+
+    def test_mv_directory_moves_subtree(self):
+        self.shell.mv("dir1", "moved")
+        self.assertEqual(self.shell.cat("/moved/subdir/file3.txt"), "Content of file3")
+        with self.assertRaises(FileNotFoundError):
+            self.shell.cd("/dir1")
+
+    def test_mv_directory_into_itself(self):
+        with self.assertRaises(OSError):
+            self.shell.mv("dir1", "dir1/subdir/inner")
+
+    def test_write_to_zip_round_trip(self):
+        self.shell.mkdir("empty")
+        self.shell.nano("dir1/new.txt", "new content")
+        self.shell._write_to_zip()
+        shell = VShell(self.zip_path)
+        self.assertEqual(shell.ls(), ['dir1', 'empty', 'file1.txt'])
+        self.assertEqual(shell.cat("dir1/new.txt"), "new content")
+
+    # find
+    def test_find_exact_name(self):
+        self.shell.nano("dir1/subdir/file1.txt", "copy")
+        self.assertEqual(list(self.shell.find("/", name="file1.txt")), ["/dir1/subdir/file1.txt", "/file1.txt"])
+        self.assertEqual(list(self.shell.find("dir1", name="file1.txt")), ["/dir1/subdir/file1.txt"])
+        self.assertEqual(list(self.shell.find("/", name="file1.txt", max_depth=1)), ["/file1.txt"])
+
+    def test_find_results_can_be_closed(self):
+        # Окно прерывает вывод по Ctrl+C через close() у любого пути поиска
+        for name in ("file1.txt", "file*", "*.txt"):
+            result = self.shell.find("/", name=name)
+            next(result)
+            result.close()
+            self.assertEqual(list(result), [])
+
+    def test_find_prefix_and_type(self):
+        self.assertEqual(list(self.shell.find("/", name="file*")),
+                         ["/dir1/file2.txt", "/dir1/subdir/file3.txt", "/file1.txt"])
+        self.assertEqual(list(self.shell.find("/", name="sub*", kind="d")), ["/dir1/subdir"])
+        self.assertEqual(list(self.shell.find("/", name="sub*", kind="f")), [])
+
+    def test_find_glob_walk(self):
+        self.assertEqual(list(self.shell.find("/", name="*3.txt")), ["/dir1/subdir/file3.txt"])
+        self.assertEqual(list(self.shell.find("dir1", kind="d")), ["/dir1", "/dir1/subdir"])
+        self.assertEqual(list(self.shell.find("/", name="*.txt", max_depth=1)), ["/file1.txt"])
+
+    def test_find_index_follows_mutations(self):
+        self.shell.mv("dir1/subdir", "renamed")
+        self.shell.mkdir("renamed/inner")
+        self.assertEqual(list(self.shell.find("/", name="subdir")), [])
+        self.assertEqual(list(self.shell.find("/", name="renamed")), ["/renamed"])
+        self.assertEqual(list(self.shell.find("/", name="file3.txt")), ["/renamed/file3.txt"])
+        self.assertEqual(list(self.shell.find("/", name="inner")), ["/renamed/inner"])
+
+    # grep
+    def test_grep_file_and_line_numbers(self):
+        self.shell.nano("notes.txt", "alpha")
+        self.assertEqual(list(self.shell.grep("file1", "file1.txt")), ["Content of file1"])
+        self.assertEqual(list(self.shell.grep("alp", "notes.txt", line_numbers=True)), ["1:alpha"])
+
+    def test_grep_recursive(self):
+        self.assertEqual(list(self.shell.grep("file[23]", "/", recursive=True)),
+                         ["/dir1/file2.txt:Content of file2", "/dir1/subdir/file3.txt:Content of file3"])
+        self.assertEqual(list(self.shell.grep("Content", "dir1", recursive=True, files_only=True)),
+                         ["/dir1/file2.txt", "/dir1/subdir/file3.txt"])
+        with self.assertRaises(IsADirectoryError):
+            self.shell.grep("Content", "dir1")
+
+    def test_grep_does_not_cache_streamed_files(self):
+        list(self.shell.grep("Content", "/", recursive=True))
+        self.assertEqual(len(self.shell._cache), 0)
+
+    def test_grep_trigram_index_skips_files(self):
+        shell = VShell(self.zip_path, grep_index=True)
+        list(shell.grep("Content", "/", recursive=True))
+        self.assertEqual(len(shell._trigrams), 3)
+        scanned = []
+        original = shell._grep_file
+        shell._grep_file = lambda node, *args: scanned.append(node.name) or original(node, *args)
+        self.assertEqual(list(shell.grep("of file3", "/", recursive=True)),
+                         ["/dir1/subdir/file3.txt:Content of file3"])
+        self.assertEqual(scanned, ["file3.txt"])
+        shell.nano("file1.txt", "mentions of file3")
+        scanned.clear()
+        self.assertEqual(len(list(shell.grep("of file3", "/", recursive=True))), 2)
+        self.assertEqual(sorted(scanned), ["file1.txt", "file3.txt"])
+        shell.close()
+
+    # ленивая загрузка
+    def test_lazy_load_does_not_decompress(self):
+        node = self.shell._lookup("/dir1/file2.txt")
+        self.assertIsNone(node.content)
+        self.assertEqual(len(self.shell._cache), 0)
+        self.assertEqual(self.shell.cat("dir1/file2.txt"), "Content of file2")
+        self.assertEqual(len(self.shell._cache), 1)
+
+    def test_eager_load(self):
+        shell = VShell(self.zip_path, lazy=False)
+        self.assertEqual(shell._lookup("/file1.txt").content, "Content of file1")
+        shell.close()
+
+    def test_cache_respects_byte_budget(self):
+        shell = VShell(self.zip_path, cache_size=20)
+        shell.cat("file1.txt")
+        shell.cat("dir1/file2.txt")
+        self.assertEqual(len(shell._cache), 1)
+        self.assertLessEqual(shell._cache.current_bytes, 20)
+        shell.close()
+
+    def test_write_to_zip_copies_untouched_members(self):
+        self.shell.nano("file1.txt", "changed")
+        self.shell._write_to_zip()
+        self.assertEqual(self.shell.cat("dir1/subdir/file3.txt"), "Content of file3")
+        with zipfile.ZipFile(self.zip_path) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.read("file1.txt"), b"changed")
+            self.assertEqual(zf.read("dir1/file2.txt"), b"Content of file2")
+
+    # потоковое чтение
+    def _write_big_file(self, compression):
+        lines = [f"line {i} word" for i in range(20000)]
+        with zipfile.ZipFile(self.zip_path, 'w', compression) as zf:
+            zf.writestr("big.log", "\n".join(lines) + "\n")
+        return VShell(self.zip_path), lines
+
+    def test_head_and_tail_stored(self):
+        shell, lines = self._write_big_file(zipfile.ZIP_STORED)
+        self.assertEqual(shell.head("big.log", 3), "\n".join(lines[:3]) + "\n")
+        self.assertEqual(shell.tail("big.log", 3), "\n".join(lines[-3:]) + "\n")
+        shell.close()
+
+    def test_head_and_tail_deflated(self):
+        shell, lines = self._write_big_file(zipfile.ZIP_DEFLATED)
+        self.assertEqual(shell.head("big.log", 2), "\n".join(lines[:2]) + "\n")
+        self.assertEqual(shell.tail("big.log", 4), "\n".join(lines[-4:]) + "\n")
+        self.assertEqual(len(shell._cache), 0)
+        # Сжатый элемент открывается для tail один раз
+        with mock.patch.object(shell._zip, 'open', wraps=shell._zip.open) as zip_open:
+            self.assertEqual(shell.tail("big.log", 1), lines[-1] + "\n")
+        self.assertEqual(zip_open.call_count, 1)
+        shell.close()
+
+    def test_wc(self):
+        shell, lines = self._write_big_file(zipfile.ZIP_DEFLATED)
+        size = len("\n".join(lines)) + 1
+        self.assertEqual(shell.wc("big.log"), f"20000 60000 {size} big.log")
+        shell.close()
+
+    def test_cat_range(self):
+        self.assertEqual(self.shell.cat("file1.txt", offset=11, length=5), "file1")
+        self.assertEqual(self.shell.cat("file1.txt", offset=11), "file1")
+        self.shell.nano("file1.txt", "in memory")
+        self.assertEqual(self.shell.cat("file1.txt", length=2), "in")
+
+    # сохранение с отслеживанием изменений
+    def test_write_to_zip_without_changes_keeps_archive(self):
+        before = os.stat(self.zip_path)
+        self.shell._write_to_zip()
+        after = os.stat(self.zip_path)
+        self.assertEqual((before.st_ino, before.st_mtime_ns), (after.st_ino, after.st_mtime_ns))
+
+    def test_write_to_zip_keeps_clean_members_compressed_as_is(self):
+        shell = VShell(self.zip_path, lazy=False)
+        shell.mkdir("new_dir")
+        shell._write_to_zip()
+        self.assertFalse(shell.dirty)
+        with zipfile.ZipFile(self.zip_path) as zf:
+            self.assertEqual(zf.getinfo("file1.txt").compress_type, zipfile.ZIP_STORED)
+            self.assertIn("new_dir/", zf.namelist())
+        self.assertEqual([name for name in os.listdir(self.temp_dir)], ["test.zip"])
+        shell.close()
+
+    def test_write_to_zip_keeps_file_mode(self):
+        os.chmod(self.zip_path, 0o644)
+        self.shell.mkdir("new_dir")
+        self.shell._write_to_zip()
+        self.assertEqual(os.stat(self.zip_path).st_mode & 0o777, 0o644)
+
+    # профилирование
+    def test_profiler_load_phases(self):
+        phases = self.shell.profiler.phases
+        for phase in ("central_directory", "decode", "index_build"):
+            self.assertIn(phase, phases)
+
+    def test_profiler_command_histogram(self):
+        profiler = self.shell.profiler
+        profiler.record_command("ls", 0.00005)
+        profiler.record_command("ls", 0.5)
+        stats = profiler.commands["ls"]
+        self.assertEqual(stats["count"], 2)
+        self.assertEqual(stats["histogram"][0], 1)
+        self.assertEqual(stats["histogram"][4], 1)
+        self.assertIn("ls", profiler.report())
+
+    # параллельные распаковка и сжатие
+    def test_parallel_eager_load(self):
+        with zipfile.ZipFile(self.zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for i in range(50):
+                zf.writestr(f"dir{i % 5}/file{i}.txt", f"content {i} " * 100)
+        shell = VShell(self.zip_path, lazy=False, workers=4)
+        for i in range(50):
+            self.assertEqual(shell._lookup(f"/dir{i % 5}/file{i}.txt").content, f"content {i} " * 100)
+        shell.close()
+
+    def test_parallel_save_is_deterministic(self):
+        names = []
+        for workers in (1, 4):
+            shell = VShell(self.zip_path, workers=workers)
+            for i in range(30):
+                shell.nano(f"dir1/new{i}.txt", f"data {i} " * 50)
+            shell._write_to_zip()
+            shell.close()
+            with zipfile.ZipFile(self.zip_path) as zf:
+                self.assertIsNone(zf.testzip())
+                self.assertEqual(zf.read("dir1/new7.txt"), b"data 7 " * 50)
+                names.append(zf.namelist())
+        self.assertEqual(names[0], names[1])
+
+    # копирование и общее содержимое
+    def test_cp_shares_content_until_nano(self):
+        self.shell.nano("notes.txt", "shared text")
+        self.shell.cp("notes.txt", "dir1")
+        self.shell.cp("notes.txt", "copy.txt")
+        original = self.shell._lookup("/notes.txt")
+        copy = self.shell._lookup("/dir1/notes.txt")
+        self.assertIs(copy.content, original.content)
+        self.assertEqual(self.shell._blobs.refs(original.digest), 3)
+        self.shell.nano("dir1/notes.txt", "changed")
+        self.assertEqual(self.shell.cat("notes.txt"), "shared text")
+        self.assertEqual(self.shell.cat("copy.txt"), "shared text")
+        # две копии и прежнее содержимое измененного файла в журнале отмены
+        self.assertEqual(self.shell._blobs.refs(original.digest), 3)
+        self.assertEqual(len(self.shell._blobs), 2)
+
+    def test_cp_recursive(self):
+        with self.assertRaises(IsADirectoryError):
+            self.shell.cp("dir1", "dir2")
+        self.shell.cp("dir1", "dir2", recursive=True)
+        self.assertEqual(self.shell.cat("dir2/subdir/file3.txt"), "Content of file3")
+        self.assertIs(self.shell._lookup("/dir2/file2.txt").member, self.shell._lookup("/dir1/file2.txt").member)
+        self.assertEqual(sorted(self.shell.find("/", name="file3.txt")),
+                         ["/dir1/subdir/file3.txt", "/dir2/subdir/file3.txt"])
+        with self.assertRaises(OSError):
+            self.shell.cp("dir1", "dir1/subdir/loop", recursive=True)
+        with self.assertRaises(FileExistsError):
+            self.shell.cp("dir1", "/", recursive=True)
+
+    def test_write_to_zip_compresses_shared_content_once(self):
+        self.shell.nano("a.txt", "same " * 100)
+        self.shell.nano("b.txt", "same " * 100)
+        self.shell.cp("a.txt", "dir1/c.txt")
+        with mock.patch("vshell.deflate", wraps=vshell.deflate) as deflate:
+            self.shell._write_to_zip()
+        self.assertEqual(deflate.call_count, 1)
+        self.assertEqual(len(self.shell._blobs), 0)
+        with zipfile.ZipFile(self.zip_path) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.read("dir1/c.txt"), b"same " * 100)
+            self.assertEqual(zf.read("b.txt"), b"same " * 100)
+
+
+    # du и stat
+    def assertSizesConsistent(self, shell):
+        for _, node in shell._walk(shell.root):
+            if node.is_dir:
+                files = [child for _, child in shell._walk(node) if not child.is_dir]
+                self.assertEqual(node.size, sum(f.size for f in files))
+                self.assertEqual(node.files, len(files))
+
+    def test_du_uses_central_directory_sizes(self):
+        self.assertEqual(list(self.shell.du("/")),
+                         ["16\t16\t/dir1/subdir", "32\t32\t/dir1", "48\t48\t/"])
+        self.assertEqual(list(self.shell.du("/", summarize=True)), ["48\t48\t/"])
+        self.assertEqual(list(self.shell.du("dir1", max_depth=0)), ["32\t32\t/dir1"])
+        self.assertEqual(list(self.shell.du("file1.txt")), ["16\t16\t/file1.txt"])
+        self.shell.nano("big.txt", "x" * 3000)
+        self.assertEqual(list(self.shell.du("/", human=True, summarize=True)), ["3.0K\t3.0K\t/"])
+
+    def test_sizes_follow_mutations(self):
+        self.shell.nano("dir1/subdir/file3.txt", "longer content of file3")
+        self.shell.mkdir("dir2")
+        self.shell.mv("dir1/subdir", "dir2/subdir")
+        self.shell.cp("dir2", "dir3", recursive=True)
+        self.shell.nano("dir3/subdir/file3.txt", "short")
+        self.assertSizesConsistent(self.shell)
+        self.assertEqual(self.shell.root.files, 4)
+        self.shell._write_to_zip()
+        self.assertSizesConsistent(self.shell)
+        self.assertEqual(self.shell.root.packed, sum(info.compress_size for info in self.shell._zip.infolist()))
+
+    def test_stat(self):
+        self.assertIn("Размер: 16", self.shell.stat("file1.txt"))
+        self.assertIn("Сжатие: stored", self.shell.stat("file1.txt"))
+        self.assertIn("Файлов: 2", self.shell.stat("dir1"))
+        with self.assertRaises(FileNotFoundError):
+            self.shell.stat("missing")
+
+
+    # снимки и отмена
+    def test_undo_each_command(self):
+        self.shell.mkdir("new_dir")
+        self.shell.nano("file1.txt", "edited")
+        self.shell.mv("dir1", "new_dir/dir1")
+        self.shell.cp("file1.txt", "new_dir/file1.txt")
+        self.shell.undo()
+        self.assertEqual(sorted(self.shell._lookup("/new_dir").children), ["dir1"])
+        self.shell.undo()
+        self.assertEqual(self.shell.cat("dir1/file2.txt"), "Content of file2")
+        self.shell.undo()
+        self.assertEqual(self.shell.cat("file1.txt"), "Content of file1")
+        self.shell.undo()
+        self.assertEqual(self.shell.ls(), ["dir1", "file1.txt"])
+        self.assertEqual(list(self.shell.find("/", name="new_dir")), [])
+        self.assertEqual(list(self.shell.du("/", summarize=True)), ["48\t48\t/"])
+        with self.assertRaises(IndexError):
+            self.shell.undo()
+
+    def test_snapshot_and_rollback(self):
+        first = self.shell.snapshot()
+        self.shell.nano("dir1/file2.txt", "v1")
+        second = self.shell.snapshot()
+        self.shell.nano("dir1/file2.txt", "v2")
+        self.shell.cp("dir1", "copy", recursive=True)
+        self.shell.rollback(second)
+        self.assertEqual(self.shell.cat("dir1/file2.txt"), "v1")
+        self.assertNotIn("copy", self.shell.ls())
+        self.shell.rollback(first)
+        self.assertEqual(self.shell.cat("dir1/file2.txt"), "Content of file2")
+        with self.assertRaises(KeyError):
+            self.shell.rollback(second)
+        self.assertEqual(len(self.shell._blobs), 0)
+
+    def test_undo_after_save(self):
+        self.shell.nano("file1.txt", "edited")
+        self.shell._write_to_zip()
+        self.shell.undo()
+        self.assertEqual(self.shell.cat("file1.txt"), "Content of file1")
+        self.assertTrue(self.shell.dirty)
+
+    # импорт и выгрузка
+    def host_path(self, *parts):
+        """Путь во временной директории хоста, которая удаляется после теста"""
+        if not hasattr(self, 'host_dir'):
+            temp_dir = tempfile.TemporaryDirectory()
+            self.addCleanup(temp_dir.cleanup)
+            self.host_dir = temp_dir.name
+        return os.path.join(self.host_dir, *parts)
+
+    def make_host_tree(self):
+        host_dir = self.host_path("host")
+        os.makedirs(os.path.join(host_dir, "sub", "deep"))
+        os.makedirs(os.path.join(host_dir, "empty"))
+        files = {"a.txt": "alpha", "sub/b.txt": "beta\nline", "sub/deep/c.txt": "ж" * 100000}
+        for path, content in files.items():
+            with open(os.path.join(host_dir, *path.split('/')), 'w', encoding='utf-8') as f:
+                f.write(content)
+        return host_dir, files
+
+    def test_import_into_new_directory(self):
+        host_dir, files = self.make_host_tree()
+        result = self.shell.import_tree(host_dir, "imported")
+        self.assertIn("3", result)
+        for path, content in files.items():
+            self.assertEqual(self.shell.cat(f"imported/{path}"), content)
+        self.assertEqual(sorted(self.shell._lookup("/imported").children), ["a.txt", "empty", "sub"])
+        self.assertEqual(list(self.shell.find("/", name="c.txt")), ["/imported/sub/deep/c.txt"])
+        self.assertSizesConsistent(self.shell)
+        self.assertEqual(self.shell._lookup("/imported/sub/deep/c.txt").size, 200000)
+        self.shell.undo()
+        self.assertEqual(self.shell.ls(), ["dir1", "file1.txt"])
+        self.assertEqual(list(self.shell.find("/", name="c.txt")), [])
+        self.assertEqual(list(self.shell.du("/", summarize=True)), ["48\t48\t/"])
+        self.assertEqual(len(self.shell._blobs), 0)
+
+    def test_import_merges_and_undo_restores(self):
+        host_dir = self.host_path("host")
+        os.makedirs(os.path.join(host_dir, "subdir"))
+        with open(os.path.join(host_dir, "file2.txt"), 'w') as f:
+            f.write("imported file2")
+        with open(os.path.join(host_dir, "subdir", "new.txt"), 'w') as f:
+            f.write("new")
+        self.shell.import_tree(host_dir, "/dir1")
+        self.assertEqual(self.shell.cat("dir1/file2.txt"), "imported file2")
+        self.assertEqual(self.shell.cat("dir1/subdir/file3.txt"), "Content of file3")
+        self.assertEqual(self.shell.cat("dir1/subdir/new.txt"), "new")
+        self.assertSizesConsistent(self.shell)
+        self.shell.undo()
+        self.assertEqual(self.shell.cat("dir1/file2.txt"), "Content of file2")
+        self.assertEqual(sorted(self.shell._lookup("/dir1/subdir").children), ["file3.txt"])
+        self.assertSizesConsistent(self.shell)
+
+    def test_import_conflict_changes_nothing(self):
+        host_dir = self.host_path("host")
+        os.makedirs(os.path.join(host_dir, "file1.txt"))
+        with open(os.path.join(host_dir, "other.txt"), 'w') as f:
+            f.write("other")
+        with self.assertRaises(NotADirectoryError):
+            self.shell.import_tree(host_dir, "/")
+        with self.assertRaises(NotADirectoryError):
+            self.shell.import_tree(os.path.join(host_dir, "other.txt"), "/x")
+        self.assertEqual(self.shell.ls(), ["dir1", "file1.txt"])
+        self.assertFalse(self.shell.dirty)
+
+    def test_export_round_trip(self):
+        host_dir, files = self.make_host_tree()
+        self.shell.import_tree(host_dir, "imported")
+        self.shell.nano("dir1/file2.txt", "edited")
+        out_dir = self.host_path("out")
+        self.assertIn("6", self.shell.export_tree("/", out_dir))
+        expected = {f"imported/{path}": content for path, content in files.items()}
+        expected.update({"dir1/file2.txt": "edited", "dir1/subdir/file3.txt": "Content of file3",
+                         "file1.txt": "Content of file1"})
+        for path, content in expected.items():
+            with open(os.path.join(out_dir, *path.split('/')), encoding='utf-8') as f:
+                self.assertEqual(f.read(), content)
+        self.assertTrue(os.path.isdir(os.path.join(out_dir, "imported", "empty")))
+        self.shell.export_tree("file1.txt", self.host_path("single"))
+        with open(self.host_path("single", "file1.txt")) as f:
+            self.assertEqual(f.read(), "Content of file1")
+        with self.assertRaises(FileNotFoundError):
+            self.shell.export_tree("missing", out_dir)
+
+
+class TestCompletion(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.zip_path = os.path.join(self.temp_dir.name, "test.zip")
+        with zipfile.ZipFile(self.zip_path, 'w') as zf:
+            zf.writestr("file1.txt", "Content of file1")
+            zf.writestr("file10.txt", "Content of file10")
+            zf.writestr("dir1/file2.txt", "Content of file2")
+            zf.writestr("dir1/subdir/file3.txt", "Content of file3")
+        self.shell = VShell(self.zip_path)
+        self.dispatcher = CommandDispatcher(self.shell)
+
+    def tearDown(self):
+        self.shell.close()
+        self.temp_dir.cleanup()
+
+    def test_complete_command_names(self):
+        self.assertEqual(self.dispatcher.complete("gr"), (0, ["grep"]))
+        self.assertEqual(self.dispatcher.complete("  c"), (2, ["cat", "cd", "cp"]))
+        self.assertEqual(self.dispatcher.complete("xyz"), (0, []))
+
+    def test_complete_paths(self):
+        self.assertEqual(self.dispatcher.complete("cat fi"), (4, ["file1.txt", "file10.txt"]))
+        self.assertEqual(self.dispatcher.complete("cat d"), (4, ["dir1/"]))
+        self.assertEqual(self.dispatcher.complete("cat dir1/"), (4, ["dir1/file2.txt", "dir1/subdir/"]))
+        self.assertEqual(self.dispatcher.complete("cp -r /dir1/s"), (6, ["/dir1/subdir/"]))
+        self.assertEqual(self.dispatcher.complete("tree -"), (5, []))
+        self.assertEqual(self.dispatcher.complete("cat missing/"), (4, []))
+        self.shell.cd("dir1/subdir")
+        self.assertEqual(self.dispatcher.complete("cat ../f"), (4, ["../file2.txt"]))
+        self.assertEqual(self.dispatcher.complete("cat "), (4, ["file3.txt"]))
+
+    def test_listing_follows_changes(self):
+        root = self.shell.root
+        self.assertEqual(self.shell.ls(), ["dir1", "file1.txt", "file10.txt"])
+        self.assertIsNotNone(root.listing)
+        self.shell.mkdir("a_dir")
+        self.shell.nano("file2.txt", "new")
+        self.shell.mv("file10.txt", "dir1/file10.txt")
+        self.shell.cp("dir1", "copy", recursive=True)
+        self.assertEqual(root.listing, sorted(root.children))
+        self.assertEqual(self.shell.complete("dir1/file1"), ["dir1/file10.txt"])
+        self.assertEqual(self.shell.complete("co"), ["copy/"])
+        for _ in range(4):
+            self.shell.undo()
+            self.assertEqual(root.listing, sorted(root.children))
+        self.assertEqual(self.shell.complete("dir1/file1"), [])
+        self.assertEqual(self.shell.ls(), ["dir1", "file1.txt", "file10.txt"])
+
+
+class TestCommandHistory(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, "history")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_arrows_keep_draft(self):
+        history = vshell.CommandHistory()
+        for command in ("ls", "cd dir1", "cd dir1", "", "cat file1.txt"):
+            history.add(command)
+        self.assertEqual(history.entries, ["ls", "cd dir1", "cat file1.txt"])
+        self.assertEqual(history.previous("draft"), "cat file1.txt")
+        self.assertEqual(history.previous("cat file1.txt"), "cd dir1")
+        self.assertEqual(history.previous("cd dir1"), "ls")
+        self.assertIsNone(history.previous("ls"))
+        self.assertEqual(history.next(), "cd dir1")
+        self.assertEqual(history.next(), "cat file1.txt")
+        self.assertEqual(history.next(), "draft")
+        self.assertIsNone(history.next())
+
+    def test_reverse_search(self):
+        history = vshell.CommandHistory()
+        for command in ("cat a.txt", "ls", "cat b.txt", "cd dir"):
+            history.add(command)
+        self.assertEqual(history.search("cat"), 2)
+        self.assertEqual(history.search("cat", 2), 0)
+        self.assertIsNone(history.search("cat", 0))
+        self.assertIsNone(history.search("missing"))
+
+    def test_persisted_and_trimmed(self):
+        history = vshell.CommandHistory(self.path, max_size=3)
+        for i in range(10):
+            history.add(f"cmd {i}")
+        self.assertEqual(history.entries, ["cmd 7", "cmd 8", "cmd 9"])
+        with open(self.path, encoding='utf-8') as f:
+            self.assertLessEqual(len(f.readlines()), 6)
+        self.assertEqual(vshell.CommandHistory(self.path, max_size=3).entries, ["cmd 7", "cmd 8", "cmd 9"])
+
+    def test_rewrite_keeps_file_mode(self):
+        history = vshell.CommandHistory(self.path, max_size=2)
+        history.add("cmd 0")
+        os.chmod(self.path, 0o644)
+        for i in range(1, 6):
+            history.add(f"cmd {i}")
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o644)
+
+
+class FakeText:
+    """Текстовое поле окна без Tk: хранит текст и понимает индексы вида 'строка.столбец'"""
+
+    def __init__(self, *args, **kwargs):
+        self.text = ""
+
+    def pack(self, **kwargs):
+        pass
+
+    def configure(self, **kwargs):
+        pass
+
+    def see(self, index):
+        pass
+
+    def insert(self, index, text):
+        self.text += text
+
+    def index(self, index):
+        lines = self.text.split('\n')
+        return f"{len(lines)}.{len(lines[-1])}"
+
+    def delete(self, start, end):
+        # Удаляются строки с первой до строки end (не включая ее)
+        self.text = self.text.split('\n', int(end.split('.')[0]) - 1)[-1]
+
+
+class FakeWidget:
+    def __init__(self, *args, **kwargs):
+        self.text = ""
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+    def get(self):
+        return self.text
+
+    def delete(self, start, end=None):
+        self.text = ""
+
+
+class TestShellGUI(unittest.TestCase):
+    """Очередь команд, Ctrl+C и обрезка вывода окна с подменой tkinter"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.zip_path = os.path.join(self.temp_dir.name, "test.zip")
+        with zipfile.ZipFile(self.zip_path, 'w') as zf:
+            zf.writestr("file1.txt", "Content of file1")
+        tk = mock.MagicMock(END='end', INSERT='insert', Entry=FakeWidget, Label=FakeWidget)
+        scrolledtext = mock.MagicMock(ScrolledText=FakeText)
+        with mock.patch.dict(sys.modules, {"tkinter": tk, "tkinter.scrolledtext": scrolledtext}):
+            self.shell = VShell(self.zip_path)
+            self.gui = vshell.ShellGUI(self.shell)
+
+    def tearDown(self):
+        self.finish()
+        self.shell.close()
+        self.temp_dir.cleanup()
+
+    def finish(self):
+        """Дожидается выполнения поставленных команд и переносит их вывод в окно"""
+        if self.gui._worker.is_alive():
+            self.gui._commands.put(None)
+            self.gui._worker.join()
+        self.gui._flush_output()
+        return self.gui.output.text
+
+    def submit(self, command):
+        self.gui.entry.text = command
+        self.gui.execute_command()
+
+    def test_commands_run_in_order(self):
+        for command in ("mkdir a", "cd a", "nano b.txt text", "ls", "pwd"):
+            self.submit(command)
+        self.assertEqual(self.finish(), "/$ /$ mkdir a\nДиректория 'a' создана.\n/a$ cd a\n"
+                                        "/a$ nano b.txt text\nФайл 'b.txt' обновлен.\n"
+                                        "/a$ ls\nb.txt\n/a$ pwd\n/a\n")
+
+    def test_cancel_stops_line_output(self):
+        closed = threading.Event()
+
+        def endless(args):
+            try:
+                for i in range(10 ** 9):
+                    if i == 1:
+                        self.gui.cancel_command()
+                    yield str(i)
+            finally:
+                closed.set()
+
+        self.gui.dispatcher._handlers["endless"] = endless
+        self.submit("endless")
+        self.submit("pwd")
+        # Прерывается только выполняемая команда, следующая в очереди выполняется
+        self.assertEqual(self.finish(), "/$ /$ endless\n0\n^C\n/$ pwd\n/\n")
+        self.assertTrue(closed.is_set())
+
+    def test_scrollback_is_trimmed(self):
+        with mock.patch.object(vshell, "SCROLLBACK_LINES", 5):
+            for i in range(12):
+                self.gui._append_output(f"{i}\n")
+            text = self.finish()
+        self.assertEqual(text, "8\n9\n10\n11\n")
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.zip_path = os.path.join(self.temp_dir.name, "test.zip")
+        with zipfile.ZipFile(self.zip_path, 'w') as zf:
+            zf.writestr("dir1/file1.txt", "content")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_replay_after_crash(self):
+        shell = VShell(self.zip_path, journal=True)
+        shell.mkdir("new_dir")
+        shell.nano("new_dir/file.txt", "line1\nline2")
+        shell.mv("dir1", "new_dir/dir1")
+        shell.journal.close()  # процесс "упал" без записи архива
+
+        recovered = VShell(self.zip_path, journal=True)
+        self.assertTrue(recovered.dirty)
+        self.assertEqual(recovered.cat("/new_dir/file.txt"), "line1\nline2")
+        self.assertEqual(recovered.cat("/new_dir/dir1/file1.txt"), "content")
+        recovered.close()
+
+    def test_replay_releases_overwritten_content(self):
+        shell = VShell(self.zip_path, journal=True)
+        for i in range(50):
+            shell.nano("dir1/file1.txt", f"version {i}")
+        shell.cp("dir1/file1.txt", "copy.txt")
+        shell.cp("dir1/file1.txt", "copy.txt")
+        shell.journal.close()
+
+        recovered = VShell(self.zip_path, journal=True)
+        self.assertEqual(recovered.cat("/copy.txt"), "version 49")
+        # Живо только последнее содержимое, на которое ссылаются файл и его копия
+        self.assertEqual(len(recovered._blobs), 1)
+        recovered.close()
+
+    def test_replay_cp(self):
+        shell = VShell(self.zip_path, journal=True)
+        shell.cp("dir1", "copy", recursive=True)
+        shell.nano("copy/file1.txt", "edited")
+        shell.journal.close()
+
+        recovered = VShell(self.zip_path, journal=True)
+        self.assertEqual(recovered.cat("/copy/file1.txt"), "edited")
+        self.assertEqual(recovered.cat("/dir1/file1.txt"), "content")
+        recovered.close()
+
+    def test_replay_import(self):
+        host_dir = os.path.join(self.temp_dir.name, "host")
+        os.makedirs(os.path.join(host_dir, "sub"))
+        with open(os.path.join(host_dir, "sub", "file.txt"), 'w') as f:
+            f.write("from host")
+        shell = VShell(self.zip_path, journal=True)
+        shell.import_tree(host_dir, "imported")
+        shell.journal.close()
+
+        recovered = VShell(self.zip_path, journal=True)
+        self.assertEqual(recovered.cat("/imported/sub/file.txt"), "from host")
+        recovered.close()
+
+    def test_replay_undo(self):
+        shell = VShell(self.zip_path, journal=True)
+        snapshot = shell.snapshot()
+        shell.mkdir("new_dir")
+        shell.nano("dir1/file1.txt", "edited")
+        shell.mv("dir1", "new_dir/dir1")
+        shell.rollback(snapshot)
+        shell.nano("dir1/file1.txt", "after rollback")
+        shell.journal.close()
+
+        recovered = VShell(self.zip_path, journal=True)
+        self.assertEqual(recovered.ls(), ['dir1'])
+        self.assertEqual(recovered.cat("/dir1/file1.txt"), "after rollback")
+        recovered.close()
+
+    def test_torn_record_is_discarded(self):
+        shell = VShell(self.zip_path, journal=True)
+        shell.mkdir("a")
+        shell.mkdir("b")
+        shell.journal.close()
+        with open(self.zip_path + '.journal', 'r+b') as f:
+            f.truncate(os.path.getsize(self.zip_path + '.journal') - 3)
+
+        recovered = VShell(self.zip_path, journal=True)
+        self.assertEqual(recovered.ls(), ['a', 'dir1'])
+        recovered.mkdir("c")
+        recovered.close()
+        reopened = VShell(self.zip_path, journal=True)
+        self.assertEqual(reopened.ls(), ['a', 'c', 'dir1'])
+        reopened.close()
+
+    def test_journal_is_folded_into_archive(self):
+        shell = VShell(self.zip_path, journal=True, group_commit=4)
+        shell.mkdir("saved")
+        shell._write_to_zip()
+        shell.close()
+        with open(self.zip_path + '.journal', 'rb') as f:
+            self.assertEqual(len(f.readlines()), 1)
+        shell = VShell(self.zip_path, journal=True)
+        self.assertFalse(shell.dirty)
+        self.assertIn('saved', shell.ls())
+        shell.close()
+
+    def test_background_checkpoint(self):
+        shell = VShell(self.zip_path, journal=True, checkpoint_size=200)
+        for i in range(10):
+            shell.nano(f"file{i}.txt", "x" * 50)
+        shell.close()
+        with zipfile.ZipFile(self.zip_path) as zf:
+            self.assertIn("file0.txt", zf.namelist())
+
+
+class TestOverlay(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.base_path = os.path.join(self.temp_dir.name, "base.zip")
+        self.zip_path = os.path.join(self.temp_dir.name, "upper.zip")
+        with zipfile.ZipFile(self.base_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr("etc/app.conf", "base config")
+            zf.writestr("etc/LICENSE", "license text")
+            zf.writestr("usr/lib/data.txt", "data " * 100)
+        with zipfile.ZipFile(self.zip_path, 'w'):
+            pass
+        self.mounts = [("/base", self.base_path)]
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_layer_is_loaded_on_first_access(self):
+        shell = VShell(self.zip_path, mounts=self.mounts)
+        self.assertIsNone(shell.layers[0].zip)
+        self.assertEqual(shell.ls(), ['base'])
+        self.assertEqual(shell.cat("/base/etc/app.conf"), "base config")
+        self.assertEqual(list(shell.du("/", summarize=True)), [f"{11 + 12 + 500}\t{shell.root.packed}\t/"])
+        self.assertIn("Слой: " + self.base_path, shell.stat("/base/etc/LICENSE"))
+        shell.close()
+
+    def test_undo_move_keeps_lower_layer(self):
+        shell = VShell(self.zip_path, mounts=self.mounts, journal=True)
+        shell.mv("/base/usr", "/u")
+        shell.mv("/base/etc/LICENSE", "/base/etc/LICENSE.txt")
+        shell.undo()
+        shell.undo()
+        self.assertEqual(shell._whiteouts, set())
+        self.assertEqual(shell.cat("/base/usr/lib/data.txt"), "data " * 100)
+        shell.close()
+        # Журнал воспроизводит и отмену переноса
+        recovered = VShell(self.zip_path, mounts=self.mounts, journal=True)
+        self.assertEqual(recovered._whiteouts, set())
+        recovered._write_to_zip()
+        recovered.close()
+        with zipfile.ZipFile(self.zip_path) as zf:
+            # Сама точка монтирования - директория верхнего слоя, а нижний слой в архив не копируется
+            self.assertEqual(zf.namelist(), ["base/"])
+
+    def test_eager_load_skips_whiteout_contents(self):
+        # Сторонние инструменты пишут скрывающие элементы не обязательно последними
+        with zipfile.ZipFile(self.zip_path, 'w') as zf:
+            zf.writestr("base/etc/.wh.app.conf", "")
+            zf.writestr("notes.txt", "NOTES")
+            zf.writestr("zz.txt", "ZZ")
+        shell = VShell(self.zip_path, lazy=False, mounts=self.mounts)
+        self.assertEqual(shell.cat("/notes.txt"), "NOTES")
+        self.assertEqual(shell.cat("/zz.txt"), "ZZ")
+        shell.cd("/base/etc")
+        self.assertEqual(shell.ls(), ["LICENSE"])
+        shell.close()
+
+    def test_only_upper_layer_is_persisted(self):
+        with open(self.base_path, 'rb') as f:
+            base = f.read()
+        shell = VShell(self.zip_path, mounts=self.mounts)
+        shell.nano("/base/etc/app.conf", "session config")
+        shell.mv("/base/etc/LICENSE", "/LICENSE")
+        shell.cp("/base/usr", "/usr_copy", recursive=True)
+        shell._write_to_zip()
+        shell.close()
+        with open(self.base_path, 'rb') as f:
+            self.assertEqual(f.read(), base)
+        with zipfile.ZipFile(self.zip_path) as zf:
+            self.assertNotIn("base/usr/lib/data.txt", zf.namelist())
+            self.assertIn("base/etc/.wh.LICENSE", zf.namelist())
+
+        shell = VShell(self.zip_path, mounts=self.mounts)
+        self.assertEqual(shell.cat("/base/etc/app.conf"), "session config")
+        self.assertEqual(shell.cat("/LICENSE"), "license text")
+        self.assertEqual(shell.cat("/usr_copy/lib/data.txt"), "data " * 100)
+        self.assertEqual(list(shell.find("/", name="LICENSE")), ["/LICENSE"])
+        self.assertEqual(sorted(shell._lookup("/base/etc").children), ["app.conf"])
+        shell.close()
+
+    def test_find_exact_name_loads_layers(self):
+        shell = VShell(self.zip_path, mounts=self.mounts)
+        self.assertEqual(list(shell.find("/", name="app.conf")), ["/base/etc/app.conf"])
+        shell.close()
+        shell = VShell(self.zip_path, mounts=self.mounts)
+        shell.cp("/base/usr", "/usr_copy", recursive=True)
+        self.assertEqual(sorted(shell.find("/", name="data.txt")), ["/base/usr/lib/data.txt", "/usr_copy/lib/data.txt"])
+        shell.close()
+        shell = VShell(self.zip_path, mounts=self.mounts)
+        self.assertEqual(list(shell.find("/base/etc", name="LIC*")), ["/base/etc/LICENSE"])
+        shell.close()
+
+    def test_whiteout_names_without_layers(self):
+        with zipfile.ZipFile(self.zip_path, 'w') as zf:
+            zf.writestr(".wh.notes", "user notes")
+            zf.writestr("dir/.wh.cfg/", "")
+        for index_cache in (False, True, True):
+            shell = VShell(self.zip_path, index_cache=index_cache)
+            self.assertEqual(shell.ls(), [".wh.notes", "dir"])
+            self.assertEqual(shell.cat(".wh.notes"), "user notes")
+            self.assertTrue(shell._lookup("/dir/.wh.cfg").is_dir)
+            self.assertEqual(shell._whiteouts, set())
+            shell.close()
+
+    def test_whiteout_names_are_reserved(self):
+        shell = VShell(self.zip_path, mounts=self.mounts)
+        shell.nano("/notes", "x")
+        with self.assertRaises(ValueError):
+            shell.nano("/.wh.keep", "x")
+        with self.assertRaises(ValueError):
+            shell.mkdir("/.wh.dir")
+        with self.assertRaises(ValueError):
+            shell.mv("/notes", "/.wh.notes")
+        with self.assertRaises(ValueError):
+            shell.cp("/notes", "/base/.wh.notes")
+        host_dir = os.path.join(self.temp_dir.name, "host")
+        os.makedirs(host_dir)
+        with open(os.path.join(host_dir, ".wh.file"), 'w') as f:
+            f.write("x")
+        with self.assertRaises(ValueError):
+            shell.import_tree(host_dir, "/imported")
+        self.assertEqual(shell.ls(), ["base", "notes"])
+        shell.close()
+
+    def test_mount_point_cannot_be_moved(self):
+        shell = VShell(self.zip_path, mounts=self.mounts)
+        with self.assertRaises(OSError):
+            shell.mv("/base", "/other")
+        with self.assertRaises(FileNotFoundError):
+            VShell(self.zip_path, mounts=[("/missing", os.path.join(self.temp_dir.name, "missing.zip"))])
+        shell.close()
+
+
+class TestIndexCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.zip_path = os.path.join(self.temp_dir.name, "test.zip")
+        self.index_path = self.zip_path + '.index'
+        with zipfile.ZipFile(self.zip_path, 'w') as zf:
+            zf.writestr("file1.txt", "Content of file1")
+            zf.writestr("dir1/", "")
+            zf.writestr("dir1/file2.txt", "Content of file2", zipfile.ZIP_DEFLATED)
+            zf.writestr("dir1/subdir/file3.txt", "Content of file3")
+            zf.writestr("dir1/.wh.hidden", "")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def snapshot(self, shell):
+        """Дерево с размерами, скрытые пути, результат find и stat - все, что строится при загрузке"""
+        nodes = [(path, node.is_dir, node.size, node.packed, node.files)
+                 for path, node in sorted(shell._walk(shell.root), key=lambda item: item[0])]
+        return nodes, shell._whiteouts, sorted(shell.find("/", name="file*")), shell.stat("/dir1/file2.txt")
+
+    def test_warm_start_matches_central_directory(self):
+        with zipfile.ZipFile(self.zip_path, 'a') as zf:
+            zf.writestr("a//b.txt", "Content of b")
+        cold = VShell(self.zip_path)
+        self.assertFalse(os.path.exists(self.index_path))
+        built = VShell(self.zip_path, index_cache=True)
+        self.assertTrue(os.path.exists(self.index_path))
+        warm = VShell(self.zip_path, index_cache=True)
+        self.assertIn("index_build", warm.profiler.phases)
+        self.assertNotIn("central_directory", warm.profiler.phases)
+        self.assertEqual(self.snapshot(warm), self.snapshot(cold))
+        self.assertEqual(self.snapshot(built), self.snapshot(cold))
+        self.assertEqual(warm.cat("/dir1/file2.txt"), "Content of file2")
+        self.assertEqual(warm.tail("/dir1/subdir/file3.txt", 1), "Content of file3")
+        self.assertEqual(warm.cat("/a/b.txt"), "Content of b")
+        eager = VShell(self.zip_path, lazy=False, index_cache=True)
+        self.assertEqual(eager._lookup("/file1.txt").content, "Content of file1")
+        for shell in (cold, built, warm, eager):
+            shell.close()
+
+    def test_changed_archive_rebuilds_index(self):
+        VShell(self.zip_path, index_cache=True).close()
+        with zipfile.ZipFile(self.zip_path, 'a') as zf:
+            zf.writestr("added.txt", "new")
+        shell = VShell(self.zip_path, index_cache=True)
+        self.assertIn("central_directory", shell.profiler.phases)
+        self.assertEqual(shell.cat("/added.txt"), "new")
+        shell.close()
+        shell = VShell(self.zip_path, index_cache=True)
+        self.assertNotIn("central_directory", shell.profiler.phases)
+        self.assertIn("added.txt", shell.ls())
+        shell.close()
+
+    def test_same_size_and_mtime_checks_central_directory(self):
+        VShell(self.zip_path, index_cache=True).close()
+        stat = os.stat(self.zip_path)
+        with open(self.zip_path, 'r+b') as f:
+            data = f.read()
+            # Меняем имя файла в центральном каталоге, не меняя размер архива
+            f.seek(data.rindex(b"file1.txt"))
+            f.write(b"fileX.txt")
+        os.utime(self.zip_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        shell = VShell(self.zip_path, index_cache=True)
+        self.assertIn("central_directory", shell.profiler.phases)
+        shell.close()
+
+    def test_corrupted_index_is_ignored(self):
+        VShell(self.zip_path, index_cache=True).close()
+        with open(self.index_path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.index_path) - 5)
+        shell = VShell(self.zip_path, index_cache=True)
+        self.assertEqual(sorted(shell.ls()), ["dir1", "file1.txt"])
+        shell.close()
+        with open(self.index_path, 'wb'):
+            pass
+        shell = VShell(self.zip_path, index_cache=True)
+        self.assertEqual(shell.cat("/file1.txt"), "Content of file1")
+        shell.close()
+
+    def test_index_has_archive_mode(self):
+        os.chmod(self.zip_path, 0o644)
+        VShell(self.zip_path, index_cache=True).close()
+        self.assertEqual(os.stat(self.index_path).st_mode & 0o777, 0o644)
+
+    def test_index_follows_write_to_zip(self):
+        shell = VShell(self.zip_path, index_cache=True)
+        shell.nano("/dir1/file2.txt", "changed")
+        shell.mkdir("/new_dir")
+        shell._write_to_zip()
+        shell.close()
+        shell = VShell(self.zip_path, index_cache=True)
+        self.assertNotIn("central_directory", shell.profiler.phases)
+        self.assertEqual(shell.cat("/dir1/file2.txt"), "changed")
+        self.assertIn("new_dir", shell.ls())
+        shell.close()
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), "нужны Unix-сокеты")
+class TestShellServer(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.zip_path = os.path.join(self.temp_dir.name, "test.zip")
+        self.socket_path = os.path.join(self.temp_dir.name, "vshell.sock")
+        with zipfile.ZipFile(self.zip_path, 'w') as zf:
+            zf.writestr("file1.txt", "Content of file1")
+            zf.writestr("dir1/file2.txt", "Content of file2")
+        self.shell = VShell(self.zip_path)
+        self.server = ShellServer(self.shell)
+
+    def tearDown(self):
+        self.shell.close()
+        self.temp_dir.cleanup()
+
+    def test_sessions_have_own_directory(self):
+        first, second = Session(), Session()
+        self.server.execute(first, "cd dir1")
+        self.assertEqual(self.server.execute(first, "pwd"), "/dir1\n")
+        self.assertEqual(self.server.execute(second, "pwd"), "/\n")
+        self.assertEqual(self.shell.pwd(), "/")
+        self.server.execute(second, "nano dir1/new.txt shared")
+        self.assertEqual(self.server.execute(first, "cat new.txt"), "shared\n")
+
+    def test_checkpoint_waits_for_readers(self):
+        self.shell.close()
+        self.shell = VShell(self.zip_path, journal=True)
+        self.server = ShellServer(self.shell)
+        self.server.execute(Session(), "nano file1.txt changed")
+        with self.server.lock.read():
+            checkpoint = threading.Thread(target=self.shell.checkpoint)
+            checkpoint.start()
+            checkpoint.join(0.2)
+            # Пока читатель держит блокировку, архив не переписывается
+            self.assertTrue(checkpoint.is_alive())
+            self.assertTrue(self.shell.dirty)
+        checkpoint.join()
+        self.assertFalse(self.shell.dirty)
+        self.assertEqual(self.server.execute(Session(), "cat file1.txt"), "changed\n")
+
+    def test_clients_over_socket(self):
+        import asyncio
+
+        async def request(reader, writer, command):
+            writer.write(command.encode('utf-8') + b"\n")
+            await writer.drain()
+            return (await reader.readuntil(END_OF_REPLY))[:-len(END_OF_REPLY)].decode('utf-8')
+
+        async def client(index):
+            reader, writer = await asyncio.open_unix_connection(self.socket_path)
+            await request(reader, writer, f"mkdir session{index}")
+            await request(reader, writer, f"cd session{index}")
+            replies = [await request(reader, writer, "pwd") for _ in range(5)]
+            replies.append(await request(reader, writer, "exit"))
+            writer.close()
+            return replies
+
+        async def main():
+            server = await self.server.start(self.socket_path)
+            async with server:
+                return await asyncio.gather(*(client(i) for i in range(10)))
+
+        results = asyncio.run(main())
+        for index, replies in enumerate(results):
+            self.assertEqual(replies[:5], [f"/session{index}\n"] * 5)
+            self.assertEqual(replies[5], "Выход...\n")
+        self.assertEqual(len(self.shell.ls()), 12)
+
+    def test_exit_with_arguments_closes_only_connection(self):
+        import asyncio
+
+        async def request(reader, writer, command):
+            writer.write(command.encode('utf-8') + b"\n")
+            await writer.drain()
+            return (await reader.readuntil(END_OF_REPLY))[:-len(END_OF_REPLY)].decode('utf-8')
+
+        async def main():
+            server = await self.server.start(self.socket_path)
+            async with server:
+                first = await asyncio.open_unix_connection(self.socket_path)
+                second = await asyncio.open_unix_connection(self.socket_path)
+                replies = [await request(*first, "exit now"), await request(*second, "cat file1.txt")]
+                for _, writer in (first, second):
+                    writer.close()
+                return replies
+
+        self.assertEqual(asyncio.run(main()), ["Выход...\n", "Content of file1\n"])
+        self.assertFalse(self.shell.dirty)
+
+
+class TestCommandDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.zip_path = os.path.join(self.temp_dir.name, "test.zip")
+        with zipfile.ZipFile(self.zip_path, 'w') as zf:
+            zf.writestr("file1.txt", "Content of file1")
+            zf.writestr("dir1/file2.txt", "Content of file2")
+        self.shell = VShell(self.zip_path)
+        self.dispatcher = CommandDispatcher(self.shell)
+
+    def tearDown(self):
+        self.shell.close()
+        self.temp_dir.cleanup()
+
+    def test_execute_commands(self):
+        self.assertEqual(self.dispatcher.execute("ls"), "dir1\nfile1.txt")
+        self.assertEqual(self.dispatcher.execute("cd dir1"), "")
+        self.assertEqual(self.dispatcher.execute("pwd"), "/dir1")
+        self.assertEqual(self.dispatcher.execute("cat file2.txt"), "Content of file2")
+        self.assertEqual(list(self.dispatcher.execute("tree")), ["/dir1", "└── file2.txt"])
+
+    def test_errors_are_reported(self):
+        self.assertEqual(self.dispatcher.execute("foo"), "Команда 'foo' не найдена.")
+        self.assertEqual(self.dispatcher.execute("cd"), "cd: отсутствует аргумент.")
+        self.assertTrue(self.dispatcher.execute("cd nowhere").startswith("Ошибка при выполнении команды"))
+        # Ленивые команды сообщают об ошибке в аргументах так же, как остальные
+        self.assertTrue(self.dispatcher.execute("du /missing").startswith("Ошибка при выполнении команды"))
+
+    def test_lazy_command_latency_covers_consumption(self):
+        commands = self.shell.profiler.commands
+        result = self.dispatcher.execute("tree")
+        self.assertNotIn("tree", commands)
+        self.assertEqual(list(result), ["/", "├── dir1", "│   └── file2.txt", "└── file1.txt"])
+        self.assertEqual(commands["tree"]["count"], 1)
+        result = self.dispatcher.execute("find / -name *.txt")
+        next(result)
+        result.close()
+        self.assertEqual(commands["find"]["count"], 1)
+
+    def test_run_batch(self):
+        script = io.StringIO("# комментарий\nmkdir new_dir\n\ncd new_dir\nnano a.txt hello world\ncat a.txt\nexit\nls\n")
+        output = io.StringIO()
+        self.assertEqual(run_batch(self.dispatcher, script, output), 5)
+        self.assertTrue(self.dispatcher.exit_requested)
+        self.assertIn("hello world\nВыход...\n", output.getvalue())
+        with zipfile.ZipFile(self.zip_path) as zf:
+            self.assertEqual(zf.read("new_dir/a.txt"), b"hello world")
+
+    def test_import_does_not_load_tkinter(self):
+        code = "import sys, vshell; print('tkinter' in sys.modules)"
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+        self.assertEqual(result.stdout.strip(), "False")
+
+
 if __name__ == '__main__':
     unittest.main()
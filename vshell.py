@@ -1,67 +1,1618 @@
 import os
+import io
+import sys
+import codecs
+import json
+import zlib
 import zipfile
+import functools
+import gc
+import logging
+import time
+import bisect
+import hashlib
+import mmap
+import contextlib
+import concurrent.futures
+import fnmatch
+import re
 import argparse
-import tkinter as tk
-from tkinter import Entry, END, WORD
-from tkinter.scrolledtext import ScrolledText
 import threading
+import queue
+import struct
+import tempfile
+import shutil
 import xml.etree.ElementTree as ET
+from collections import OrderedDict, deque
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger("vshell")
+
+# Бюджет кэша содержимого файлов по умолчанию (в байтах)
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+# Размер блока при потоковом чтении файлов
+CHUNK_SIZE = 64 * 1024
+# Размер журнала, после которого он сворачивается в архив (в байтах)
+DEFAULT_CHECKPOINT_SIZE = 4 * 1024 * 1024
+# Операции, которые записываются в журнал и воспроизводятся при восстановлении
+JOURNAL_OPERATIONS = ('mkdir', 'nano', 'mv', 'cp', '_unlink', '_move', '_demote')
+# Сколько последних изменений можно отменить командой undo (изменения после самого раннего снимка
+# хранятся независимо от этого предела)
+DEFAULT_UNDO_DEPTH = 1000
+# Команды, которые изменяют общую файловую систему; в режиме сервера они выполняются
+# под блокировкой писателя, остальные - одновременно под блокировкой читателей
+WRITE_COMMANDS = frozenset(('mkdir', 'nano', 'mv', 'cp', 'import', 'snapshot', 'rollback', 'undo'))
+# Конец ответа сервера на команду: после вывода команды идет строка из одного нулевого байта
+END_OF_REPLY = b"\0\n"
+# Префикс элемента верхнего слоя, который скрывает путь нижнего слоя (как в образах OCI)
+WHITEOUT_PREFIX = '.wh.'
+# Сигнатура и версия формата индекса-спутника архива (файл <архив>.index)
+INDEX_MAGIC = b'VSHINDEX'
+INDEX_VERSION = 3
+# Число потоков для распаковки и сжатия по умолчанию
+DEFAULT_WORKERS = min(32, os.cpu_count() or 1)
+# Файлы крупнее этого размера (в байтах) не попадают в индекс триграмм и всегда просматриваются
+TRIGRAM_MAX_FILE = 1024 * 1024
+# Сколько строк построчного вывода передается в окно за один раз
+OUTPUT_CHUNK_LINES = 500
+# Период, с которым накопленный вывод вставляется в окно, в миллисекундах
+OUTPUT_FRAME_MS = 50
+# Сколько порций вывода может ожидать вставки, прежде чем команда притормозит
+OUTPUT_QUEUE_SIZE = 256
+# Сколько последних строк хранит окно вывода
+SCROLLBACK_LINES = 10000
+# Сколько последних команд хранит история окна
+HISTORY_SIZE = 1000
+# Сколько вариантов дополнения пути выдается за одно нажатие Tab
+COMPLETION_LIMIT = 200
+
+
+class Profiler:
+    """Замеры времени фаз загрузки и гистограммы задержек команд"""
+
+    # Верхние границы корзин гистограммы задержек, в миллисекундах
+    BUCKETS = (0.1, 1, 10, 100, 1000, float('inf'))
+
+    def __init__(self):
+        self.phases = OrderedDict()
+        self.commands = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Добавляет время выполнения блока к фазе name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+
+    def add_phase(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def command(self, name):
+        """Учитывает задержку выполнения команды name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_command(name, time.perf_counter() - start)
+
+    def record_command(self, name, seconds):
+        millis = seconds * 1000
+        with self._lock:
+            stats = self.commands.get(name)
+            if stats is None:
+                stats = self.commands[name] = {"count": 0, "total": 0.0, "max": 0.0,
+                                               "histogram": [0] * len(self.BUCKETS)}
+            stats["count"] += 1
+            stats["total"] += millis
+            stats["max"] = max(stats["max"], millis)
+            stats["histogram"][bisect.bisect_left(self.BUCKETS, millis)] += 1
+
+    @staticmethod
+    def peak_memory():
+        """Пиковый объем резидентной памяти процесса в байтах (None, если недоступно)"""
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # В Linux ru_maxrss в килобайтах, в macOS - в байтах
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+    def report(self):
+        lines = ["Фазы загрузки:"]
+        for name, seconds in self.phases.items():
+            lines.append(f"  {name:<20} {seconds * 1000:10.2f} мс")
+        if self.commands:
+            labels = ["<=" + (f"{bound:g}мс" if bound != float('inf') else "inf") for bound in self.BUCKETS]
+            lines.append("Задержки команд:")
+            for name, stats in sorted(self.commands.items()):
+                histogram = " ".join(f"{label}:{count}" for label, count in zip(labels, stats["histogram"]) if count)
+                lines.append(f"  {name:<10} n={stats['count']:<6} среднее {stats['total'] / stats['count']:.3f} мс"
+                             f"  макс {stats['max']:.3f} мс  [{histogram}]")
+        peak = self.peak_memory()
+        if peak is not None:
+            lines.append(f"Пиковая память: {peak / (1024 * 1024):.1f} МБ")
+        return "\n".join(lines)
+
+
+def synchronized(method):
+    """Выполняет метод VShell под блокировкой оболочки"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class LRUCache:
+    """Кэш содержимого файлов с вытеснением давно не использованных записей по бюджету в байтах"""
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        """Добавляет запись; значения больше всего бюджета не кэшируются"""
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+
+    def discard(self, key):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class BlobStore:
+    """Содержимое файлов в памяти, адресуемое хешем: одинаковое содержимое хранится один раз.
+
+    Узлы держат общую строку и ее хеш; счетчик ссылок освобождает строку, когда
+    на нее не ссылается ни один узел."""
+
+    def __init__(self):
+        # хеш -> [содержимое, число ссылок]
+        self._blobs = {}
+        self.bytes = 0
+
+    @staticmethod
+    def digest(content):
+        return hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
+
+    def acquire(self, content, digest=None):
+        """Добавляет ссылку на содержимое; возвращает хеш и общую строку с таким содержимым"""
+        if digest is None:
+            digest = self.digest(content)
+        blob = self._blobs.get(digest)
+        if blob is None:
+            blob = self._blobs[digest] = [content, 0]
+            self.bytes += len(content)
+        blob[1] += 1
+        return digest, blob[0]
+
+    def share(self, digest):
+        """Добавляет еще одну ссылку на уже хранящееся содержимое"""
+        self._blobs[digest][1] += 1
+
+    def release(self, digest):
+        blob = self._blobs[digest]
+        blob[1] -= 1
+        if not blob[1]:
+            del self._blobs[digest]
+            self.bytes -= len(blob[0])
+
+    def refs(self, digest):
+        blob = self._blobs.get(digest)
+        return blob[1] if blob is not None else 0
+
+    def __len__(self):
+        return len(self._blobs)
+
+
+class Journal:
+    """Журнал операций (write-ahead log), который хранится рядом с архивом.
+
+    Первая строка - заголовок со штампом архива (размер и время изменения), к которому
+    относятся записи. Каждая запись - строка "<crc32> <json>"; оборванный при сбое хвост
+    отбрасывается при восстановлении. fsync выполняется раз в group_commit записей."""
+
+    HEADER = b'# vshell-journal 1'
+
+    def __init__(self, path, group_commit=1):
+        self.path = path
+        self.group_commit = max(1, group_commit)
+        self._file = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def recover(self, stamp):
+        """Возвращает записи, относящиеся к архиву stamp, и открывает журнал для дозаписи.
+
+        Журнал от другой версии архива (например, уже свернутый в него) сбрасывается."""
+        records = []
+        valid_length = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                header = f.readline()
+                if header == self._header(stamp):
+                    valid_length = len(header)
+                    for line in f:
+                        record = self._decode_record(line)
+                        if record is None:
+                            break
+                        records.append(record)
+                        valid_length += len(line)
+        if not valid_length:
+            self.reset(stamp)
+            return records
+        self._file = open(self.path, 'r+b')
+        self._file.truncate(valid_length)
+        self._file.seek(valid_length)
+        return records
+
+    def append(self, record):
+        """Дописывает запись; на диск она гарантированно попадает при групповом fsync"""
+        self.extend([record])
+
+    def extend(self, records):
+        """Дописывает записи одной командой: fsync выполняется не чаще одного раза"""
+        lines = []
+        for record in records:
+            payload = json.dumps(record, ensure_ascii=False).encode('utf-8')
+            lines.append(b'%08x %s\n' % (zlib.crc32(payload), payload))
+        with self._lock:
+            self._file.writelines(lines)
+            self._pending += len(lines)
+            if self._pending >= self.group_commit:
+                self._sync()
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        if self._pending:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._pending = 0
+
+    def reset(self, stamp):
+        """Очищает журнал после того, как его записи попали в архив со штампом stamp"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            self._file = open(self.path, 'w+b')
+            self._file.write(self._header(stamp))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._pending = 0
+
+    @property
+    def size(self):
+        return self._file.tell()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
+
+    def _header(self, stamp):
+        return b'%s %d %d\n' % (self.HEADER, stamp[0], stamp[1])
+
+    @staticmethod
+    def _decode_record(line):
+        """Разбирает строку журнала; None означает поврежденную или недописанную запись"""
+        if not line.endswith(b'\n') or len(line) < 10:
+            return None
+        checksum, payload = line[:8], line[9:-1]
+        try:
+            if int(checksum, 16) != zlib.crc32(payload):
+                return None
+            record = json.loads(payload.decode('utf-8'))
+        except ValueError:
+            return None
+        if not isinstance(record, list) or not record or record[0] not in JOURNAL_OPERATIONS:
+            return None
+        return record
+
+
+class NameIndex:
+    """Индекс имя -> узлы для поиска по точному имени и по префиксу имени.
+
+    Точный поиск - обращение к словарю, поиск по префиксу - бинарный поиск по
+    отсортированному списку различных имен."""
+
+    def __init__(self):
+        self._nodes = {}
+        self._sorted = []
+        self._bulk = False
+
+    @contextlib.contextmanager
+    def bulk(self):
+        """Массовое добавление: список имен сортируется один раз в конце"""
+        self._bulk = True
+        try:
+            yield
+        finally:
+            self._bulk = False
+            self._sorted = sorted(self._nodes)
+
+    def add(self, node):
+        nodes = self._nodes.get(node.name)
+        if nodes is None:
+            self._nodes[node.name] = {node}
+            if not self._bulk:
+                bisect.insort(self._sorted, node.name)
+        else:
+            nodes.add(node)
+
+    def remove(self, node):
+        nodes = self._nodes.get(node.name)
+        if nodes is None:
+            return
+        nodes.discard(node)
+        if not nodes:
+            del self._nodes[node.name]
+            if not self._bulk:
+                del self._sorted[bisect.bisect_left(self._sorted, node.name)]
+
+    def exact(self, name):
+        return list(self._nodes.get(name, ()))
+
+    def prefix(self, prefix):
+        """Отдает узлы, имена которых начинаются с prefix"""
+        names = self._sorted
+        index = bisect.bisect_left(names, prefix)
+        while index < len(names) and names[index].startswith(prefix):
+            yield from list(self._nodes[names[index]])
+            index += 1
+
+    def __len__(self):
+        return len(self._nodes)
+
+
+class TrigramIndex:
+    """Инвертированный индекс триграмма -> файлы для поиска литералов командой grep.
+
+    Файл попадает в индекс, когда grep просмотрел его целиком, и обновляется, когда nano
+    переписывает его. Файл из индекса, в котором нет хотя бы одной триграммы литерала,
+    при поиске пропускается без чтения; файлы вне индекса просматриваются как обычно."""
+
+    def __init__(self):
+        self._postings = {}
+        self._files = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def trigrams(lines):
+        result = set()
+        for line in lines:
+            result.update(line[i:i + 3] for i in range(len(line) - 2))
+        return result
+
+    def update(self, node, trigrams):
+        with self._lock:
+            self._remove(node)
+            self._files[node] = trigrams
+            for trigram in trigrams:
+                self._postings.setdefault(trigram, set()).add(node)
+
+    def remove(self, node):
+        with self._lock:
+            self._remove(node)
+
+    def _remove(self, node):
+        for trigram in self._files.pop(node, ()):
+            nodes = self._postings[trigram]
+            nodes.discard(node)
+            if not nodes:
+                del self._postings[trigram]
+
+    def candidates(self, literal):
+        """Возвращает функцию, которая говорит, может ли файл содержать литерал"""
+        trigrams = self.trigrams([literal])
+        with self._lock:
+            if not trigrams:
+                return lambda node: True
+            postings = [self._postings.get(trigram, set()) for trigram in trigrams]
+            matching = set.intersection(*sorted(postings, key=len))
+            indexed = set(self._files)
+        return lambda node: node in matching or node not in indexed
+
+    def __len__(self):
+        return len(self._files)
+
+
+def member_data_offset(src, info):
+    """Возвращает смещение данных элемента в файле архива src, пропуская локальный заголовок"""
+    src.seek(info.header_offset)
+    header = src.read(zipfile.sizeFileHeader)
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    return info.header_offset + zipfile.sizeFileHeader + name_length + extra_length
+
+
+def member_path(filename):
+    """Абсолютный путь узла для имени элемента архива: пустые компоненты отбрасываются, как в VShell._split"""
+    return '/' + '/'.join(part for part in filename.replace('\\', '/').split('/') if part)
+
+
+def central_directory_digest(f):
+    """Возвращает хеш центрального каталога архива, открытого в двоичном режиме"""
+    # Расположение каталога определяется так же, как в ZipFile._RealGetContents
+    endrec = zipfile._EndRecData(f)
+    if not endrec:
+        raise zipfile.BadZipFile("File is not a zip file")
+    size_cd = endrec[zipfile._ECD_SIZE]
+    start = endrec[zipfile._ECD_LOCATION] - size_cd
+    if endrec[zipfile._ECD_SIGNATURE] == zipfile.stringEndArchive64:
+        start -= zipfile.sizeEndCentDir64 + zipfile.sizeEndCentDir64Locator
+    f.seek(start)
+    digest = hashlib.blake2b(digest_size=16)
+    remaining = size_cd
+    while remaining > 0:
+        chunk = f.read(min(remaining, CHUNK_SIZE))
+        if not chunk:
+            break
+        digest.update(chunk)
+        remaining -= len(chunk)
+    return digest.digest()
+
+
+class IndexCache:
+    """Индекс-спутник архива: заранее разобранная структура директорий, размеры и смещения элементов.
+
+    Индекс действителен, пока у архива те же размер, время изменения и хеш центрального
+    каталога; тогда дерево строится по нему без разбора центрального каталога и нормализации
+    путей. Файл состоит из заголовка, массива записей фиксированной длины (номер родительской
+    директории, вид узла, поля элемента архива) и имен, разделенных нулевым байтом: у директории
+    имя, у файла имя и имя элемента в архиве, у элемента с префиксом WHITEOUT_PREFIX - путь и
+    имя элемента в архиве (скрывающим элементом он считается, только если смонтированы слои)."""
+    HEADER = struct.Struct('<8sIQq16sQQ')
+    RECORD = struct.Struct('<IBBHHHHIIQQQ')
+    FILE, DIRECTORY, WHITEOUT = range(3)
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, zip_path):
+        """Возвращает пару (записи, имена), если индекс есть и соответствует архиву, иначе None"""
+        try:
+            with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                magic, version, size, mtime, digest, count, names_length = self.HEADER.unpack_from(data)
+                stat = os.stat(zip_path)
+                if (magic, version, size, mtime) != (INDEX_MAGIC, INDEX_VERSION, stat.st_size, stat.st_mtime_ns):
+                    logger.info("Индекс архива устарел и будет построен заново.")
+                    return None
+                with open(zip_path, 'rb') as src:
+                    if central_directory_digest(src) != digest:
+                        logger.info("Центральный каталог архива изменился, индекс будет построен заново.")
+                        return None
+                start = self.HEADER.size
+                end = start + count * self.RECORD.size
+                if end + names_length != len(data):
+                    raise ValueError("неверная длина файла")
+                with memoryview(data) as view:
+                    records = list(self.RECORD.iter_unpack(view[start:end]))
+                    names = str(view[end:], 'utf-8').split('\0')
+                return records, names
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, struct.error, zipfile.BadZipFile) as e:
+            logger.warning("Индекс архива '%s' не прочитан: %s", self.path, e)
+            return None
+
+    def save(self, zip_path, infos):
+        """Записывает индекс для архива zip_path по списку его элементов infos.
+
+        Записи идут в том же порядке, в котором их создает загрузка из центрального каталога:
+        недостающие родительские директории перед файлом."""
+        directories = {'': 0}
+        records = []
+        names = []
+
+        def directory(path):
+            index = directories.get(path)
+            if index is None:
+                parent_path, name = path.rsplit('/', 1)
+                parent = directory(parent_path)
+                index = directories[path] = len(directories)
+                records.append(self.RECORD.pack(parent, self.DIRECTORY, *[0] * 10))
+                names.append(name)
+            return index
+
+        for info in infos:
+            path = member_path(info.filename)
+            parent_path, name = path.rsplit('/', 1)
+            if name.startswith(WHITEOUT_PREFIX):
+                records.append(self.RECORD.pack(0, self.WHITEOUT, *self._fields(info)))
+                names.extend((path, info.orig_filename))
+            elif info.is_dir():
+                directory(path if path != '/' else '')
+            else:
+                records.append(self.RECORD.pack(directory(parent_path), self.FILE, *self._fields(info)))
+                names.extend((name, info.orig_filename))
+        if any('\0' in name for name in names):
+            logger.info("Индекс архива не записан: в именах элементов есть нулевой байт.")
+            return
+        names_data = '\0'.join(names).encode('utf-8')
+        directory_path = os.path.dirname(os.path.abspath(self.path))
+        try:
+            with open(zip_path, 'rb') as src:
+                stat = os.fstat(src.fileno())
+                digest = central_directory_digest(src)
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory_path)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(self.HEADER.pack(INDEX_MAGIC, INDEX_VERSION, stat.st_size, stat.st_mtime_ns,
+                                             digest, len(records), len(names_data)))
+                    f.write(b''.join(records))
+                    f.write(names_data)
+                # Индекс доступен на чтение тем же, кому доступен архив
+                shutil.copymode(zip_path, tmp_path)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        except OSError as e:
+            logger.warning("Индекс архива '%s' не записан: %s", self.path, e)
+
+    @staticmethod
+    def _fields(info):
+        """Поля записи индекса после номера родителя и вида узла"""
+        year, month, day, hour, minute, second = info.date_time
+        return (info.create_system, info.compress_type, info.flag_bits,
+                (year - 1980) << 9 | month << 5 | day, hour << 11 | minute << 5 | second // 2,
+                info.CRC, info.external_attr, info.header_offset, info.compress_size, info.file_size)
+
+    @staticmethod
+    def member(record, filename):
+        """Восстанавливает описание элемента архива по записи индекса"""
+        _, _, create_system, compress_type, flag_bits, date, time_, crc, external_attr, \
+            header_offset, compress_size, file_size = record
+        info = zipfile.ZipInfo(filename, ((date >> 9) + 1980, (date >> 5) & 0xF, date & 0x1F,
+                                          time_ >> 11, (time_ >> 5) & 0x3F, (time_ & 0x1F) * 2))
+        info.create_system = create_system
+        info.compress_type = compress_type
+        info.flag_bits = flag_bits
+        info.CRC = crc
+        info.external_attr = external_attr
+        info.header_offset = header_offset
+        info.compress_size = compress_size
+        info.file_size = file_size
+        return info
+
+
+class IndexedZipFile(zipfile.ZipFile):
+    """Архив для чтения, список элементов которого взят из индекса, а не из центрального каталога"""
+
+    def __init__(self, path, infos):
+        self._indexed = infos
+        super().__init__(path, 'r')
+
+    def _RealGetContents(self):
+        self.filelist = self._indexed
+        self.NameToInfo = {info.filename: info for info in self._indexed}
+
+
+@contextlib.contextmanager
+def gc_paused():
+    """Отключает сборщик циклического мусора на время массового создания узлов: иначе он
+    многократно обходит растущее дерево, хотя циклов, которые можно освободить, в нем нет"""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class ArchiveReader:
+    """Чтение и распаковка элементов архива из нескольких потоков.
+
+    У каждого потока свой файловый дескриптор, поэтому чтение не сериализуется общей
+    блокировкой ZipFile, а zlib при распаковке отпускает GIL."""
+
+    def __init__(self, zip_ref):
+        self._zip = zip_ref
+        self._local = threading.local()
+        self._files = []
+        self._lock = threading.Lock()
+
+    def _file(self):
+        f = getattr(self._local, 'file', None)
+        if f is None:
+            f = self._local.file = open(self._zip.filename, 'rb')
+            with self._lock:
+                self._files.append(f)
+        return f
+
+    def read(self, info):
+        """Возвращает распакованное содержимое элемента с проверкой CRC"""
+        if info.flag_bits & 0x1 or info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            # Шифрование и прочие методы сжатия оставляем стандартной реализации
+            return self._zip.read(info)
+        f = self._file()
+        f.seek(member_data_offset(f, info))
+        data = f.read(info.compress_size)
+        if info.compress_type == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -zlib.MAX_WBITS)
+        if zlib.crc32(data) != info.CRC:
+            raise zipfile.BadZipFile(f"Неверная контрольная сумма элемента '{info.filename}'.")
+        return data
+
+    def close(self):
+        with self._lock:
+            for f in self._files:
+                f.close()
+            self._files.clear()
+
+
+def deflate(data, level=zlib.Z_DEFAULT_COMPRESSION):
+    """Сжимает данные так же, как ZipFile для ZIP_DEFLATED; возвращает (сжатые данные, crc32, размер)"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(), zlib.crc32(data), len(data)
+
+
+class RangeReader(io.RawIOBase):
+    """Файловый объект над участком файла архива; дает настоящий seek для несжатых (ZIP_STORED) элементов"""
+
+    def __init__(self, path, start, size):
+        self._file = open(path, 'rb')
+        self._start = start
+        self._size = size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self._size
+        self._pos = min(max(offset, 0), self._size)
+        return self._pos
+
+    def read(self, size=-1):
+        remaining = self._size - self._pos
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        self._file.seek(self._start + self._pos)
+        data = self._file.read(size)
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def format_size(size):
+    """Переводит размер в байтах в короткую запись с единицами измерения (1.5K, 20M)"""
+    for unit in ('', 'K', 'M', 'G', 'T'):
+        if size < 1024 or unit == 'T':
+            return f"{size}" if not unit else f"{size:.1f}{unit}"
+        size /= 1024
+
+
+class Node:
+    """Узел дерева виртуальной файловой системы (файл или директория)"""
+    __slots__ = ('name', 'parent', 'children', 'content', 'member', 'digest', 'size', 'packed', 'files', 'layer',
+                 'listing')
+
+    def __init__(self, name, parent=None, is_dir=False, content=None, member=None, digest=None, layer=None):
+        self.name = name
+        self.parent = parent
+        # У директории есть словарь дочерних узлов, у файла - содержимое
+        self.children = {} if is_dir else None
+        # content задан, если содержимое находится в памяти (изменено или загружено сразу);
+        # иначе файл читается из элемента архива member по первому обращению
+        self.content = content
+        self.member = member
+        # Хеш содержимого в хранилище BlobStore, если content задан
+        self.digest = digest
+        # Нижний слой (Layer), из архива которого взят узел; None - верхний слой
+        self.layer = layer
+        # Размер и сжатый размер файла по центральному каталогу и число файлов;
+        # у директории - суммы по всему поддереву, которые поддерживает VShell
+        self.size = self.packed = 0
+        self.files = 0 if is_dir else 1
+        # Отсортированные имена детей директории; строятся при первом ls или дополнении
+        # и поддерживаются VShell при добавлении и удалении узлов
+        self.listing = None
+        if member is not None:
+            self.size, self.packed = member.file_size, member.compress_size
+
+    @property
+    def is_dir(self):
+        return self.children is not None
+
+    def path(self):
+        """Возвращает абсолютный путь узла, поднимаясь по ссылкам на родителя"""
+        parts = []
+        node = self
+        while node.parent is not None:
+            parts.append(node.name)
+            node = node.parent
+        return '/' + '/'.join(reversed(parts))
+
+
+class Layer:
+    """Нижний слой: архив только для чтения, смонтированный в директорию mount_point"""
+
+    def __init__(self, path, mount_point):
+        self.path = path
+        self.mount_point = mount_point
+        self.zip = None
+
+    def close(self):
+        if self.zip is not None:
+            self.zip.close()
+            self.zip = None
+
+
+class MountNode(Node):
+    """Точка монтирования нижнего слоя.
+
+    Центральный каталог архива слоя читается при первом обращении к детям точки
+    монтирования, поэтому смонтированный образ не замедляет запуск."""
+    __slots__ = ('mount', 'pending')
+
+    def __init__(self, name, parent, layer, loader):
+        super().__init__(name, parent, is_dir=True)
+        self.mount = layer
+        # Функция, которая подгружает слой; None, когда слой уже подгружен
+        self.pending = loader
+
+    @property
+    def is_dir(self):
+        return True
+
+    @property
+    def children(self):
+        if self.pending is not None:
+            self.pending(self)
+        return Node.children.__get__(self)
+
+    @children.setter
+    def children(self, value):
+        Node.children.__set__(self, value)
+
 
 class VShell:
-    def __init__(self, zip_path):
+    def __init__(self, zip_path, lazy=True, cache_size=DEFAULT_CACHE_SIZE,
+                 journal=False, group_commit=1, checkpoint_size=DEFAULT_CHECKPOINT_SIZE,
+                 workers=DEFAULT_WORKERS, grep_index=False, mounts=(), index_cache=False):
         self.zip_path = zip_path
-        self.current_directory = '/'
-        self.filesystem = {}
+        self.lazy = lazy
+        self.workers = max(1, workers)
+        # Текущая директория общая, если к потоку не привязан сеанс (см. session)
+        self._local = threading.local()
+        self._current_directory = '/'
+        self.root = Node('', is_dir=True)
+        # Индекс имен для find; поддерживается при создании, перемещении и замене узлов
+        self._names = NameIndex()
+        # Суммарные размеры директорий поддерживаются по пути к корню после загрузки
+        self._sizes_ready = False
+        # Необязательный индекс триграмм для grep; строится по мере поиска
+        self._trigrams = TrigramIndex() if grep_index else None
+        self._zip = None
+        # Индекс-спутник рядом с архивом, по которому дерево строится без разбора центрального каталога
+        self._index = IndexCache(zip_path + '.index') if index_cache else None
+        self._cache = LRUCache(cache_size)
+        # Содержимое в памяти хранится один раз на хеш; копии файлов ссылаются на него
+        self._blobs = BlobStore()
+        self._lock = threading.RLock()
+        # Есть ли изменения, которые еще не записаны в архив
+        self.dirty = False
+        self.journal = None
+        self.checkpoint_size = checkpoint_size
+        self._replaying = False
+        self._checkpoint_thread = None
+        # Блокировка, под которой фоновое сворачивание журнала исключает выполнение команд;
+        # ShellServer подставляет свою блокировку записи, чтобы архив не менялся под читателями
+        self.exclusive = contextlib.nullcontext
+        # Журнал отмены: по кадру обратных действий на каждую изменяющую команду. Снимок - это
+        # позиция в журнале; _history_start - абсолютный номер первого хранящегося кадра
+        self._history = deque()
+        self._history_start = 0
+        self._snapshots = {}
+        self._next_snapshot = 1
+        self.undo_depth = DEFAULT_UNDO_DEPTH
+        self.profiler = Profiler()
+        # Нижние слои только для чтения; архив zip_path - верхний слой, в который пишутся изменения.
+        # Пути, скрытые в нижних слоях (whiteout), и файлы нижних слоев, перенесенные в верхний
+        # командами mv и cp, сохраняются вместе с верхним слоем
+        self.layers = []
+        self._whiteouts = set()
+        self._promoted = set()
+        for mount_point, archive_path in mounts:
+            self._mount(mount_point, archive_path)
         self._load_from_zip()
-        print("yt yt Файловая система успешно загружена.")
+        if journal:
+            with self.profiler.phase("journal_replay"):
+                self._open_journal(group_commit)
+        logger.info("Файловая система успешно загружена.")
+
+    @property
+    def filesystem(self):
+        """Содержимое корневой директории: имя -> узел"""
+        return self.root.children
+
+    @property
+    def current_directory(self):
+        session = getattr(self._local, 'session', None)
+        return session.cwd if session is not None else self._current_directory
+
+    @current_directory.setter
+    def current_directory(self, path):
+        session = getattr(self._local, 'session', None)
+        if session is not None:
+            session.cwd = path
+        else:
+            self._current_directory = path
+
+    @contextlib.contextmanager
+    def session(self, session):
+        """Привязывает к текущему потоку сеанс со своей текущей директорией"""
+        previous = getattr(self._local, 'session', None)
+        self._local.session = session
+        try:
+            yield session
+        finally:
+            self._local.session = previous
 
     def _load_from_zip(self):
         if not os.path.exists(self.zip_path):
             raise FileNotFoundError(f"ZIP-файл '{self.zip_path}' не найден. Пожалуйста, укажите существующий ZIP-файл.")
 
-        with zipfile.ZipFile(self.zip_path, 'r') as zip_ref:
-            for file_info in zip_ref.infolist():
-                path = '/' + file_info.filename.replace('\\', '/').strip('/')
-                if file_info.is_dir():
+        cached = None
+        if self._index is not None:
+            with self.profiler.phase("index_load"):
+                cached = self._index.load(self.zip_path)
+        if cached is not None:
+            self._load_from_index(*cached)
+            return
+
+        # Архив остается открытым: в ленивом режиме содержимое читается из него по требованию,
+        # а при загрузке читается только центральный каталог
+        with self.profiler.phase("central_directory"):
+            self._zip = zipfile.ZipFile(self.zip_path, 'r')
+        infos = self._zip.infolist()
+        with self.profiler.phase("decode"):
+            # Скрывающие элементы слоев не распаковываются: содержимого у них нет
+            contents = iter(self._read_members([info for info in infos
+                                                if not info.is_dir() and not self._is_whiteout(info)])
+                            if not self.lazy else ())
+        with self.profiler.phase("index_build"), self._names.bulk(), gc_paused():
+            for file_info in infos:
+                path = member_path(file_info.filename)
+                parent_path, name = path.rsplit('/', 1)
+                if self._is_whiteout(file_info):
+                    self._whiteouts.add(f"{parent_path}/{name[len(WHITEOUT_PREFIX):]}")
+                elif file_info.is_dir():
                     self._create_directory(path)
+                elif self.lazy:
+                    self._create_file(path, None, member=file_info)
                 else:
-                    # Попытка декодировать содержимое как UTF-8. Если не удается, сохраняем в байтах.
-                    try:
-                        content = zip_ref.read(file_info.filename).decode('utf-8')
-                    except UnicodeDecodeError:
-                        content = zip_ref.read(file_info.filename).decode('utf-8', errors='ignore')
-                    self._create_file(path, content)
+                    self._create_file(path, *next(contents), member=file_info)
+            self._compute_sizes()
+        if self._index is not None:
+            with self.profiler.phase("index_save"):
+                self._index.save(self.zip_path, infos)
+        self._log_loaded()
+
+    def _is_whiteout(self, info):
+        """Скрывает ли элемент верхнего архива путь нижнего слоя (только когда слои подключены)"""
+        if not self.layers:
+            return False
+        return member_path(info.filename).rsplit('/', 1)[-1].startswith(WHITEOUT_PREFIX)
+
+    def _load_from_index(self, records, names):
+        """Строит дерево по записям индекса-спутника: родитель каждой записи уже создан,
+        поэтому пути не разбираются и не ищутся от корня"""
+        directories = [self.root]
+        files = []
+        names = iter(names)
+        with self.profiler.phase("index_build"), self._names.bulk(), gc_paused():
+            for record in records:
+                kind = record[1]
+                if kind == IndexCache.WHITEOUT:
+                    path, filename = next(names), next(names)
+                    parent_path, name = path.rsplit('/', 1)
+                    if self.layers:
+                        self._whiteouts.add(f"{parent_path}/{name[len(WHITEOUT_PREFIX):]}")
+                    elif filename.endswith('/'):
+                        self._create_directory(path)
+                    else:
+                        # Без слоев это обычный файл пользователя; такие записи редки, поэтому
+                        # путь разбирается как при загрузке из центрального каталога
+                        self._create_file(path, None, member=IndexCache.member(record, filename))
+                        files.append(self._lookup(path))
+                    continue
+                parent = directories[record[0]]
+                name = next(names)
+                existing = parent.children.get(name)
+                if kind == IndexCache.DIRECTORY:
+                    if existing is None:
+                        existing = self._attach(parent, Node(name, parent, is_dir=True))
+                    directories.append(existing)
+                    continue
+                if existing is not None:
+                    if existing.is_dir:
+                        raise IsADirectoryError(f"'{existing.path()}' является директорией.")
+                    self._remove(existing)
+                files.append(self._attach(parent, Node(name, parent, member=IndexCache.member(record, next(names)))))
+            self._compute_sizes()
+        infos = [node.member for node in files]
+        self._zip = IndexedZipFile(self.zip_path, infos)
+        if not self.lazy:
+            with self.profiler.phase("decode"):
+                for node, (content, digest) in zip(files, self._read_members(infos)):
+                    if node.parent.children.get(node.name) is node:
+                        node.digest, node.content = self._blobs.acquire(content, digest)
+        self._log_loaded()
+
+    def _log_loaded(self):
         if not self.filesystem:
-            print("В ZIP-файле нет файловой системы.")
-        else:
-            print("Файловая система загружена:")
-            for path in sorted(self.filesystem.keys()):
-                print(f" - {path}")
+            logger.info("В ZIP-файле нет файловой системы.")
+        elif logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Файловая система загружена:")
+            for path, node in sorted(self._walk(self.root)):
+                logger.debug(" - %s%s", path, '/' if node.is_dir else '')
 
+    def _compute_sizes(self, start=None):
+        """Считает суммарные размеры всех директорий поддерева одним проходом снизу вверх"""
+        order = []
+        stack = [start or self.root]
+        while stack:
+            directory = stack.pop()
+            order.append(directory)
+            stack.extend(child for child in directory.children.values() if child.is_dir)
+        for directory in reversed(order):
+            children = directory.children.values()
+            directory.size = sum(child.size for child in children)
+            directory.packed = sum(child.packed for child in children)
+            directory.files = sum(child.files for child in children)
+        self._sizes_ready = True
+
+    def _mount(self, mount_point, archive_path):
+        """Монтирует архив только для чтения в директорию mount_point; записи слоя подгружаются позже"""
+        if not os.path.exists(archive_path):
+            raise FileNotFoundError(f"ZIP-файл '{archive_path}' не найден.")
+        parts = self._split(mount_point)
+        if not parts:
+            raise ValueError("Нижний слой нельзя смонтировать в корень.")
+        mount_point = '/' + '/'.join(parts)
+        parent = self._create_directory('/' + '/'.join(parts[:-1]))
+        if parts[-1] in parent.children:
+            raise FileExistsError(f"Точка монтирования уже занята: {mount_point}")
+        layer = Layer(archive_path, mount_point)
+        self.layers.append(layer)
+        self._attach(parent, MountNode(parts[-1], parent, layer, self._load_layer))
+
+    def _load_layer(self, mount):
+        """Читает центральный каталог нижнего слоя и сливает его записи с деревом под точкой монтирования.
+
+        Узлы верхнего слоя и пути под whiteout закрывают записи нижнего."""
+        with self._lock:
+            # Во время загрузки дерева и слияния слоя точка монтирования отдает детей как есть
+            if mount.pending is None or not self._sizes_ready:
+                return
+            layer = mount.mount
+            size, packed, files = mount.size, mount.packed, mount.files
+            self._sizes_ready = False
+            try:
+                with self.profiler.phase("mount"):
+                    layer.zip = zipfile.ZipFile(layer.path, 'r')
+                    with self._names.bulk():
+                        for info in layer.zip.infolist():
+                            self._add_lower(mount, layer, info)
+            finally:
+                mount.pending = None
+                self._compute_sizes(mount)
+            self._propagate(mount.parent, mount.size - size, mount.packed - packed, mount.files - files)
+            logger.info("Смонтирован слой '%s' в %s.", layer.path, layer.mount_point)
+
+    def _add_lower(self, mount, layer, info):
+        """Добавляет запись нижнего слоя, если ее путь не занят верхним слоем и не скрыт"""
+        relative = info.filename.replace('\\', '/').strip('/')
+        if not relative:
+            return
+        if self._whiteouts and self._whited_out(f"{layer.mount_point}/{relative}"):
+            return
+        parts = relative.split('/')
+        directories = parts if info.is_dir() else parts[:-1]
+        node = mount
+        for part in directories:
+            child = node.children.get(part)
+            if child is None:
+                child = self._attach(node, Node(part, node, is_dir=True, layer=layer))
+            elif not child.is_dir:
+                # Файл верхнего слоя закрывает директорию нижнего
+                return
+            node = child
+        if not info.is_dir() and parts[-1] not in node.children:
+            self._attach(node, Node(parts[-1], node, member=info, layer=layer))
+
+    def _whited_out(self, path):
+        """Скрыт ли путь или одна из его родительских директорий в нижних слоях"""
+        while path != '/':
+            if path in self._whiteouts:
+                return True
+            path = path.rsplit('/', 1)[0] or '/'
+        return False
+
+    def _load_mounts(self, path):
+        """Подгружает нижние слои, смонтированные в поддереве path"""
+        prefix = path.rstrip('/') + '/'
+        for layer in self.layers:
+            if (layer.mount_point + '/').startswith(prefix):
+                mount = self._lookup(layer.mount_point)
+                if isinstance(mount, MountNode):
+                    self._load_layer(mount)
+
+    def _read_members(self, infos):
+        """Распаковывает и декодирует элементы архива пулом потоков, заодно вычисляя хеши содержимого.
+
+        Возвращает пары (содержимое, хеш); порядок результатов совпадает с infos."""
+        reader = ArchiveReader(self._zip)
+
+        def read(info):
+            content = self._decode(reader.read(info))
+            return content, BlobStore.digest(content)
+
+        try:
+            if self.workers == 1 or len(infos) < 2:
+                return [read(info) for info in infos]
+            with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+                return list(pool.map(read, infos))
+        finally:
+            reader.close()
+
+    def _archive_stamp(self):
+        stat = os.stat(self.zip_path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def _open_journal(self, group_commit):
+        """Открывает журнал рядом с архивом и воспроизводит операции, не попавшие в архив"""
+        self.journal = Journal(self.zip_path + '.journal', group_commit)
+        records = self.journal.recover(self._archive_stamp())
+        self._replaying = True
+        try:
+            for op, *args in records:
+                getattr(self, op)(*args)
+        finally:
+            self._replaying = False
+        if records:
+            self.dirty = True
+            logger.info("Из журнала восстановлено операций: %d", len(records))
+
+    def _log(self, *record):
+        """Записывает операцию в журнал и запускает фоновое сворачивание, если журнал разросся"""
+        self._log_batch([list(record)])
+
+    def _log_batch(self, records):
+        """Записывает в журнал операции одной команды с одним fsync"""
+        if self.journal is None or self._replaying or not records:
+            return
+        self.journal.extend(records)
+        if self.journal.size >= self.checkpoint_size and self._checkpoint_thread is None:
+            self._checkpoint_thread = threading.Thread(target=self.checkpoint, daemon=True)
+            self._checkpoint_thread.start()
+
+    def checkpoint(self):
+        """Сворачивает журнал в архив"""
+        try:
+            with self.exclusive():
+                self._write_to_zip()
+        finally:
+            self._checkpoint_thread = None
+
+    @staticmethod
+    def _decode(data):
+        """Декодирует содержимое как UTF-8, отбрасывая некорректные байты"""
+        try:
+            return data.decode('utf-8')
+        except UnicodeDecodeError:
+            return data.decode('utf-8', errors='ignore')
+
+    def _read(self, node):
+        """Возвращает содержимое файла, при необходимости распаковывая его из архива"""
+        content = node.content
+        if content is not None:
+            return content
+        # Под блокировкой берется согласованная пара (содержимое, элемент) и открывается поток
+        # элемента. Открытый поток держит файл архива, даже если checkpoint его переоткроет,
+        # поэтому распаковка идет уже без блокировки
+        with self._lock:
+            content, info = self._contents(node)
+            if content is None:
+                stream = self._archive(node).open(info)
+        if content is not None:
+            return content
+        with stream:
+            content = self._decode(stream.read())
+        self._cache.put(info, content, info.file_size)
+        return content
+
+    def _contents(self, node):
+        """Возвращает пару (содержимое из памяти или кэша либо None, элемент архива) файла.
+
+        Кэш привязан к элементу архива: копии файла, сделанные cp, делят одну запись."""
+        with self._lock:
+            content, info = node.content, node.member
+        if content is None:
+            content = self._cache.get(info)
+        return content, info
+
+    def _open(self, node):
+        """Открывает файл на чтение в двоичном виде, не загружая его целиком из архива.
+
+        Возвращает пару (файловый объект, признак дешевого seek)."""
+        with self._lock:
+            return self._open_unlocked(node)
+
+    def _open_unlocked(self, node):
+        content = node.content if node.content is not None else self._cache.get(node.member)
+        if content is not None:
+            return io.BytesIO(content.encode('utf-8')), True
+        info = node.member
+        if info.compress_type == zipfile.ZIP_STORED:
+            path = node.layer.path if node.layer is not None else self.zip_path
+            return RangeReader(path, self._data_offset(info, path=path), info.file_size), True
+        return self._archive(node).open(info), False
+
+    def _archive(self, node):
+        """Архив, в котором лежит элемент файла: нижний слой узла или верхний архив"""
+        return node.layer.zip if node.layer is not None else self._zip
+
+    def _data_offset(self, info, src=None, path=None):
+        """Возвращает смещение данных элемента в файле архива, пропуская локальный заголовок"""
+        if src is None:
+            with open(path or self.zip_path, 'rb') as src:
+                return member_data_offset(src, info)
+        return member_data_offset(src, info)
+
+    def _iter_chunks(self, node, offset=0, length=None):
+        """Потоково отдает байты файла начиная с offset, не больше length байт"""
+        stream, _ = self._open(node)
+        with stream:
+            if offset:
+                stream.seek(offset)
+            remaining = length
+            while remaining is None or remaining > 0:
+                size = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+                chunk = stream.read(size)
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def _iter_lines(self, node):
+        """Потоково отдает строки файла в байтах (вместе с переводом строки)"""
+        return self._split_lines(self._iter_chunks(node))
+
+    @staticmethod
+    def _split_lines(chunks):
+        """Разбивает последовательность блоков байтов на строки (вместе с переводом строки)"""
+        tail = b''
+        for chunk in chunks:
+            lines = (tail + chunk).split(b'\n')
+            tail = lines.pop()
+            for line in lines:
+                yield line + b'\n'
+        if tail:
+            yield tail
+
+    def _file_node(self, filename):
+        node = self._lookup(self._abs_path(filename))
+        if node is None or node.is_dir:
+            raise FileNotFoundError(f"Нет такого файла: {filename}")
+        return node
+
+    def close(self):
+        """Закрывает исходный архив и журнал"""
+        if self._checkpoint_thread is not None:
+            self._checkpoint_thread.join()
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        self._close_archive()
+        for layer in self.layers:
+            layer.close()
+
+    def _close_archive(self):
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+
+    @synchronized
     def _write_to_zip(self):
-        with zipfile.ZipFile(self.zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
-            for path, content in self.filesystem.items():
-                zip_path = path.lstrip('/')
-                if path.endswith('/'):
-                    # Добавляем директорию
-                    zip_info = zipfile.ZipInfo(zip_path)
-                    zip_ref.writestr(zip_info, '')
-                else:
-                    zip_ref.writestr(zip_path, content)
-        print("Файловая система записана в ZIP-файл.")
+        if not self.dirty:
+            logger.info("Изменений нет, ZIP-файл не перезаписывается.")
+            return
+
+        # Новый архив пишется во временный файл рядом с исходным и атомарно подменяет его:
+        # сбой во время записи не портит единственную копию. Нетронутые файлы (у которых
+        # сохранилась ссылка на элемент архива) копируются в сжатом виде без распаковки,
+        # измененные сжимаются пулом потоков, а единственный писатель добавляет элементы
+        # в архив строго в порядке обхода дерева. При смонтированных нижних слоях пишется
+        # только верхний слой: измененные узлы и пути, скрытые в нижних слоях
+        directory = os.path.dirname(os.path.abspath(self.zip_path))
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        written = []
+        pool = concurrent.futures.ThreadPoolExecutor(self.workers) if self.workers > 1 else None
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file, contextlib.ExitStack() as stack:
+                # Исходные файлы архивов, из которых элементы копируются без распаковки
+                sources = {None: stack.enter_context(open(self.zip_path, 'rb'))}
+
+                def source(layer):
+                    if layer not in sources:
+                        sources[layer] = stack.enter_context(open(layer.path, 'rb'))
+                    return sources[layer]
+
+                with zipfile.ZipFile(tmp_file, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+                    # Окно ожидающих сжатия записей ограничивает объем памяти под сжатые данные
+                    window = deque()
+                    # Одинаковое содержимое сжимается один раз и записывается под каждым путем
+                    blobs = {}
+                    for path, node in self._walk_upper(self.root):
+                        compressed = None
+                        if not node.is_dir and node.member is None:
+                            compressed = blobs.get(node.digest)
+                            if compressed is None:
+                                data = node.content.encode('utf-8')
+                                compressed = pool.submit(deflate, data) if pool else deflate(data)
+                                blobs[node.digest] = compressed
+                        window.append((path.lstrip('/'), node, compressed))
+                        if len(window) > self.workers * 4:
+                            self._write_entry(zip_ref, source, written, *window.popleft())
+                    while window:
+                        self._write_entry(zip_ref, source, written, *window.popleft())
+                    for path in sorted(self._whiteouts):
+                        parent_path, name = path.rsplit('/', 1)
+                        zip_ref.writestr(f"{parent_path}/{WHITEOUT_PREFIX}{name}".lstrip('/'), '')
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            self._materialize_history()
+            self._close_archive()
+            # mkstemp создает файл с правами 0600; архив сохраняет права исходного файла
+            shutil.copymode(self.zip_path, tmp_path)
+            os.replace(tmp_path, self.zip_path)
+            self._fsync_directory(directory)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            if self._zip is None:
+                self._zip = zipfile.ZipFile(self.zip_path, 'r')
+            raise
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+        # Узлы привязываются к элементам нового архива, а содержимое из памяти
+        # переходит в ограниченный кэш как чистое
+        self._zip = zipfile.ZipFile(self.zip_path, 'r')
+        if self._index is not None:
+            self._index.save(self.zip_path, self._zip.infolist())
+        self._cache.clear()
+        for node, info in written:
+            new_info = self._zip.getinfo(info.filename)
+            # Элемент назначается до сброса содержимого: у узла всегда есть одно из двух
+            node.member = new_info
+            node.layer = None
+            if node.content is not None:
+                self._cache.put(new_info, node.content, new_info.file_size)
+                self._blobs.release(node.digest)
+                node.content = None
+                node.digest = None
+            self._promoted.discard(node)
+            self._resize(node, new_info.file_size, new_info.compress_size)
+        self.dirty = False
+        if self.journal is not None:
+            self.journal.reset(self._archive_stamp())
+        logger.info("Файловая система записана в ZIP-файл.")
+
+    @staticmethod
+    def _fsync_directory(directory):
+        """Сбрасывает на диск запись каталога, чтобы переименование пережило сбой (только POSIX)"""
+        if not hasattr(os, 'O_DIRECTORY'):
+            return
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _write_entry(self, zip_ref, source, written, zip_path, node, compressed):
+        """Добавляет в архив один узел: директорию, нетронутый или заново сжатый файл"""
+        if node.is_dir:
+            # Добавляем директорию
+            zip_ref.writestr(zipfile.ZipInfo(zip_path + '/'), '')
+        elif node.member is not None:
+            written.append((node, self._copy_member_raw(zip_ref, source(node.layer), node.member, zip_path)))
+        else:
+            data, crc, size = compressed.result() if isinstance(compressed, concurrent.futures.Future) else compressed
+            info = zipfile.ZipInfo(zip_path, time.localtime(time.time())[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o600 << 16
+            info.CRC = crc
+            info.file_size = size
+            info.compress_size = len(data)
+            written.append((node, self._append_raw(zip_ref, info, [data])))
+
+    def _copy_member_raw(self, zip_ref, src, info, arcname):
+        """Копирует элемент исходного архива в zip_ref как есть, без распаковки и повторного сжатия"""
+        new_info = zipfile.ZipInfo(arcname, info.date_time)
+        new_info.compress_type = info.compress_type
+        new_info.external_attr = info.external_attr
+        new_info.create_system = info.create_system
+        new_info.CRC = info.CRC
+        new_info.compress_size = info.compress_size
+        new_info.file_size = info.file_size
+
+        def chunks():
+            src.seek(self._data_offset(info, src))
+            remaining = info.compress_size
+            while remaining > 0:
+                chunk = src.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    raise zipfile.BadZipFile(f"Элемент '{info.filename}' обрезан.")
+                remaining -= len(chunk)
+                yield chunk
+
+        return self._append_raw(zip_ref, new_info, chunks())
+
+    @staticmethod
+    def _append_raw(zip_ref, info, chunks):
+        """Дописывает в zip_ref элемент с уже сжатыми данными и заполненными CRC и размерами"""
+        info.header_offset = zip_ref.fp.tell()
+        zip_ref.fp.write(info.FileHeader())
+        for chunk in chunks:
+            zip_ref.fp.write(chunk)
+        zip_ref.filelist.append(info)
+        zip_ref.NameToInfo[info.filename] = info
+        zip_ref.start_dir = zip_ref.fp.tell()
+        zip_ref._didModify = True
+        return info
+
+    def _walk(self, node, path=''):
+        """Обходит поддерево в глубину, возвращая пары (путь, узел) для всех потомков"""
+        for name, child in node.children.items():
+            child_path = f"{path}/{name}"
+            yield child_path, child
+            if child.is_dir:
+                yield from self._walk(child, child_path)
+
+    def _walk_upper(self, node, path=''):
+        """Обходит узлы верхнего слоя, пропуская нетронутые поддеревья нижних слоев.
+
+        Не подгруженные точки монтирования при обходе не подгружаются."""
+        for name, child in Node.children.__get__(node).items():
+            if child.layer is not None and child not in self._promoted:
+                continue
+            child_path = f"{path}/{name}"
+            yield child_path, child
+            if child.is_dir:
+                yield from self._walk_upper(child, child_path)
+
+    @staticmethod
+    def _split(path):
+        """Разбивает абсолютный путь на компоненты"""
+        return [part for part in path.split('/') if part]
+
+    def _lookup(self, abs_path):
+        """Находит узел по абсолютному пути, спускаясь по компонентам. Возвращает None, если узла нет"""
+        node = self.root
+        for part in self._split(abs_path):
+            if not node.is_dir:
+                return None
+            node = node.children.get(part)
+            if node is None:
+                return None
+        return node
+
+    def _lookup_parent(self, abs_path):
+        """Возвращает родительскую директорию и имя последнего компонента пути"""
+        parts = self._split(abs_path)
+        if not parts:
+            return None, ''
+        parent_path = '/' + '/'.join(parts[:-1])
+        parent = self._lookup(parent_path)
+        if parent is None or not parent.is_dir:
+            raise FileNotFoundError(f"Родительская директория не существует: {parent_path}")
+        return parent, parts[-1]
 
     def _create_directory(self, path):
-        """Создает директорию в файловой системе"""
-        if not path.endswith('/'):
-            path += '/'
-        if path not in self.filesystem:
-            self.filesystem[path] = {}
-            print(f"Директория создана: {path}")
-
-    def _create_file(self, path, content):
-        """Создает файл в файловой системе"""
-        self.filesystem[path] = content
-        print(f"Файл создан: {path}")
+        """Создает директорию в файловой системе вместе с недостающими родителями"""
+        node = self.root
+        current = ''
+        for part in self._split(path):
+            current += '/' + part
+            child = node.children.get(part)
+            if child is None:
+                child = self._attach(node, Node(part, node, is_dir=True))
+                logger.debug("Директория создана: %s/", current)
+            elif not child.is_dir:
+                raise NotADirectoryError(f"Не является директорией: {current}")
+            node = child
+        return node
+
+    def _create_file(self, path, content, digest=None, member=None):
+        """Создает файл в файловой системе; content, если задан, попадает в хранилище по хешу"""
+        parts = self._split(path)
+        parent = self._create_directory('/' + '/'.join(parts[:-1]))
+        existing = parent.children.get(parts[-1])
+        if existing is not None:
+            if existing.is_dir:
+                raise IsADirectoryError(f"'{path}' является директорией.")
+            self._remove(existing)
+        if content is not None:
+            digest, content = self._blobs.acquire(content, digest)
+        self._attach(parent, Node(parts[-1], parent, content=content, member=member, digest=digest))
+        logger.debug("Файл создан: %s", path)
+
+    def _attach(self, parent, node):
+        """Вешает узел в директорию parent под его именем, добавляет в индекс имен и в суммы размеров"""
+        node.parent = parent
+        parent.children[node.name] = node
+        if parent.listing is not None:
+            bisect.insort(parent.listing, node.name)
+        self._names.add(node)
+        self._propagate(parent, node.size, node.packed, node.files)
+        if parent.layer is not None and (node.layer is None or node in self._promoted):
+            self._copy_up(parent)
+        return node
+
+    @staticmethod
+    def _copy_up(directory):
+        """Переносит директории нижнего слоя на пути к корню в верхний слой, чтобы они сохранились"""
+        while directory is not None and directory.layer is not None:
+            directory.layer = None
+            directory = directory.parent
+
+    def _promote(self, node, abs_path):
+        """Готовит узел нижнего слоя к переносу с пути abs_path: старый путь скрывается в нижних
+        слоях, а файлы поддерева становятся частью верхнего слоя и сохраняются вместе с ним.
+
+        Возвращает (добавлен ли whiteout заново, файлы, ставшие частью верхнего слоя,
+        пары (директория, ее прежний слой)) - то, что нужно отмене, чтобы вернуть все как было."""
+        if not any(abs_path.startswith(layer.mount_point + '/') for layer in self.layers):
+            return False, [], []
+        added = abs_path not in self._whiteouts
+        self._whiteouts.add(abs_path)
+        files, directories = [], []
+        nodes = [node] + [child for _, child in self._walk(node)] if node.is_dir else [node]
+        for child in nodes:
+            if child.layer is None:
+                continue
+            if child.is_dir:
+                directories.append((child, child.layer))
+                child.layer = None
+            elif child not in self._promoted:
+                files.append(child)
+                self._promoted.add(child)
+        return added, files, directories
+
+    @staticmethod
+    def _layered(directory):
+        """Пары (директория, слой) на пути к корню, которые снимет _copy_up"""
+        chain = []
+        while directory is not None and directory.layer is not None:
+            chain.append((directory, directory.layer))
+            directory = directory.parent
+        return chain
+
+    def _demote(self, path, hidden, files, directories):
+        """Отменяет перенос узлов нижнего слоя в верхний: снимает whiteout пути path, если его
+        добавила отменяемая команда, и возвращает файлам и директориям их слои"""
+        if hidden:
+            self._whiteouts.discard(path)
+        for file_path in files:
+            self._promoted.discard(self._lookup(file_path))
+        layers = {layer.mount_point: layer for layer in self.layers}
+        for directory_path, mount_point in directories:
+            self._lookup(directory_path).layer = layers[mount_point]
+        self._log('_demote', path, hidden, files, directories)
+
+    def _detach(self, node):
+        """Снимает узел с родительской директории и убирает из индекса имен и сумм размеров"""
+        del node.parent.children[node.name]
+        listing = node.parent.listing
+        if listing is not None:
+            del listing[bisect.bisect_left(listing, node.name)]
+        self._names.remove(node)
+        self._propagate(node.parent, -node.size, -node.packed, -node.files)
+
+    def _propagate(self, directory, size, packed, files):
+        """Прибавляет изменение размеров к директории и всем ее предкам"""
+        if not self._sizes_ready:
+            return
+        while directory is not None:
+            directory.size += size
+            directory.packed += packed
+            directory.files += files
+            directory = directory.parent
+
+    def _resize(self, node, size, packed):
+        """Задает новые размеры файла и переносит разницу на предков"""
+        delta_size, delta_packed = size - node.size, packed - node.packed
+        if delta_size or delta_packed:
+            node.size, node.packed = size, packed
+            self._propagate(node.parent, delta_size, delta_packed, 0)
+
+    def _remove(self, node):
+        """Удаляет узел вместе с поддеревом: снимает с дерева и освобождает ссылки на содержимое"""
+        self._detach(node)
+        if node.is_dir:
+            for _, child in self._walk(node):
+                self._names.remove(child)
+                self._release(child)
+        else:
+            self._release(node)
+
+    def _release(self, node):
+        """Освобождает ссылку файла на содержимое и его запись в индексе триграмм"""
+        if node.is_dir:
+            return
+        if self._trigrams is not None:
+            self._trigrams.remove(node)
+        if node.digest is not None:
+            self._blobs.release(node.digest)
+            node.digest = None
+        self._promoted.discard(node)
+
+    @staticmethod
+    def _check_name(name):
+        """Имена с префиксом WHITEOUT_PREFIX зарезервированы: в верхнем архиве такие элементы
+        скрывают пути нижних слоев, поэтому файл пользователя с таким именем пропал бы"""
+        if name.startswith(WHITEOUT_PREFIX):
+            raise ValueError(f"Имя '{name}' зарезервировано для скрывающих элементов слоев.")
 
     def _abs_path(self, path):
         """Возвращает абсолютный путь на основе текущего местоположения"""
@@ -75,247 +1626,1547 @@ class VShell:
         return normalized if path.endswith('/') else normalized.rstrip('/')
 
     def pwd(self):
-        print(f"Текущая директория: {self.current_directory}")
         return self.current_directory
 
     def ls(self):
         """Возвращает список файлов и директорий в текущей директории"""
-        current_dir = self.current_directory.rstrip('/') + '/'
-        entries = []
-        for path in self.filesystem:
-            if path.startswith(current_dir) and path != current_dir:
-                relative_path = path[len(current_dir):]
-                if '/' not in relative_path.strip('/'):
-                    if path.endswith('/'):
-                        entries.append(relative_path + '/')
-                    else:
-                        entries.append(relative_path)
-        print(f"ls в {self.current_directory}: {entries}")
-        return sorted(entries)
+        node = self._lookup(self.current_directory)
+        return list(self._listing(node))
+
+    @staticmethod
+    def _listing(directory):
+        """Отсортированные имена детей директории: список строится при первом обращении,
+        а дальше поддерживается бинарными вставками и удалениями в _attach и _detach"""
+        if directory.listing is None:
+            directory.listing = sorted(directory.children)
+        return directory.listing
+
+    def complete(self, fragment):
+        """Возвращает варианты дополнения фрагмента пути относительно текущей директории.
+
+        Имена ищутся бинарным поиском в отсортированном списке детей одной директории,
+        поэтому время ответа не зависит от размера остальной файловой системы. К директориям
+        добавляется '/', вариантов не больше COMPLETION_LIMIT."""
+        base, _, prefix = fragment.rpartition('/')
+        base = base + '/' if '/' in fragment else ''
+        directory = self._lookup(self._abs_path(base) if base else self.current_directory)
+        if directory is None or not directory.is_dir:
+            return []
+        names = self._listing(directory)
+        children = directory.children
+        completions = []
+        index = bisect.bisect_left(names, prefix)
+        while index < len(names) and names[index].startswith(prefix) and len(completions) < COMPLETION_LIMIT:
+            child = children.get(names[index])
+            if child is not None:
+                completions.append(base + child.name + ('/' if child.is_dir else ''))
+            index += 1
+        return completions
 
     def cd(self, path):
         """Меняет текущую директорию"""
-
         abs_path = self._abs_path(path)
-        if not abs_path.endswith('/'):
-            abs_path += '/'
-        if abs_path in self.filesystem and isinstance(self.filesystem[abs_path], dict):
-            self.current_directory = abs_path
-            print(f"Текущая директория изменена на: {self.current_directory}")
-        else:
+        node = self._lookup(abs_path)
+        if node is None or not node.is_dir:
             raise FileNotFoundError(f"Нет такой директории: {path}")
+        self.current_directory = '/' + '/'.join(self._split(abs_path))
+        logger.debug("Текущая директория изменена на: %s", self.current_directory)
 
-    def cat(self, filename):
-        """не не Возвращает содержимое файла"""
-        abs_path = self._abs_path(filename)
-        if abs_path in self.filesystem and not abs_path.endswith('/'):
-            content = self.filesystem[abs_path]
-            print(f"cat {filename}:\n{content}")
-            return content
-        else:
-            raise FileNotFoundError(f"Нет такого файла: {filename}")
+    def cat(self, filename, offset=None, length=None):
+        """не не Возвращает содержимое файла; с offset/length - только указанный диапазон байт"""
+        node = self._file_node(filename)
+        if offset is None and length is None:
+            return self._read(node)
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        parts = [decoder.decode(chunk) for chunk in self._iter_chunks(node, offset or 0, length)]
+        parts.append(decoder.decode(b'', final=True))
+        return ''.join(parts)
+
+    def head(self, filename, n=10):
+        """Возвращает первые n строк файла, читая его потоково"""
+        node = self._file_node(filename)
+        lines = []
+        if n > 0:
+            for line in self._iter_lines(node):
+                lines.append(line)
+                if len(lines) >= n:
+                    break
+        return self._decode(b''.join(lines))
+
+    def tail(self, filename, n=10):
+        """Возвращает последние n строк файла.
 
+        Несжатые элементы и содержимое в памяти читаются блоками с конца,
+        сжатые - одним потоковым проходом с хранением только n последних строк."""
+        node = self._file_node(filename)
+        if n <= 0:
+            return ''
+        stream, seekable = self._open(node)
+        with stream:
+            if not seekable:
+                # Строки читаются из уже открытого потока, а не из нового открытия элемента
+                chunks = iter(functools.partial(stream.read, CHUNK_SIZE), b'')
+                return self._decode(b''.join(deque(self._split_lines(chunks), maxlen=n)))
+            position = stream.seek(0, os.SEEK_END)
+            data = b''
+            # Завершающий перевод строки не открывает новую строку
+            while position > 0 and data.count(b'\n', 0, len(data) - 1) < n:
+                size = min(CHUNK_SIZE, position)
+                position -= size
+                stream.seek(position)
+                data = stream.read(size) + data
+        lines = data.split(b'\n')
+        trailing = lines[-1] == b''
+        if trailing:
+            lines.pop()
+        result = b'\n'.join(lines[-n:])
+        return self._decode(result + b'\n' if trailing else result)
+
+    def wc(self, filename):
+        """Возвращает число строк, слов и байт в файле, читая его потоково"""
+        node = self._file_node(filename)
+        lines = words = size = 0
+        in_word = False
+        for chunk in self._iter_chunks(node):
+            size += len(chunk)
+            lines += chunk.count(b'\n')
+            # Слово, разорванное границей блока, считается один раз
+            chunk_words = chunk.split()
+            words += len(chunk_words)
+            if in_word and chunk_words and not chunk[:1].isspace():
+                words -= 1
+            in_word = not chunk[-1:].isspace()
+        return f"{lines} {words} {size} {filename}"
+
+    @synchronized
     def mkdir(self, dirname):
         """Не не Создает новую директорию"""
         abs_path = self._abs_path(dirname)
-        if not abs_path.endswith('/'):
-            abs_path += '/'
-        if abs_path in self.filesystem:
+        parent, name = self._lookup_parent(abs_path)
+        if parent is None or name in parent.children:
             raise FileExistsError(f"Директория уже существует: {dirname}")
-        self.filesystem[abs_path] = {}
-        print(f"Директория '{dirname}' создана.")
+        self._check_name(name)
+        node = self._attach(parent, Node(name, parent, is_dir=True))
+        self._push([('attach', node)])
+        self.dirty = True
+        self._log('mkdir', abs_path)
+        logger.debug("Директория '%s' создана.", abs_path)
         return f"Директория '{dirname}' создана."
 
+    @synchronized
     def nano(self, filename, content):
         """Создает или редактирует файл с указанным содержимым"""
         abs_path = self._abs_path(filename)
         if abs_path.endswith('/'):
             raise IsADirectoryError(f"'{filename}' является директорией.")
-        parent_dir = os.path.dirname(abs_path).replace('\\', '/') + '/'
-        if parent_dir not in self.filesystem or not isinstance(self.filesystem[parent_dir], dict):
-            raise FileNotFoundError(f"Родительская директория не существует: {parent_dir}")
-        self.filesystem[abs_path] = content
-        print(f"Файл '{filename}' обновлен содержимым: {content}")
+        parent, name = self._lookup_parent(abs_path)
+        node = parent.children.get(name) if parent is not None else self.root
+        if node is not None and node.is_dir:
+            raise IsADirectoryError(f"'{filename}' является директорией.")
+        self._check_name(name)
+        # Новое содержимое получает ссылку раньше, чем освобождается старое: запись того же
+        # содержимого не выбрасывает его из хранилища. Копии, сделанные cp, не затрагиваются
+        digest, content = self._blobs.acquire(content)
+        # Сжатый размер станет известен при сохранении, до тех пор он равен исходному
+        size = len(content.encode('utf-8'))
+        if node is None:
+            node = Node(name, parent, content=content, digest=digest)
+            node.size = node.packed = size
+            self._attach(parent, node)
+            self._push([('attach', node)])
+        else:
+            # Ссылка на прежнее содержимое переходит в журнал отмены
+            self._push([('replace', node, self._state(node))])
+            node.content = content
+            node.digest = digest
+            node.member = None
+            self._resize(node, size, size)
+            if node.layer is not None:
+                # Измененный файл нижнего слоя переходит в верхний вместе с директориями над ним
+                node.layer = None
+                self._promoted.discard(node)
+                self._copy_up(parent)
+        if self._trigrams is not None and len(content) <= TRIGRAM_MAX_FILE:
+            self._trigrams.update(node, self._trigrams.trigrams(content.splitlines()))
+        self.dirty = True
+        self._log('nano', abs_path, content)
+        logger.debug("Файл '%s' обновлен.", abs_path)
         return f"Файл '{filename}' обновлен."
 
     def tree_helper(self, current_dir, prefix=''):
-        """Рекурсивно строит структуру дерева относительно current_dir"""
-        tree_str = ""
-        # Получаем все пути, которые начинаются с current_dir, но не равны ему
-        entries = sorted([
-            path for path in self.filesystem
-            if path.startswith(current_dir) and path != current_dir
-        ], key=lambda x: x.count('/'))
-
-        subdirs = {}
-        files = []
-        for path in entries:
-            # Относительный путь
-            relative_path = path[len(current_dir):].lstrip('/')
-            parts = relative_path.split('/')
-            if len(parts) > 1:
-                subdir = parts[0] + '/'
-                if subdir not in subdirs:
-                    subdirs[subdir] = []
-                subdirs[subdir].append(path)
-            else:
-                files.append(path)
+        """Строит структуру дерева относительно current_dir"""
+        node = current_dir if isinstance(current_dir, Node) else self._lookup(current_dir)
+        return ''.join(f"{line}\n" for line in self._tree_lines(node, prefix))
+
+    def _tree_lines(self, node, prefix='', max_depth=None, dirs_only=False, limit=None):
+        """Обходит поддерево один раз и по мере обхода отдает строки дерева.
+
+        Обход итеративный (явный стек), поэтому глубина иерархии не ограничена стеком вызовов.
+        max_depth ограничивает глубину, dirs_only скрывает файлы, limit - число выводимых записей."""
+        def entries(directory):
+            children = directory.children
+            return [children[name] for name in sorted(children) if not dirs_only or children[name].is_dir]
 
-        # Сортируем поддиректории и файлы вместе
-        all_entries = sorted(list(subdirs.keys()) + files)
-        for idx, name in enumerate(all_entries):
-            is_last = idx == len(all_entries) - 1
+        count = 0
+        # Элемент стека: [узлы директории, индекс следующего узла, префикс, глубина]
+        stack = [[entries(node), 0, prefix, 1]]
+        while stack:
+            frame = stack[-1]
+            children, index, prefix, depth = frame
+            if index == len(children):
+                stack.pop()
+                continue
+            frame[1] += 1
+            if limit is not None and count >= limit:
+                yield f"... (вывод ограничен {limit} записями)"
+                return
+            child = children[index]
+            is_last = index == len(children) - 1
             connector = "└── " if is_last else "├── "
-            # Если это директория, отображаем имя без '/' на конце
-            display_name = name[:-1] if name.endswith('/') else os.path.basename(name)
-            tree_str += f"{prefix}{connector}{display_name}\n"
-            if name.endswith('/'):
+            yield f"{prefix}{connector}{child.name}"
+            count += 1
+            if child.is_dir and (max_depth is None or depth < max_depth):
                 # Определяем новый префикс для вложенных элементов
                 extension = "    " if is_last else "│   "
-                # Рекурсивный вызов для поддиректории
-                tree_str += self.tree_helper(os.path.join(current_dir, name), prefix + extension)
-        return tree_str
+                stack.append([entries(child), 0, prefix + extension, depth + 1])
 
-    def tree(self):
+    def iter_tree(self, max_depth=None, dirs_only=False, limit=None):
+        """Отдает строки древовидной структуры текущей директории по одной"""
+        node = self._lookup(self.current_directory)
+        if node is None:
+            raise FileNotFoundError(f"Нет такой директории: {self.current_directory}")
+        yield self.current_directory
+        yield from self._tree_lines(node, max_depth=max_depth, dirs_only=dirs_only, limit=limit)
+
+    def tree(self, max_depth=None, dirs_only=False, limit=None):
         """Отображает древовидную структуру текущей директории"""
         if not self.filesystem:
-            print("Файловая система пуста.")
             return "Файловая система пуста."
+        return ''.join(f"{line}\n" for line in self.iter_tree(max_depth, dirs_only, limit))
+
+    def du(self, path='.', human=False, summarize=False, max_depth=None):
+        """Отдает строки "размер<TAB>сжатый размер<TAB>путь" для директорий поддерева path.
+
+        Директории выводятся после своих поддиректорий, как в du. Размеры берутся из сумм,
+        которые хранятся в директориях, поэтому du -s стоит O(1) при любом размере дерева;
+        summarize выводит только path, max_depth ограничивает глубину выводимых директорий."""
+        abs_path = self._abs_path(path)
+        start = self._lookup(abs_path)
+        if start is None:
+            raise FileNotFoundError(f"Нет такого файла или директории: {path}")
+        # Суммы директорий учитывают нижние слои, только когда те подгружены
+        self._load_mounts(abs_path)
+        if summarize:
+            max_depth = 0
 
-        # Получаем текущую директорию
-        current_dir = self.current_directory
-        # Отображаем имя текущей директории (опционально)
-        tree_structure = f"{current_dir}\n"
-        # Добавляем дерево начиная с текущей директории
-        tree_structure += self.tree_helper(current_dir)
-        print(tree_structure)
-        return tree_structure
+        def line(node, node_path):
+            if human:
+                return f"{format_size(node.size)}\t{format_size(node.packed)}\t{node_path}"
+            return f"{node.size}\t{node.packed}\t{node_path}"
 
+        if not start.is_dir:
+            yield line(start, start.path())
+            return
+        # Элемент стека: [директория, путь, глубина, поддиректории в порядке имен, индекс следующей]
+        stack = [[start, start.path(), 0, None, 0]]
+        while stack:
+            frame = stack[-1]
+            directory, directory_path, depth, subdirs, index = frame
+            if subdirs is None:
+                children = directory.children
+                subdirs = frame[3] = [] if max_depth is not None and depth >= max_depth else [
+                    name for name in sorted(children) if children[name].is_dir]
+            if index == len(subdirs):
+                stack.pop()
+                yield line(directory, directory_path)
+                continue
+            frame[4] += 1
+            name = subdirs[index]
+            stack.append([directory.children[name], f"{directory_path.rstrip('/')}/{name}", depth + 1, None, 0])
+
+    def stat(self, path):
+        """Возвращает сведения о файле или директории: тип, размеры и данные элемента архива"""
+        abs_path = self._abs_path(path)
+        node = self._lookup(abs_path)
+        if node is None:
+            raise FileNotFoundError(f"Нет такого файла или директории: {path}")
+        if node.is_dir:
+            self._load_mounts(abs_path)
+        lines = [f"Путь: {abs_path}",
+                 f"Тип: {'директория' if node.is_dir else 'файл'}",
+                 f"Размер: {node.size}",
+                 f"Сжатый размер: {node.packed}"]
+        if node.is_dir:
+            lines.append(f"Файлов: {node.files}")
+            lines.append(f"Элементов: {len(node.children)}")
+        elif node.member is not None:
+            method = {zipfile.ZIP_STORED: 'stored', zipfile.ZIP_DEFLATED: 'deflated'}.get(
+                node.member.compress_type, str(node.member.compress_type))
+            lines.append(f"Сжатие: {method}")
+            lines.append(f"CRC: {node.member.CRC:08x}")
+            lines.append("Изменен: {:04d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}".format(*node.member.date_time))
+        else:
+            lines.append("Изменен: не сохранен в архив")
+        if node.layer is not None:
+            lines.append(f"Слой: {node.layer.path}")
+        return "\n".join(lines)
+
+    @synchronized
     def mv(self, source, destination):
         """Перемещает файл или директорию"""
         abs_source = self._abs_path(source)
         abs_destination = self._abs_path(destination)
-
-        if abs_source not in self.filesystem:
+        node = self._lookup(abs_source)
+        if node is None or node is self.root:
             raise FileNotFoundError(f"Нет такого файла или директории: {source}")
-        if abs_destination in self.filesystem:
+        new_parent, new_name = self._lookup_parent(abs_destination)
+        if new_parent is None or new_name in new_parent.children:
             raise FileExistsError(f"Пункт назначения уже существует: {destination}")
+        self._check_name(new_name)
+
+        # Директорию нельзя переместить внутрь нее самой
+        ancestor = new_parent
+        while ancestor is not None:
+            if ancestor is node:
+                raise OSError(f"Нельзя переместить '{source}' в собственную поддиректорию '{destination}'.")
+            ancestor = ancestor.parent
+        if any((layer.mount_point + '/').startswith(abs_source + '/') for layer in self.layers):
+            raise OSError(f"Нельзя переместить точку монтирования или директорию, которая ее содержит: {source}")
 
-        # Перемещаем основной файл или директорию
-        self.filesystem[abs_destination] = self.filesystem.pop(abs_source)
-
-        # Если перемещается директория, необходимо обновить пути вложенных файлов
-        if abs_destination.endswith('/'):
-            prefix = abs_source.rstrip('/') + '/'
-            new_prefix = abs_destination
-            keys_to_update = [key for key in self.filesystem.keys() if key.startswith(prefix)]
-            for key in keys_to_update:
-                new_key = new_prefix + key[len(prefix):]
-                self.filesystem[new_key] = self.filesystem.pop(key)
-        print(f"Перемещено '{source}' в '{destination}'.")
+        # Перемещение - это перевешивание одного узла, вложенные пути и имена не меняются
+        # Отмена возвращает слои и директориям, которые перенос в верхний слой снимет у обоих родителей
+        added, files, directories = self._promote(node, abs_source)
+        directories += self._layered(node.parent) + self._layered(new_parent)
+        frame = [('promote', abs_source, added, files, directories)] if added or files or directories else []
+        frame.append(('move', node, node.parent, node.name))
+        self._relink(node, new_parent, new_name)
+        self._push(frame)
+        self.dirty = True
+        self._log('mv', abs_source, abs_destination)
+        logger.debug("Перемещено '%s' в '%s'.", abs_source, abs_destination)
         return f"Перемещено '{source}' в '{destination}'."
 
+    @synchronized
+    def cp(self, source, destination, recursive=False):
+        """Копирует файл или, с recursive, директорию.
+
+        Копия ссылается на то же содержимое, что и оригинал, поэтому копирование поддерева
+        стоит O(числа узлов) без копирования байт; файл получает собственное содержимое,
+        только когда его изменяет nano."""
+        abs_source = self._abs_path(source)
+        abs_destination = self._abs_path(destination)
+        node = self._lookup(abs_source)
+        if node is None or node is self.root:
+            raise FileNotFoundError(f"Нет такого файла или директории: {source}")
+        if node.is_dir and not recursive:
+            raise IsADirectoryError(f"'{source}' является директорией (используйте -r).")
+        target = self._lookup(abs_destination)
+        if target is not None and target.is_dir:
+            new_parent, new_name = target, node.name
+        else:
+            new_parent, new_name = self._lookup_parent(abs_destination)
+        existing = new_parent.children.get(new_name)
+        if existing is node:
+            raise FileExistsError(f"'{source}' и '{destination}' - один и тот же файл.")
+        self._check_name(new_name)
+        if existing is not None and (existing.is_dir or node.is_dir):
+            raise FileExistsError(f"Пункт назначения уже существует: {destination}")
+
+        # Директорию нельзя скопировать внутрь нее самой
+        ancestor = new_parent
+        while ancestor is not None:
+            if ancestor is node:
+                raise OSError(f"Нельзя скопировать '{source}' в собственную поддиректорию '{destination}'.")
+            ancestor = ancestor.parent
+
+        frame = []
+        if existing is not None:
+            # Замененный файл снимается с дерева, но сохраняет ссылку на содержимое для отмены
+            self._detach(existing)
+            if self._trigrams is not None:
+                self._trigrams.remove(existing)
+            frame.append(('detach', existing, new_parent))
+        # Копия собирается отдельно и вешается в дерево последней: суммы размеров
+        # предков пересчитываются один раз, а не для каждого скопированного узла
+        copy = self._copy_node(node, new_name, None)
+        stack = [(node, copy)] if node.is_dir else []
+        while stack:
+            original, duplicate = stack.pop()
+            for child in original.children.values():
+                child_copy = self._attach(duplicate, self._copy_node(child, child.name, duplicate))
+                if child.is_dir:
+                    stack.append((child, child_copy))
+        self._attach(new_parent, copy)
+        frame.append(('attach', copy))
+        self._push(frame)
+        self.dirty = True
+        self._log('cp', abs_source, abs_destination, recursive)
+        logger.debug("Скопировано '%s' в '%s'.", abs_source, abs_destination)
+        return f"Скопировано '{source}' в '{destination}'."
+
+    def _copy_node(self, node, name, parent):
+        """Создает копию узла без детей, которая ссылается на то же содержимое"""
+        if node.is_dir:
+            return Node(name, parent, is_dir=True)
+        if node.digest is not None:
+            self._blobs.share(node.digest)
+        copy = Node(name, parent, content=node.content, member=node.member, digest=node.digest, layer=node.layer)
+        copy.size, copy.packed = node.size, node.packed
+        if node.layer is not None:
+            # Копия файла нижнего слоя читается из его архива, но принадлежит верхнему слою
+            self._promoted.add(copy)
+        return copy
+
+    @synchronized
+    def import_tree(self, host_dir, destination):
+        """Импортирует содержимое директории хоста host_dir в директорию destination (она создается,
+        если ее нет); существующие файлы заменяются.
+
+        Дерево хоста обходится через os.scandir, файлы читаются пулом потоков с ограниченным окном
+        ожидающих чтений и вставляются пачкой: индекс имен сортируется и суммы размеров
+        пересчитываются один раз на команду, а записи журнала сбрасываются на диск одним fsync."""
+        if not os.path.isdir(host_dir):
+            raise NotADirectoryError(f"Не является директорией хоста: {host_dir}")
+        abs_destination = self._abs_path(destination)
+        target = self._lookup(abs_destination)
+        if target is not None and not target.is_dir:
+            raise NotADirectoryError(f"Не является директорией: {destination}")
+        parent, name = (None, None) if target is not None else self._lookup_parent(abs_destination)
+        if target is None:
+            self._check_name(name)
+        directories, files = self._scan_host(host_dir)
+        for parts in directories + [parts for parts, _ in files]:
+            self._check_name(parts[-1])
+
+        # Все конфликты выясняются до первого изменения: директория хоста не может заменить
+        # файл, а файл - директорию
+        nodes = {(): target}
+        for parts in directories:
+            directory = nodes[parts[:-1]]
+            node = directory.children.get(parts[-1]) if directory is not None else None
+            if node is not None and not node.is_dir:
+                raise NotADirectoryError(f"Не является директорией: {node.path()}")
+            nodes[parts] = node
+        for parts, _ in files:
+            directory = nodes[parts[:-1]]
+            node = directory.children.get(parts[-1]) if directory is not None else None
+            if node is not None and node.is_dir:
+                raise IsADirectoryError(f"'{node.path()}' является директорией.")
+
+        frame = []
+        records = []
+        journal = self.journal is not None and not self._replaying
+        # Новые директории: их содержимое отменяется вместе с ними
+        created = set()
+        if target is None:
+            target = nodes[()] = self._attach(parent, Node(name, parent, is_dir=True))
+            created.add(target)
+            frame.append(('attach', target))
+            records.append(['mkdir', abs_destination])
+        size, packed, count = target.size, target.packed, target.files
+        total = 0
+        pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+        self._sizes_ready = False
+        try:
+            with self._names.bulk(), gc_paused():
+                for parts in directories:
+                    if nodes[parts] is not None:
+                        continue
+                    directory = nodes[parts[:-1]]
+                    node = nodes[parts] = self._attach(directory, Node(parts[-1], directory, is_dir=True))
+                    if directory not in created:
+                        frame.append(('attach', node))
+                    created.add(node)
+                    if journal:
+                        records.append(['mkdir', node.path()])
+                window = deque()
+                for parts, host_path in files:
+                    window.append((parts, pool.submit(self._read_host_file, host_path)))
+                    if len(window) > self.workers * 4:
+                        total += self._insert_imported(nodes, created, frame, records if journal else None,
+                                                       *window.popleft())
+                while window:
+                    total += self._insert_imported(nodes, created, frame, records if journal else None,
+                                                   *window.popleft())
+        finally:
+            pool.shutdown(cancel_futures=True)
+            self._compute_sizes(target)
+            self._propagate(target.parent, target.size - size, target.packed - packed, target.files - count)
+            if frame:
+                self._push(frame)
+                self.dirty = True
+            self._log_batch(records)
+        logger.debug("Импортировано файлов из '%s' в '%s': %d", host_dir, abs_destination, len(files))
+        return f"Импортировано файлов: {len(files)} ({format_size(total)}) в '{destination}'."
+
+    @staticmethod
+    def _scan_host(host_dir):
+        """Обходит директорию хоста; возвращает поддиректории и пары (компоненты пути, путь на хосте)
+        для файлов. Директория идет раньше своего содержимого, символические ссылки на
+        директории не раскрываются"""
+        directories = []
+        files = []
+        stack = [((), host_dir)]
+        while stack:
+            parts, path = stack.pop()
+            with os.scandir(path) as entries:
+                for entry in sorted(entries, key=lambda entry: entry.name):
+                    child = parts + (entry.name,)
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(child)
+                        stack.append((child, entry.path))
+                    elif entry.is_file():
+                        files.append((child, entry.path))
+        return directories, files
+
+    @staticmethod
+    def _read_host_file(path):
+        """Читает файл хоста блоками, декодируя и хешируя его по ходу чтения, без полной копии в байтах.
+
+        Возвращает (содержимое, хеш, размер в UTF-8); хеш None, если при декодировании
+        отброшены некорректные байты."""
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        digest = hashlib.blake2b(digest_size=16)
+        parts = []
+        size = 0
+        with open(path, 'rb') as f:
+            try:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    parts.append(decoder.decode(chunk))
+                    digest.update(chunk)
+                    size += len(chunk)
+                parts.append(decoder.decode(b'', final=True))
+            except UnicodeDecodeError:
+                f.seek(0)
+                content = f.read().decode('utf-8', errors='ignore')
+                return content, None, len(content.encode('utf-8'))
+        return ''.join(parts), digest.hexdigest(), size
+
+    def _insert_imported(self, nodes, created, frame, records, parts, future):
+        """Вешает прочитанный файл в дерево, заменяя существующий; возвращает его размер"""
+        content, digest, size = future.result()
+        directory = nodes[parts[:-1]]
+        existing = directory.children.get(parts[-1])
+        if existing is not None:
+            # Замененный файл сохраняет ссылку на содержимое для отмены, как в cp
+            self._detach(existing)
+            if self._trigrams is not None:
+                self._trigrams.remove(existing)
+            frame.append(('detach', existing, directory))
+        digest, content = self._blobs.acquire(content, digest)
+        node = Node(parts[-1], directory, content=content, digest=digest)
+        node.size = node.packed = size
+        self._attach(directory, node)
+        if directory not in created:
+            frame.append(('attach', node))
+        if records is not None:
+            records.append(['nano', node.path(), content])
+        return size
+
+    def export_tree(self, source, host_dir):
+        """Выгружает файл или содержимое директории source в директорию хоста host_dir.
+
+        Файлы пишутся пулом потоков с ограниченным окном; содержимое читается из архива
+        потоково блоками, поэтому большой файл не загружается в память целиком."""
+        node = self._lookup(self._abs_path(source))
+        if node is None:
+            raise FileNotFoundError(f"Нет такого файла или директории: {source}")
+        os.makedirs(host_dir, exist_ok=True)
+        entries = self._walk(node) if node.is_dir else [('/' + node.name, node)]
+        count = total = 0
+        pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+        window = deque()
+        try:
+            for path, child in entries:
+                if child.name in ('.', '..'):
+                    raise ValueError(f"Недопустимое имя для выгрузки: {path}")
+                host_path = os.path.join(host_dir, *path.split('/')[1:])
+                if child.is_dir:
+                    os.makedirs(host_path, exist_ok=True)
+                    continue
+                window.append(pool.submit(self._export_file, child, host_path))
+                if len(window) > self.workers * 4:
+                    total += window.popleft().result()
+                    count += 1
+            while window:
+                total += window.popleft().result()
+                count += 1
+        finally:
+            pool.shutdown(cancel_futures=True)
+        logger.debug("Выгружено файлов из '%s' в '%s': %d", source, host_dir, count)
+        return f"Выгружено файлов: {count} ({format_size(total)}) в '{host_dir}'."
+
+    def _export_file(self, node, host_path):
+        """Записывает файл на хост блоками; возвращает число записанных байт"""
+        written = 0
+        with open(host_path, 'wb') as f:
+            for chunk in self._iter_chunks(node):
+                f.write(chunk)
+                written += len(chunk)
+        return written
+
+    def _unlink(self, path):
+        """Удаляет узел по пути; так в журнал операций записывается отмена создания узла"""
+        node = self._lookup(path)
+        if node is None or node is self.root:
+            raise FileNotFoundError(f"Нет такого файла или директории: {path}")
+        self._remove(node)
+        self.dirty = True
+        self._log('_unlink', path)
+
+    def _move(self, source, destination):
+        """Перевешивает узел, не перенося его в верхний слой; так в журнал операций записывается отмена mv"""
+        node = self._lookup(source)
+        if node is None or node is self.root:
+            raise FileNotFoundError(f"Нет такого файла или директории: {source}")
+        parent, name = self._lookup_parent(destination)
+        self._relink(node, parent, name)
+        self.dirty = True
+        self._log('_move', source, destination)
+
+    def _relink(self, node, parent, name):
+        self._detach(node)
+        node.name = name
+        self._attach(parent, node)
+
+    @staticmethod
+    def _state(node):
+        return node.content, node.digest, node.member, node.layer, node.size, node.packed
+
+    def _push(self, frame):
+        """Добавляет кадр обратных действий изменяющей команды в журнал отмены.
+
+        Кадры старше undo_depth последних и самого раннего снимка отбрасываются, поэтому память
+        журнала растет с объемом изменений, а не с числом снимков."""
+        if self._replaying:
+            # При воспроизведении журнала отмены нет, но ссылки на прежнее содержимое кадр уже держит
+            self._drop(frame)
+            return
+        self._history.append(frame)
+        oldest = min(self._snapshots.values(), default=None)
+        while len(self._history) > self.undo_depth and (oldest is None or self._history_start < oldest):
+            self._drop(self._history.popleft())
+            self._history_start += 1
+
+    def _drop(self, frame):
+        """Освобождает ссылки на содержимое, которые держал отброшенный кадр"""
+        for record in frame:
+            if record[0] == 'replace' and record[2][1] is not None:
+                self._blobs.release(record[2][1])
+            elif record[0] == 'detach':
+                self._release(record[1])
+
+    def _revert(self, frame):
+        """Применяет обратные действия кадра в обратном порядке и записывает их в журнал операций"""
+        for record in reversed(frame):
+            kind, node = record[0], record[1]
+            if kind == 'attach':
+                path = node.path()
+                self._remove(node)
+                self._log('_unlink', path)
+            elif kind == 'move':
+                source = node.path()
+                self._relink(node, record[2], record[3])
+                self._log('_move', source, node.path())
+            elif kind == 'promote':
+                # Узлы уже вернулись на прежние места, поэтому пути берутся от них
+                self._demote(node, record[2], [file.path() for file in record[3]],
+                             [(directory.path(), layer.mount_point) for directory, layer in record[4]])
+            elif kind == 'replace':
+                if node.digest is not None:
+                    self._blobs.release(node.digest)
+                content, digest, member, layer, size, packed = record[2]
+                node.content, node.digest, node.member, node.layer = content, digest, member, layer
+                self._resize(node, size, packed)
+                if self._trigrams is not None:
+                    self._trigrams.remove(node)
+                if self.journal is not None:
+                    self._log('nano', node.path(), self._read(node))
+            elif kind == 'detach':
+                self._attach(record[2], node)
+                if self.journal is not None:
+                    self._log('nano', node.path(), self._read(node))
+        self.dirty = True
+
+    def _materialize_history(self):
+        """Переносит в память прежнее содержимое из журнала отмены, которое хранится в элементах
+        верхнего архива: после перезаписи архива эти элементы станут недоступны"""
+        for frame in self._history:
+            for index, record in enumerate(frame):
+                if record[0] == 'replace':
+                    content, digest, member, layer, size, packed = record[2]
+                    if content is None and layer is None:
+                        digest, content = self._blobs.acquire(self._decode(self._zip.read(member)))
+                        frame[index] = ('replace', record[1], (content, digest, None, None, size, packed))
+                elif record[0] == 'detach':
+                    node = record[1]
+                    if node.content is None and node.layer is None:
+                        node.digest, node.content = self._blobs.acquire(self._decode(self._zip.read(node.member)))
+                        node.member = None
+
+    @synchronized
+    def snapshot(self):
+        """Запоминает текущее состояние файловой системы за O(1) и возвращает номер снимка"""
+        snapshot_id = self._next_snapshot
+        self._next_snapshot += 1
+        self._snapshots[snapshot_id] = self._history_start + len(self._history)
+        return snapshot_id
+
+    @synchronized
+    def rollback(self, snapshot_id):
+        """Возвращает файловую систему к снимку; более поздние снимки удаляются"""
+        position = self._snapshots.get(snapshot_id)
+        if position is None:
+            raise KeyError(f"Нет такого снимка: {snapshot_id}")
+        count = 0
+        while self._history_start + len(self._history) > position:
+            self._revert(self._history.pop())
+            count += 1
+        self._forget_snapshots()
+        logger.debug("Отменено изменений до снимка %d: %d", snapshot_id, count)
+        return f"Восстановлен снимок {snapshot_id}."
+
+    @synchronized
+    def undo(self):
+        """Отменяет последнюю изменяющую команду"""
+        if not self._history:
+            raise IndexError("Нечего отменять.")
+        self._revert(self._history.pop())
+        self._forget_snapshots()
+        return "Последнее изменение отменено."
+
+    def _forget_snapshots(self):
+        end = self._history_start + len(self._history)
+        for snapshot_id in [key for key, position in self._snapshots.items() if position > end]:
+            del self._snapshots[snapshot_id]
+
+    def find(self, path='.', name=None, kind=None, max_depth=None):
+        """Отдает абсолютные пути узлов в поддереве path, подходящих под шаблон имени и тип.
+
+        Точное имя и шаблон вида "префикс*" отвечаются по индексу имен; прочие шаблоны
+        проверяются обходом дерева, который не спускается глубже max_depth."""
+        start = self._lookup(self._abs_path(path))
+        if start is None:
+            raise FileNotFoundError(f"Нет такого файла или директории: {path}")
+        if kind not in (None, 'f', 'd'):
+            raise ValueError(f"Неизвестный тип '{kind}': ожидается f или d.")
+
+        exact = name is not None and not self._has_magic(name)
+        prefix = name is not None and name.endswith('*') and len(name) > 1 and not self._has_magic(name[:-1])
+        if not exact and not prefix:
+            return self._find_walk(start, name, kind, max_depth)
+        # Индекс имен знает только о подгруженных слоях, поэтому слои поддерева подгружаются
+        # до выборки кандидатов
+        self._load_mounts(start.path())
+        candidates = self._names.exact(name) if exact else self._names.prefix(name[:-1])
+
+        matches = []
+        for node in candidates:
+            depth = self._depth_below(node, start)
+            if depth is None or (max_depth is not None and depth > max_depth):
+                continue
+            if kind is not None and node.is_dir != (kind == 'd'):
+                continue
+            matches.append(node.path())
+        # Генератор, а не итератор списка: окно прерывает вывод по Ctrl+C через close()
+        return (path for path in sorted(matches))
+
+    @staticmethod
+    def _has_magic(pattern):
+        return any(char in pattern for char in '*?[')
+
+    @staticmethod
+    def _depth_below(node, ancestor):
+        """Глубина node относительно ancestor или None, если node вне его поддерева"""
+        depth = 0
+        while node is not None:
+            if node is ancestor:
+                return depth
+            node = node.parent
+            depth += 1
+        return None
+
+    def _find_walk(self, start, pattern, kind, max_depth):
+        """Обход поддерева для шаблонов, которые нельзя ответить по индексу"""
+        for path, node, _ in self._walk_sorted(start, max_depth):
+            if (node is not self.root and (pattern is None or fnmatch.fnmatchcase(node.name, pattern))
+                    and (kind is None or node.is_dir == (kind == 'd'))):
+                yield path
+
+    @staticmethod
+    def _walk_sorted(start, max_depth=None):
+        """Обходит поддерево в глубину в порядке имен, отдавая (путь, узел, глубина), включая start"""
+        stack = [(start, start.path(), 0)]
+        while stack:
+            node, path, depth = stack.pop()
+            yield path, node, depth
+            if node.is_dir and (max_depth is None or depth < max_depth):
+                prefix = path.rstrip('/')
+                for child_name in sorted(node.children, reverse=True):
+                    stack.append((node.children[child_name], f"{prefix}/{child_name}", depth + 1))
+
+    def grep(self, pattern, path, recursive=False, files_only=False, line_numbers=False):
+        """Ищет строки, подходящие под регулярное выражение, и отдает строки вывода по мере нахождения.
+
+        Файлы просматриваются пулом потоков; результаты отдаются в порядке обхода, как только
+        готов очередной файл. Файлы, не загруженные в память, читаются потоково и не кэшируются."""
+        regex = re.compile(pattern)
+        start = self._lookup(self._abs_path(path))
+        if start is None:
+            raise FileNotFoundError(f"Нет такого файла или директории: {path}")
+        if start.is_dir and not recursive:
+            raise IsADirectoryError(f"'{path}' является директорией.")
+        files = ((file_path, node) for file_path, node, _ in self._walk_sorted(start) if not node.is_dir)
+
+        # Для литералов индекс триграмм отсеивает файлы, в которых совпадения быть не может
+        may_match = None
+        if self._trigrams is not None and not any(char in pattern for char in '.^$*+?{}[]\\|()'):
+            may_match = self._trigrams.candidates(pattern)
+        return self._grep_stream(files, regex, start.is_dir, files_only, line_numbers, may_match)
+
+    def _grep_stream(self, files, regex, show_names, files_only, line_numbers, may_match):
+        pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+        window = deque()
+        try:
+            for file_path, node in files:
+                if may_match is not None and not may_match(node):
+                    continue
+                window.append((file_path, node, pool.submit(self._grep_file, node, regex, files_only)))
+                if len(window) > self.workers * 4:
+                    yield from self._grep_output(*window.popleft(), show_names, files_only, line_numbers)
+            while window:
+                yield from self._grep_output(*window.popleft(), show_names, files_only, line_numbers)
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _grep_output(self, file_path, node, future, show_names, files_only, line_numbers):
+        matches, trigrams = future.result()
+        if trigrams is not None:
+            self._trigrams.update(node, trigrams)
+        if files_only:
+            if matches:
+                yield file_path
+            return
+        for number, line in matches:
+            prefix = f"{file_path}:" if show_names else ""
+            yield f"{prefix}{number}:{line}" if line_numbers else f"{prefix}{line}"
+
+    def _grep_file(self, node, regex, files_only):
+        """Просматривает один файл; возвращает совпадения и, если файл прочитан целиком, его триграммы"""
+        content, info = self._contents(node)
+        if content is not None:
+            lines = content.splitlines()
+            size = len(content)
+        else:
+            lines = (self._decode(line).rstrip('\r\n') for line in self._iter_lines(node))
+            size = info.file_size
+        trigrams = set() if self._trigrams is not None and size <= TRIGRAM_MAX_FILE else None
+        matches = []
+        for number, line in enumerate(lines, 1):
+            if trigrams is not None:
+                trigrams.update(line[i:i + 3] for i in range(len(line) - 2))
+            if regex.search(line):
+                matches.append((number, line))
+                if files_only:
+                    # Файл прочитан не до конца, поэтому в индекс он не попадает
+                    return matches, None
+        return matches, trigrams
+
+
+class CommandDispatcher:
+    """Разбор и выполнение команд оболочки, не зависящие от интерфейса (окно или пакетный режим).
+
+    Команда - имя и аргументы через пробел; результат - строка или итератор строк вывода."""
 
-class ShellGUI:
     def __init__(self, shell):
         self.shell = shell
+        self.exit_requested = False
+        self._handlers = {
+            "pwd": self._pwd,
+            "ls": self._ls,
+            "cd": self._cd,
+            "cat": self._cat,
+            "head": self._head,
+            "tail": self._tail,
+            "wc": self._wc,
+            "mkdir": self._mkdir,
+            "nano": self._nano,
+            "tree": self._tree,
+            "mv": self._mv,
+            "cp": self._cp,
+            "import": self._import,
+            "export": self._export,
+            "find": self._find,
+            "grep": self._grep,
+            "du": self._du,
+            "snapshot": self._snapshot,
+            "rollback": self._rollback,
+            "undo": self._undo,
+            "stat": self._stat,
+            "stats": self._stats,
+            "exit": self._exit,
+        }
+
+    @property
+    def commands(self):
+        return sorted(self._handlers)
+
+    def complete(self, line):
+        """Дополняет последнее слово строки: в начале строки - имя команды, дальше - путь.
+
+        Возвращает позицию начала слова в строке и отсортированные варианты замены."""
+        start = line.rfind(' ') + 1
+        word = line[start:]
+        if not line[:start].strip():
+            return start, [name for name in self.commands if name.startswith(word)]
+        if word.startswith('-'):
+            return start, []
+        return start, self.shell.complete(word)
+
+    def execute(self, command):
+        parts = command.split()
+        if not parts:
+            return ""
+        cmd = parts[0]
+        handler = self._handlers.get(cmd)
+        if handler is None:
+            return f"Команда '{cmd}' не найдена."
+        start = time.perf_counter()
+        lazy = False
+        try:
+            result = handler(parts[1:])
+            if result is None or isinstance(result, str):
+                return result
+            # Построчный вывод ленив: первая строка вычисляется сразу, чтобы ошибка в аргументах
+            # (например, du несуществующего пути) возвращалась строкой, как у остальных команд
+            lines = iter(result)
+            first = next(lines, None)
+            lazy = True
+            return self._stream(command, cmd, start, first, lines)
+        except Exception as e:
+            return f"Ошибка при выполнении команды '{command}': {e}"
+        finally:
+            if not lazy:
+                self.shell.profiler.record_command(cmd, time.perf_counter() - start)
+
+    def _stream(self, command, cmd, start, first, lines):
+        """Отдает построчный вывод команды; задержка учитывается, когда вывод дочитан или закрыт"""
+        try:
+            if first is None:
+                return
+            yield first
+            yield from lines
+        except Exception as e:
+            yield f"Ошибка при выполнении команды '{command}': {e}"
+        finally:
+            close = getattr(lines, "close", None)
+            if close is not None:
+                close()
+            self.shell.profiler.record_command(cmd, time.perf_counter() - start)
+
+    def _pwd(self, args):
+        return self.shell.pwd()
+
+    def _ls(self, args):
+        output = "\n".join(self.shell.ls())
+        return output if output else "Нет файлов или директорий."
+
+    def _cd(self, args):
+        if len(args) < 1:
+            return "cd: отсутствует аргумент."
+        self.shell.cd(args[0])
+        return ""
+
+    def _cat(self, args):
+        options, args = parse_options(args, {"--offset": ("offset", int), "--length": ("length", int)})
+        if len(args) < 1:
+            return "cat: отсутствует аргумент."
+        return self.shell.cat(args[0], **options)
+
+    def _head(self, args):
+        options, args = parse_options(args, {"-n": ("n", int)})
+        if len(args) < 1:
+            return "head: отсутствует аргумент."
+        return self.shell.head(args[0], **options).rstrip('\n')
+
+    def _tail(self, args):
+        options, args = parse_options(args, {"-n": ("n", int)})
+        if len(args) < 1:
+            return "tail: отсутствует аргумент."
+        return self.shell.tail(args[0], **options).rstrip('\n')
+
+    def _wc(self, args):
+        if len(args) < 1:
+            return "wc: отсутствует аргумент."
+        return self.shell.wc(args[0])
+
+    def _mkdir(self, args):
+        if len(args) < 1:
+            return "mkdir: отсутствует аргумент."
+        return self.shell.mkdir(args[0])
+
+    def _nano(self, args):
+        if len(args) < 2:
+            return "nano: недостаточно аргументов. Использование: nano <файл> <содержимое>"
+        return self.shell.nano(args[0], ' '.join(args[1:]))
+
+    def _tree(self, args):
+        options, args = parse_options(args, {"-L": ("max_depth", int), "-d": ("dirs_only", None),
+                                             "--limit": ("limit", int)})
+        if not self.shell.filesystem:
+            return "Файловая система пуста."
+        return self.shell.iter_tree(**options)
+
+    def _mv(self, args):
+        if len(args) < 2:
+            return "mv: недостаточно аргументов. Использование: mv <источник> <назначение>"
+        return self.shell.mv(args[0], args[1])
+
+    def _cp(self, args):
+        options, args = parse_options(args, {"-r": ("recursive", None)})
+        if len(args) < 2:
+            return "cp: недостаточно аргументов. Использование: cp [-r] <источник> <назначение>"
+        return self.shell.cp(args[0], args[1], **options)
+
+    def _import(self, args):
+        if len(args) < 2:
+            return "import: недостаточно аргументов. Использование: import <директория хоста> <директория>"
+        return self.shell.import_tree(args[0], args[1])
+
+    def _export(self, args):
+        if len(args) < 2:
+            return "export: недостаточно аргументов. Использование: export <путь> <директория хоста>"
+        return self.shell.export_tree(args[0], args[1])
+
+    def _find(self, args):
+        options, args = parse_options(args, {"-name": ("name", str), "-type": ("kind", str),
+                                             "-maxdepth": ("max_depth", int)})
+        return self.shell.find(args[0] if args else '.', **options)
+
+    def _grep(self, args):
+        options, args = parse_options(args, {"-r": ("recursive", None), "-l": ("files_only", None),
+                                             "-n": ("line_numbers", None)})
+        if len(args) < 2:
+            return "grep: недостаточно аргументов. Использование: grep [-r] [-l] [-n] <шаблон> <путь>"
+        return self.shell.grep(args[0], args[1], **options)
+
+    def _du(self, args):
+        options, args = parse_options(args, {"-h": ("human", None), "-s": ("summarize", None),
+                                             "-d": ("max_depth", int)})
+        return self.shell.du(args[0] if args else '.', **options)
+
+    def _stat(self, args):
+        if len(args) < 1:
+            return "stat: отсутствует аргумент."
+        return self.shell.stat(args[0])
+
+    def _snapshot(self, args):
+        return f"Снимок {self.shell.snapshot()} создан."
+
+    def _rollback(self, args):
+        if len(args) < 1:
+            return "rollback: отсутствует номер снимка."
+        return self.shell.rollback(int(args[0]))
+
+    def _undo(self, args):
+        return self.shell.undo()
+
+    def _stats(self, args):
+        return self.shell.profiler.report()
+
+    def _exit(self, args):
+        self.shell._write_to_zip()
+        self.shell.close()
+        self.exit_requested = True
+        return "Выход..."
+
+
+class Session:
+    """Состояние одного подключения к серверу: текущая директория"""
+    __slots__ = ('cwd',)
+
+    def __init__(self, cwd='/'):
+        self.cwd = cwd
+
+
+class ReadWriteLock:
+    """Блокировка читателей и писателей: читатели работают одновременно, писатель - один.
+
+    Ожидающий писатель не пропускает новых читателей, поэтому поток чтений его не задерживает."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextlib.contextmanager
+    def read(self):
+        with self._condition:
+            while self._writer or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        with self._condition:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._condition.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer = False
+                self._condition.notify_all()
+
+
+class ShellServer:
+    """Многосеансовый сервер на Unix-сокете поверх одной загруженной файловой системы.
+
+    Протокол строчный: клиент отправляет команду одной строкой, сервер отвечает ее выводом
+    и строкой END_OF_REPLY. У каждого подключения своя текущая директория; команды
+    выполняются в пуле потоков, чтения - одновременно, изменения - по одному."""
+
+    def __init__(self, shell):
+        self.shell = shell
+        self.dispatcher = CommandDispatcher(shell)
+        self.lock = ReadWriteLock()
+        # Фоновое сворачивание журнала ждет, пока читатели дочитают вывод
+        shell.exclusive = self.lock.write
+
+    def execute(self, session, command):
+        """Выполняет команду в сеансе session и возвращает весь ее вывод"""
+        parts = command.split(maxsplit=1)
+        lock = self.lock.write() if parts and parts[0] in WRITE_COMMANDS else self.lock.read()
+        output = io.StringIO()
+        # Построчный вывод дочитывается под блокировкой: дерево не меняется, пока идет обход
+        with lock, self.shell.session(session):
+            write_result(self.dispatcher.execute(command), output)
+        return output.getvalue()
+
+    async def start(self, path):
+        """Начинает принимать подключения на сокете path"""
+        # asyncio импортируется только в режиме сервера: окну и пакетному режиму он не нужен
+        import asyncio
+        if os.path.exists(path):
+            os.remove(path)
+        return await asyncio.start_unix_server(self._handle, path)
+
+    async def serve(self, path):
+        server = await self.start(path)
+        logger.info("Сервер слушает %s", path)
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        import asyncio
+        session = Session()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode('utf-8', errors='replace').strip()
+                # Аргументы exit не важны: обработчик диспетчера сохранил бы и закрыл общую файловую систему
+                if command.split(maxsplit=1)[:1] == ['exit']:
+                    # exit закрывает только свое подключение; файловая система сохраняется при остановке сервера
+                    writer.write("Выход...\n".encode('utf-8') + END_OF_REPLY)
+                    await writer.drain()
+                    break
+                result = await asyncio.to_thread(self.execute, session, command)
+                writer.write(result.encode('utf-8') + END_OF_REPLY)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+class CommandHistory:
+    """История команд окна: перемещение стрелками, обратный поиск и сохранение в файл.
+
+    Каждая команда сразу дописывается в файл, поэтому история переживает аварийное
+    завершение; хранятся последние max_size команд, а файл время от времени сжимается."""
+
+    def __init__(self, path=None, max_size=HISTORY_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.entries = []
+        if path is not None:
+            try:
+                with open(path, encoding='utf-8', errors='ignore') as f:
+                    self.entries = [line.rstrip('\n') for line in f if line.strip()][-max_size:]
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning("История команд не прочитана: %s", e)
+        self._file_lines = len(self.entries)
+        # Позиция просмотра стрелками; len(entries) - новая строка, текст которой хранится в _draft
+        self.position = len(self.entries)
+        self._draft = ''
+
+    def add(self, command):
+        """Добавляет выполненную команду; повтор предыдущей команды не запоминается"""
+        self.position = len(self.entries)
+        if not command.strip() or (self.entries and self.entries[-1] == command):
+            return
+        self.entries.append(command)
+        if len(self.entries) > self.max_size:
+            del self.entries[0]
+        self.position = len(self.entries)
+        if self.path is None:
+            return
+        try:
+            if self._file_lines >= 2 * self.max_size:
+                self._rewrite()
+            else:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(command + '\n')
+                self._file_lines += 1
+        except OSError as e:
+            logger.warning("История команд не записана: %s", e)
+            self.path = None
+
+    def _rewrite(self):
+        """Переписывает файл истории, оставляя в нем только хранящиеся команды"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.writelines(command + '\n' for command in self.entries)
+            shutil.copymode(self.path, tmp_path)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self._file_lines = len(self.entries)
+
+    def previous(self, current):
+        """Команда перед позицией просмотра или None; current - текст поля ввода, который
+        запоминается при уходе с новой строки"""
+        if self.position == len(self.entries):
+            self._draft = current
+        if self.position == 0:
+            return None
+        self.position -= 1
+        return self.entries[self.position]
+
+    def next(self):
+        """Команда после позиции просмотра, после последней - запомненная новая строка; None в конце"""
+        if self.position >= len(self.entries):
+            return None
+        self.position += 1
+        return self.entries[self.position] if self.position < len(self.entries) else self._draft
+
+    def search(self, query, before=None):
+        """Ищет самую позднюю команду, содержащую query, раньше позиции before.
+
+        Возвращает позицию команды или None."""
+        index = len(self.entries) if before is None else before
+        for position in range(min(index, len(self.entries)) - 1, -1, -1):
+            if query in self.entries[position]:
+                return position
+        return None
+
+
+class ShellGUI:
+    def __init__(self, shell, history_path=None):
+        # tkinter импортируется только при запуске окна: пакетный режим и тесты без него обходятся
+        import tkinter as tk
+        from tkinter.scrolledtext import ScrolledText
+        self._tk = tk
+
+        self.shell = shell
+        self.dispatcher = CommandDispatcher(shell)
         self.window = tk.Tk()
         self.window.title("Виртуальный Эмулятор Shell")
 
-        self.output = ScrolledText(self.window, wrap=WORD, height=20, width=80, state='disabled')
+        self.output = ScrolledText(self.window, wrap=tk.WORD, height=20, width=80, state='disabled')
         self.output.pack(padx=10, pady=10)
 
-        self.entry = Entry(self.window, width=80)
+        self.entry = tk.Entry(self.window, width=80)
         self.entry.pack(padx=10, pady=(0, 10))
         self.entry.bind("<Return>", self.execute_command)
+        self.entry.bind("<Control-c>", self.cancel_command)
+        self.entry.bind("<Tab>", self.complete_command)
+        self.entry.bind("<Up>", self.history_previous)
+        self.entry.bind("<Down>", self.history_next)
+        self.entry.bind("<Control-r>", self.reverse_search)
+        self.entry.bind("<KeyPress>", self._search_key)
         self.entry.focus()
+        # Строка состояния обратного поиска (Ctrl+R)
+        self.status = tk.Label(self.window, anchor='w')
+        self.status.pack(fill='x', padx=10, pady=(0, 5))
+
+        self.history = CommandHistory(history_path)
+        # Состояние обратного поиска: [запрос, позиция найденной команды, исходный текст] или None
+        self._search = None
+
+        # Команды выполняются по очереди единственным рабочим потоком, поэтому они не
+        # обгоняют друг друга и не изменяют VShell одновременно
+        self._commands = queue.Queue()
+        self._cancel = threading.Event()
+        self._running = False
+        self._closing = False
+        self._quit_requested = False
+        # Вывод копится в ограниченной очереди и вставляется в окно одной порцией за кадр
+        self._output_queue = queue.Queue(OUTPUT_QUEUE_SIZE)
+        self._worker = threading.Thread(target=self._worker_loop, daemon=True)
+        self._worker.start()
+        self.window.after(OUTPUT_FRAME_MS, self._flush_output)
 
         # Инициализируем вывод текущего пути
         self._append_output(f"{self.shell.pwd()}$ ")
 
     def execute_command(self, event=None):
+        self._finish_search()
         command = self.entry.get()
-        self.entry.delete(0, END)
+        self.entry.delete(0, self._tk.END)
+        self.history.add(command)
         if not command.strip():
             return
-        threading.Thread(target=self._execute_command_thread, args=(command,)).start()
+        self._commands.put(command)
+
+    def _set_entry(self, text):
+        self.entry.delete(0, self._tk.END)
+        self.entry.insert(0, text)
+
+    def complete_command(self, event=None):
+        """Дополняет слово перед курсором (Tab): единственный вариант подставляется целиком,
+        несколько - до общего префикса, а если префикс уже набран, варианты выводятся в окно"""
+        self._finish_search()
+        cursor = self.entry.index(self._tk.INSERT)
+        line = self.entry.get()[:cursor]
+        # Во время изменяющей команды дерево меняется, поэтому дополнение не ждет ее, а пропускается
+        if not self.shell._lock.acquire(blocking=False):
+            self.window.bell()
+            return "break"
+        try:
+            start, candidates = self.dispatcher.complete(line)
+        finally:
+            self.shell._lock.release()
+        if not candidates:
+            self.window.bell()
+            return "break"
+        if len(candidates) == 1:
+            completion = candidates[0] if candidates[0].endswith('/') else candidates[0] + ' '
+        else:
+            completion = os.path.commonprefix(candidates)
+            if completion == line[start:]:
+                try:
+                    self._output_queue.put_nowait("  ".join(candidates) + "\n")
+                except queue.Full:
+                    self.window.bell()
+                return "break"
+        self.entry.delete(start, cursor)
+        self.entry.insert(start, completion)
+        return "break"
+
+    def history_previous(self, event=None):
+        self._finish_search()
+        command = self.history.previous(self.entry.get())
+        if command is None:
+            self.window.bell()
+        else:
+            self._set_entry(command)
+        return "break"
+
+    def history_next(self, event=None):
+        self._finish_search()
+        command = self.history.next()
+        if command is None:
+            self.window.bell()
+        else:
+            self._set_entry(command)
+        return "break"
+
+    def reverse_search(self, event=None):
+        """Обратный поиск по истории (Ctrl+R): первое нажатие начинает поиск, следующие ищут
+        более раннюю команду с тем же запросом"""
+        if self._search is None:
+            self._search = ["", len(self.history.entries), self.entry.get()]
+        else:
+            self._search_history(self._search[1])
+        self._show_search()
+        return "break"
+
+    def _search_key(self, event):
+        """Набор запроса обратного поиска; вне поиска клавиши обрабатываются как обычно"""
+        if self._search is None:
+            return None
+        if event.keysym == "Escape" or (event.keysym == "g" and event.state & 0x4):
+            # Отмена поиска возвращает исходный текст
+            self._set_entry(self._search[2])
+            self._finish_search()
+            return "break"
+        if event.keysym == "BackSpace":
+            self._search[0] = self._search[0][:-1]
+            self._search_history(len(self.history.entries))
+        elif event.char and event.char.isprintable() and not event.state & 0x4:
+            self._search[0] += event.char
+            # Удлиненный запрос ищется начиная с текущей найденной команды включительно
+            self._search_history(self._search[1] + 1)
+        elif event.keysym.endswith(("_L", "_R", "_Lock")):
+            # Сами по себе модификаторы поиск не завершают
+            return "break"
+        else:
+            # Любая другая клавиша оставляет найденную команду в поле ввода и действует как обычно
+            self._finish_search()
+            return None
+        self._show_search()
+        return "break"
+
+    def _search_history(self, before):
+        query = self._search[0]
+        position = self.history.search(query, before) if query else None
+        if position is not None:
+            self._search[1] = position
+            self._set_entry(self.history.entries[position])
+            self.history.position = position
+        elif not query:
+            self._search[1] = len(self.history.entries)
+            self._set_entry(self._search[2])
+
+    def _show_search(self):
+        query = self._search[0]
+        found = not query or query in self.entry.get()
+        self.status.configure(text=f"({'' if found else 'failed '}reverse-i-search)`{query}'")
+
+    def _finish_search(self):
+        if self._search is not None:
+            self._search = None
+            self.status.configure(text="")
+
+    def cancel_command(self, event=None):
+        """Прерывает выполняемую команду (Ctrl+C); без выполняемой команды работает обычное копирование"""
+        if not self._running:
+            return None
+        self._cancel.set()
+        return "break"
+
+    def _worker_loop(self):
+        while True:
+            command = self._commands.get()
+            if command is None:
+                return
+            self._cancel.clear()
+            self._running = True
+            try:
+                self._execute_command_thread(command)
+            finally:
+                self._running = False
 
     def _execute_command_thread(self, command):
         try:
             result = self.handle_command(command)
             prompt = f"{self.shell.pwd()}$ {command}\n"
-            if result:
-                self._append_output(f"{prompt}{result}\n")
-            else:
-                self._append_output(f"{prompt}")
+            if isinstance(result, str) or not result:
+                self._append_output(f"{prompt}{result}\n" if result else prompt)
+                return
+            # Построчный вывод (например, tree) передается в виджет порциями по мере получения,
+            # поэтому первые строки большого дерева появляются сразу
+            self._append_output(prompt)
+            chunk = []
+            for line in result:
+                if self._cancel.is_set():
+                    close = getattr(result, "close", None)
+                    if close is not None:
+                        close()
+                    chunk.append("^C")
+                    break
+                chunk.append(line)
+                if len(chunk) >= OUTPUT_CHUNK_LINES:
+                    self._append_output("\n".join(chunk) + "\n")
+                    chunk = []
+            if chunk:
+                self._append_output("\n".join(chunk) + "\n")
         except Exception as e:
             self._append_output(f"Ошибка: {e}\n")
 
     def _append_output(self, text):
-        def append():
+        """Передает текст в окно; при переполненной очереди ждет, пока окно ее разберет"""
+        while not self._closing:
+            try:
+                self._output_queue.put(text, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _flush_output(self):
+        """Раз в кадр вставляет весь накопленный вывод и обрезает старые строки сверх SCROLLBACK_LINES"""
+        parts = []
+        while True:
+            try:
+                parts.append(self._output_queue.get_nowait())
+            except queue.Empty:
+                break
+        if parts:
             self.output.configure(state='normal')
-            self.output.insert(END, text)
+            self.output.insert(self._tk.END, ''.join(parts))
+            lines = int(self.output.index('end-1c').split('.')[0])
+            if lines > SCROLLBACK_LINES:
+                self.output.delete('1.0', f'{lines - SCROLLBACK_LINES + 1}.0')
             self.output.configure(state='disabled')
-            self.output.see(END)
-        self.output.after(0, append)
+            self.output.see(self._tk.END)
+        if self._quit_requested:
+            self.window.quit()
+            return
+        self.window.after(OUTPUT_FRAME_MS, self._flush_output)
 
     def handle_command(self, command):
-        parts = command.strip().split()
-        if not parts:
-            return ""
-
-        cmd = parts[0]
-        args = parts[1:]
-
-        try:
-            if cmd == "pwd":
-                return self.shell.pwd()
-            elif cmd == "ls":
-                output = "\n".join(self.shell.ls())
-                return output if output else "Нет файлов или директорий."
-            elif cmd == "cd":
-                if len(args) < 1:
-                    return "cd: отсутствует аргумент."
-                self.shell.cd(args[0])
-                return ""
-            elif cmd == "cat":
-                if len(args) < 1:
-                    return "cat: отсутствует аргумент."
-                return self.shell.cat(args[0])
-            elif cmd == "mkdir":
-                if len(args) < 1:
-                    return "mkdir: отсутствует аргумент."
-                return self.shell.mkdir(args[0])
-            elif cmd == "nano":
-                if len(args) < 2:
-                    return "nano: недостаточно аргументов. Использование: nano <файл> <содержимое>"
-                filename = args[0]
-                content = ' '.join(args[1:])
-                return self.shell.nano(filename, content)
-            elif cmd == "tree":
-                output = self.shell.tree()
-                return output if output else "Файловая система пуста."
-            elif cmd == "mv":
-                if len(args) < 2:
-                    return "mv: недостаточно аргументов. Использование: mv <источник> <назначение>"
-                return self.shell.mv(args[0], args[1])
-            elif cmd == "exit":
-                self.shell._write_to_zip()
-                self.window.quit()
-                return "Выход..."
-            else:
-                return f"Команда '{cmd}' не найдена."
-        except Exception as e:
-            return f"Ошибка при выполнении команды '{command}': {e}"
+        result = self.dispatcher.execute(command)
+        if self.dispatcher.exit_requested:
+            # Окно закрывается из потока Tk при следующей вставке вывода
+            self._quit_requested = True
+        return result
 
     def run(self):
         self.window.protocol("WM_DELETE_WINDOW", self.on_close)
         self.window.mainloop()
 
     def on_close(self):
-        self.shell._write_to_zip()
+        # Текущая команда прерывается, и рабочий поток завершается до записи архива
+        self._closing = True
+        self._cancel.set()
+        self._commands.put(None)
+        self._worker.join()
+        if self.shell._zip is not None:
+            self.shell._write_to_zip()
+            self.shell.close()
         self.window.destroy()
 
+def parse_options(args, spec):
+    """Отделяет опции от позиционных аргументов.
+
+    spec сопоставляет флагу пару (имя, тип значения); тип None означает флаг без значения."""
+    options = {}
+    positional = []
+    args = iter(args)
+    for arg in args:
+        if arg not in spec:
+            positional.append(arg)
+            continue
+        name, kind = spec[arg]
+        if kind is None:
+            options[name] = True
+            continue
+        value = next(args, None)
+        if value is None:
+            raise ValueError(f"Опция {arg} требует значение.")
+        options[name] = kind(value)
+    return options, positional
+
+
 def load_config(xml_path):
     """Загружает настройки из XML-файла."""
     tree = ET.parse(xml_path)
@@ -325,16 +3176,62 @@ def load_config(xml_path):
         "computer_name": root.findtext("computer_name", default="VShell"),
         "zip_file_path": root.findtext("zip_file_path"),
         "startup_script_path": root.findtext("startup_script_path"),
+        "lazy_load": root.findtext("lazy_load", default="true").strip().lower() in ("1", "true", "yes"),
+        "cache_size": int(root.findtext("cache_size", default=str(DEFAULT_CACHE_SIZE))),
+        "journal": root.findtext("journal", default="true").strip().lower() in ("1", "true", "yes"),
+        "journal_group_commit": int(root.findtext("journal_group_commit", default="1")),
+        "checkpoint_size": int(root.findtext("checkpoint_size", default=str(DEFAULT_CHECKPOINT_SIZE))),
+        "workers": int(root.findtext("workers", default=str(DEFAULT_WORKERS))),
+        "grep_index": root.findtext("grep_index", default="false").strip().lower() in ("1", "true", "yes"),
+        "index_cache": root.findtext("index_cache", default="true").strip().lower() in ("1", "true", "yes"),
+        "history_file": root.findtext("history_file", default=os.path.join(os.path.expanduser("~"), ".vshell_history")),
+        # Нижние слои: <mounts><mount path="/точка/монтирования">архив.zip</mount></mounts>
+        "mounts": [(mount.get("path"), (mount.text or "").strip()) for mount in root.findall("mounts/mount")],
     }
 
     # Проверка наличия всех необходимых параметров
     if not config["zip_file_path"]:
         raise ValueError("XML-конфигурация должна содержать элемент 'zip_file_path'.")
+    for mount_point, archive_path in config["mounts"]:
+        if not mount_point or not archive_path:
+            raise ValueError("Элемент 'mount' должен содержать атрибут 'path' и путь к архиву.")
 
     return config
 
 
-def execute_startup_script(shell, script_path):
+def write_result(result, output):
+    """Выводит результат команды: строку целиком или итератор построчно"""
+    if not result:
+        return
+    if isinstance(result, str):
+        output.write(result)
+        output.write("\n")
+        return
+    try:
+        for line in result:
+            output.write(line)
+            output.write("\n")
+    except Exception as e:
+        output.write(f"Ошибка: {e}\n")
+
+
+def run_batch(dispatcher, commands, output):
+    """Выполняет команды по одной на строку без окна; пустые строки и комментарии (#) пропускаются.
+
+    Возвращает число выполненных команд."""
+    executed = 0
+    for command in commands:
+        command = command.strip()
+        if not command or command.startswith('#'):
+            continue
+        write_result(dispatcher.execute(command), output)
+        executed += 1
+        if dispatcher.exit_requested:
+            break
+    return executed
+
+
+def execute_startup_script(dispatcher, script_path):
     """Выполняет команды из стартового скрипта."""
     if not os.path.exists(script_path):
         print(f"Стартовый скрипт '{script_path}' не найден.")
@@ -346,17 +3243,26 @@ def execute_startup_script(shell, script_path):
     for command in commands:
         command = command.strip()
         if command:
-            print(f"Выполняется команда из скрипта: {command}")
-            try:
-                shell.handle_command(command)
-            except Exception as e:
-                print(f"Ошибка при выполнении команды '{command}': {e}")
+            logger.info("Выполняется команда из скрипта: %s", command)
+            result = dispatcher.execute(command)
+            if isinstance(result, str) and result.startswith("Ошибка"):
+                logger.error("%s", result)
 
 
 def main():
     parser = argparse.ArgumentParser(description="Виртуальный Эмулятор Shell с GUI")
     parser.add_argument("config_file", help="C:\\Users\\pasha\\PycharmProjects\\Konfig_1\\config.xml")
+    parser.add_argument("--log-level", default="warning", choices=["debug", "info", "warning", "error"],
+                        help="уровень подробности журнала (по умолчанию warning)")
+    parser.add_argument("--profile", action="store_true",
+                        help="вывести замеры фаз загрузки, задержек команд и пиковой памяти")
+    parser.add_argument("--script", help="выполнить команды из файла без окна и завершить работу")
+    parser.add_argument("--batch", action="store_true",
+                        help="выполнить команды из стандартного ввода без окна и завершить работу")
+    parser.add_argument("--serve", metavar="SOCKET",
+                        help="принимать команды нескольких сеансов на Unix-сокете вместо окна")
     args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format="%(levelname)s %(name)s: %(message)s")
 
     # Загрузка конфигурации из XML-файла
     try:
@@ -376,21 +3282,65 @@ def main():
 
     # Создание виртуальной файловой системы на основе ZIP-файла
     try:
-        shell = VShell(zip_file_path)
+        shell = VShell(zip_file_path, lazy=config["lazy_load"], cache_size=config["cache_size"],
+                       journal=config["journal"], group_commit=config["journal_group_commit"],
+                       checkpoint_size=config["checkpoint_size"], workers=config["workers"],
+                       grep_index=config["grep_index"], mounts=config["mounts"],
+                       index_cache=config["index_cache"])
         shell.computer_name = config["computer_name"]  # Устанавливаем имя компьютера
     except zipfile.BadZipFile:
         print(f"Ошибка: Файл '{zip_file_path}' поврежден или не является корректным ZIP-файлом.")
         return
+    except (FileNotFoundError, FileExistsError, ValueError) as e:
+        print(f"Ошибка при монтировании слоев: {e}")
+        return
 
     # Выполнение команд из стартового скрипта
+    dispatcher = CommandDispatcher(shell)
     startup_script_path = config["startup_script_path"]
     if startup_script_path:
-        execute_startup_script(shell, startup_script_path)
+        execute_startup_script(dispatcher, startup_script_path)
+
+    if args.profile:
+        print(shell.profiler.report())
+
+    # Пакетный режим: команды из файла или стандартного ввода, окно не создается
+    if args.script or args.batch:
+        start = time.perf_counter()
+        if args.script:
+            with open(args.script, 'r', encoding='utf-8') as f:
+                executed = run_batch(dispatcher, f, sys.stdout)
+        else:
+            executed = run_batch(dispatcher, sys.stdin, sys.stdout)
+        if not dispatcher.exit_requested:
+            shell._write_to_zip()
+            shell.close()
+        logger.info("Выполнено команд: %d за %.3f с", executed, time.perf_counter() - start)
+        if args.profile:
+            print(shell.profiler.report())
+        return
+
+    # Режим сервера: сеансы подключаются к сокету, изменения сохраняются при остановке (Ctrl+C)
+    if args.serve:
+        import asyncio
+        try:
+            asyncio.run(ShellServer(shell).serve(args.serve))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            shell._write_to_zip()
+            shell.close()
+        if args.profile:
+            print(shell.profiler.report())
+        return
 
     # Запуск GUI
-    gui = ShellGUI(shell)
+    gui = ShellGUI(shell, config["history_file"])
     gui.run()
 
+    if args.profile:
+        print(shell.profiler.report())
+
 
 if __name__ == "__main__":
     main()